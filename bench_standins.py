@@ -0,0 +1,382 @@
+"""
+Local stand-ins for the Bluesky and Twitter APIs, used by benchmark.py.
+
+One server answers everything the mirror and the preview server talk to: session login and
+refresh, a synthetic author feed, CDN images and blobs, the AppView lookups used by previews,
+media upload and tweet creation. Point the [endpoints] base URLs (and the account's pds_url) of
+the mirror, or PREVIEW_APPVIEW_URL/PREVIEW_BSKY_WEB_URL of the preview server, at it.
+
+    python bench_standins.py --posts 200 --rate 5 --latency 0.05 --port 6010
+
+A seed post is published right away so the mirror can take its first feed position. The
+benchmark posts follow after --delay seconds at --rate posts per second (all at once with 0).
+"""
+import argparse
+import base64
+import json
+import logging
+import random
+import re
+import threading
+from datetime import datetime, timezone
+from time import sleep, time
+from flask import Flask, Response, request, jsonify
+from werkzeug.serving import make_server
+
+BENCH_HANDLE = 'bench.test'
+BENCH_DID = 'did:plc:benchstandin'
+QUOTED_HANDLE = 'quoted.test'
+QUOTED_DID = 'did:plc:benchquoted'
+# Tweets name the post they mirror, so tweet times can be matched to publish times
+POST_MARKER = re.compile(r'bench post (\d+)')
+
+def make_jwt(subject, expires_at):
+    """Build an unsigned JWT with the claims the mirror reads."""
+    def encode(data):
+        return base64.urlsafe_b64encode(json.dumps(data).encode()).decode().rstrip('=')
+    return f"{encode({'alg': 'none'})}.{encode({'sub': subject, 'exp': int(expires_at)})}.bench"
+
+def get_jwt_expiry(token):
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return json.loads(base64.urlsafe_b64decode(payload)).get('exp')
+    except (IndexError, ValueError, AttributeError):
+        return None
+
+def format_time(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+def parse_mix(mix):
+    """Parse a media mix like 'text=4,images=4,video=1,quote=1' into post kinds and weights."""
+    kinds, weights = [], []
+    for part in mix.split(','):
+        kind, weight = part.split('=')
+        kinds.append(kind.strip())
+        weights.append(float(weight))
+    return kinds, weights
+
+class StandIn:
+    """Synthetic upstream state and the counters the benchmark reports from."""
+
+    def __init__(self, options):
+        self.options = options
+        self.base_url = None
+        self.lock = threading.Lock()
+        self.rng = random.Random(options.seed)
+        self.image = bytes(self.rng.getrandbits(8) for _ in range(options.image_size))
+        self.video = bytes(options.video_size)
+        self.counters = {}
+        self.tweets = []
+        self.tweeted_at = {}
+        self.media_ids = 0
+
+        kinds, weights = parse_mix(options.mix)
+        start = time()
+        # Post 0 is the seed post, the benchmark posts follow after the delay
+        self.posts = [self.make_post(0, 'text', start)]
+        for index in range(1, options.posts + 1):
+            offset = (index - 1) / options.rate if options.rate > 0 else 0
+            kind = self.rng.choices(kinds, weights)[0]
+            self.posts.append(self.make_post(index, kind, start + options.delay + offset))
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def make_post(self, index, kind, published_at):
+        return {
+            'index': index,
+            'kind': kind,
+            'images': self.rng.randint(1, 4) if kind == 'images' else 0,
+            'published_at': published_at,
+            'rkey': f"bench{index:06d}"
+        }
+
+    def published(self):
+        """Published posts, newest first like the author feed."""
+        now = time()
+        return [post for post in reversed(self.posts) if post['published_at'] <= now]
+
+    def image_view(self, did, post, count):
+        return [{
+            'thumb': f"{self.base_url}/img/feed_thumbnail/plain/{did}/bafyimg{post['index']}x{i}@jpeg",
+            'fullsize': f"{self.base_url}/img/feed_fullsize/plain/{did}/bafyimg{post['index']}x{i}@jpeg",
+            'alt': ''
+        } for i in range(count)]
+
+    def post_text(self, post):
+        return f"bench post {post['index']} " + 'lorem ipsum ' * 10
+
+    def post_view(self, post):
+        """Render a post in the shape getAuthorFeed and getPosts return."""
+        view = {
+            'uri': f"at://{BENCH_DID}/app.bsky.feed.post/{post['rkey']}",
+            'cid': f"bafypost{post['index']}",
+            'author': {'did': BENCH_DID, 'handle': BENCH_HANDLE, 'displayName': 'Bench'},
+            'record': {
+                '$type': 'app.bsky.feed.post',
+                'text': self.post_text(post),
+                'createdAt': format_time(post['published_at'])
+            },
+            'indexedAt': format_time(post['published_at'])
+        }
+
+        if post['kind'] == 'images':
+            view['embed'] = {'$type': 'app.bsky.embed.images#view', 'images': self.image_view(BENCH_DID, post, post['images'])}
+        elif post['kind'] == 'video':
+            view['embed'] = {
+                '$type': 'app.bsky.embed.video#view',
+                'cid': f"bafyvideo{post['index']}",
+                'thumbnail': f"{self.base_url}/img/feed_thumbnail/plain/{BENCH_DID}/bafyvideo{post['index']}@jpeg"
+            }
+        elif post['kind'] == 'quote':
+            view['embed'] = {
+                '$type': 'app.bsky.embed.record#view',
+                'record': {
+                    '$type': 'app.bsky.embed.record#viewRecord',
+                    'uri': f"at://{QUOTED_DID}/app.bsky.feed.post/quoted{post['index']:06d}",
+                    'author': {'did': QUOTED_DID, 'handle': QUOTED_HANDLE, 'displayName': 'Quoted'},
+                    'value': {'$type': 'app.bsky.feed.post', 'text': f"quoted by bench post {post['index']}"},
+                    'embeds': [{'$type': 'app.bsky.embed.images#view', 'images': self.image_view(QUOTED_DID, post, 1)}]
+                }
+            }
+        return view
+
+    def post_record(self, post):
+        """Render a post as the raw record the event stream carries, with blob references instead of URLs."""
+        def blob(cid, mime_type, size):
+            return {'$type': 'blob', 'ref': {'$link': cid}, 'mimeType': mime_type, 'size': size}
+
+        record = {'$type': 'app.bsky.feed.post', 'text': self.post_text(post), 'createdAt': format_time(post['published_at'])}
+        if post['kind'] == 'images':
+            record['embed'] = {
+                '$type': 'app.bsky.embed.images',
+                'images': [{'image': blob(f"bafyimg{post['index']}x{i}", 'image/jpeg', len(self.image)), 'alt': ''}
+                           for i in range(post['images'])]
+            }
+        elif post['kind'] == 'video':
+            record['embed'] = {'$type': 'app.bsky.embed.video', 'video': blob(f"bafyvideo{post['index']}", 'video/mp4', len(self.video))}
+        elif post['kind'] == 'quote':
+            record['embed'] = {
+                '$type': 'app.bsky.embed.record',
+                'record': {'uri': f"at://{QUOTED_DID}/app.bsky.feed.post/quoted{post['index']:06d}", 'cid': f"bafyquoted{post['index']}"}
+            }
+        return record
+
+    def post_events(self):
+        """The Jetstream create events of the benchmark posts, stamped with their publish times."""
+        return [{
+            'did': BENCH_DID,
+            'time_us': int(post['published_at'] * 1e6),
+            'kind': 'commit',
+            'commit': {
+                'operation': 'create',
+                'collection': 'app.bsky.feed.post',
+                'rkey': post['rkey'],
+                'cid': f"bafypost{post['index']}",
+                'record': self.post_record(post)
+            }
+        } for post in self.posts[1:]]
+
+    def tweet_created(self, text, is_reply):
+        """Record a created tweet and return its id."""
+        with self.lock:
+            tweet_id = str(len(self.tweets) + 1)
+            self.tweets.append({'id': tweet_id, 'text': text, 'reply': is_reply, 'created_at': time()})
+            match = POST_MARKER.search(text)
+            if match and not is_reply:
+                if int(match.group(1)) in self.tweeted_at:
+                    self.counters['duplicate_tweets'] = self.counters.get('duplicate_tweets', 0) + 1
+                self.tweeted_at.setdefault(int(match.group(1)), time())
+        return tweet_id
+
+    def next_media_id(self):
+        with self.lock:
+            self.media_ids += 1
+            return str(self.media_ids)
+
+    def stats(self):
+        """Counters plus the mirror latency (tweet time minus publish time) of every tweeted benchmark post."""
+        with self.lock:
+            tweeted = {index: at for index, at in self.tweeted_at.items() if index > 0}
+            return {
+                'published': len([post for post in self.posts[1:] if post['published_at'] <= time()]),
+                'posts': len(self.posts) - 1,
+                'tweeted': len(tweeted),
+                'tweets': len([tweet for tweet in self.tweets if not tweet['reply']]),
+                'replies': len([tweet for tweet in self.tweets if tweet['reply']]),
+                'first_published_at': self.posts[1]['published_at'] if len(self.posts) > 1 else None,
+                'last_tweeted_at': max(tweeted.values()) if tweeted else None,
+                'latencies': [at - self.posts[index]['published_at'] for index, at in tweeted.items()],
+                'counters': dict(self.counters)
+            }
+
+def create_app(standin):
+    app = Flask(__name__)
+    options = standin.options
+
+    def bearer_token():
+        return request.headers.get('Authorization', '').removeprefix('Bearer ').strip()
+
+    def session_response():
+        standin.count('sessions')
+        return jsonify({
+            'accessJwt': make_jwt(BENCH_DID, time() + options.token_ttl),
+            'refreshJwt': make_jwt(BENCH_DID, time() + 90 * 24 * 3600),
+            'did': BENCH_DID,
+            'handle': BENCH_HANDLE
+        })
+
+    @app.before_request
+    def inject_latency():
+        if options.latency:
+            sleep(options.latency * (1 + standin.rng.uniform(-options.jitter, options.jitter)))
+
+    @app.route("/xrpc/com.atproto.server.createSession", methods=["POST"])
+    def create_session():
+        standin.count('logins')
+        return session_response()
+
+    @app.route("/xrpc/com.atproto.server.refreshSession", methods=["POST"])
+    def refresh_session():
+        expiry = get_jwt_expiry(bearer_token())
+        if expiry is None or expiry < time():
+            standin.count('rejected_refreshes')
+            return jsonify({'error': 'ExpiredToken', 'message': 'Token has expired'}), 400
+        standin.count('refreshes')
+        return session_response()
+
+    @app.route("/xrpc/com.atproto.identity.resolveHandle")
+    def resolve_handle():
+        standin.count('resolve_handle')
+        handle = request.args.get('handle')
+        if handle not in (BENCH_HANDLE, QUOTED_HANDLE):
+            return jsonify({'error': 'InvalidRequest', 'message': 'Unable to resolve handle'}), 400
+        return jsonify({'did': BENCH_DID if handle == BENCH_HANDLE else QUOTED_DID})
+
+    @app.route("/xrpc/app.bsky.actor.getProfiles")
+    def get_profiles():
+        standin.count('get_profiles')
+        dids = {BENCH_HANDLE: BENCH_DID, QUOTED_HANDLE: QUOTED_DID}
+        actors = [actor.lower() for actor in request.args.getlist('actors') if actor.lower() in dids]
+        return jsonify({'profiles': [{'did': dids[actor], 'handle': actor} for actor in actors]})
+
+    @app.route("/xrpc/app.bsky.feed.getAuthorFeed")
+    def get_author_feed():
+        standin.count('feed_requests')
+        expiry = get_jwt_expiry(bearer_token())
+        if expiry is None or expiry < time() or standin.rng.random() < options.expire_rate:
+            standin.count('expired_tokens')
+            return jsonify({'error': 'ExpiredToken', 'message': 'Token has expired'}), 400
+
+        posts = standin.published()
+        offset = int(request.args.get('cursor') or 0)
+        limit = int(request.args.get('limit', 50))
+        page = posts[offset:offset + limit]
+        body = {'feed': [{'post': standin.post_view(post)} for post in page]}
+        if offset + limit < len(posts):
+            body['cursor'] = str(offset + limit)
+        return jsonify(body)
+
+    @app.route("/xrpc/app.bsky.feed.getPosts")
+    def get_posts():
+        standin.count('get_posts')
+        views = []
+        for uri in request.args.getlist('uris'):
+            rkey = uri.split('/')[-1]
+            if rkey.startswith('bench') and rkey[5:].isdigit() and int(rkey[5:]) < len(standin.posts):
+                views.append(standin.post_view(standin.posts[int(rkey[5:])]))
+        return jsonify({'posts': views})
+
+    @app.route("/profile/<handle>/post/<post_id>")
+    def post_page(handle, post_id):
+        standin.count('page_fetches')
+        return f'<html><head><meta property="og:title" content="{handle}"><meta property="og:description" content="{post_id}"></head></html>'
+
+    @app.route("/img/<path:path>")
+    def get_image(path):
+        standin.count('image_downloads')
+        return Response(standin.image, mimetype='image/jpeg')
+
+    @app.route("/xrpc/com.atproto.sync.getBlob")
+    def get_blob():
+        standin.count('blob_downloads')
+        return Response(standin.video, mimetype='application/octet-stream')
+
+    @app.route("/1.1/media/upload.json", methods=["GET", "POST"])
+    def media_upload():
+        command = request.values.get('command')
+        standin.count(f"upload_{(command or 'simple').lower()}")
+        if command == 'APPEND':
+            return '', 204
+        if command == 'STATUS':
+            return jsonify({'media_id_string': request.values.get('media_id'), 'processing_info': {'state': 'succeeded'}})
+        if command == 'FINALIZE':
+            body = {'media_id_string': request.values.get('media_id'), 'expires_after_secs': 86400}
+            if options.processing_time:
+                body['processing_info'] = {'state': 'pending', 'check_after_secs': options.processing_time}
+            return jsonify(body)
+        return jsonify({'media_id_string': standin.next_media_id(), 'expires_after_secs': 86400})
+
+    @app.route("/2/tweets", methods=["POST"])
+    def create_tweet():
+        if standin.rng.random() < options.rate_limit_rate:
+            standin.count('rate_limited')
+            return jsonify({'title': 'Too Many Requests'}), 429, {
+                'x-rate-limit-limit': '300',
+                'x-rate-limit-remaining': '0',
+                'x-rate-limit-reset': str(int(time()) + 1)
+            }
+
+        payload = request.get_json(silent=True) or {}
+        tweet_id = standin.tweet_created(payload.get('text', ''), 'reply' in payload)
+        return jsonify({'data': {'id': tweet_id, 'text': payload.get('text', '')}}), 201
+
+    @app.route("/stats")
+    def stats():
+        return jsonify(standin.stats())
+
+    return app
+
+def start(options, host='localhost', port=0):
+    """Start the stand-ins in a background thread. Returns the StandIn and its base URL."""
+    standin = StandIn(options)
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server(host, port, create_app(standin), threaded=True)
+    standin.base_url = f"http://{host}:{server.server_port}"
+    threading.Thread(target=server.serve_forever, name="standins", daemon=True).start()
+    return standin, standin.base_url
+
+def add_arguments(parser):
+    """Add the stand-in options (feed size, media mix and injected faults) to an argument parser."""
+    parser.add_argument("--posts", type=int, default=100, help="Benchmark posts in the synthetic feed")
+    parser.add_argument("--rate", type=float, default=0, help="Posts published per second after the delay, 0 for all at once")
+    parser.add_argument("--delay", type=float, default=3, help="Seconds before the first benchmark post is published")
+    parser.add_argument("--mix", default="text=4,images=4,video=1,quote=1", help="Relative weights of the post kinds")
+    parser.add_argument("--image-size", type=int, default=200 * 1024, help="Bytes per image")
+    parser.add_argument("--video-size", type=int, default=3 * 1024 * 1024, help="Bytes per video")
+    parser.add_argument("--latency", type=float, default=0.02, help="Seconds added to every stand-in response")
+    parser.add_argument("--jitter", type=float, default=0.5, help="Random +/- fraction of the latency")
+    parser.add_argument("--token-ttl", type=float, default=7200, help="Lifetime of access tokens in seconds")
+    parser.add_argument("--expire-rate", type=float, default=0, help="Fraction of feed requests answered with ExpiredToken")
+    parser.add_argument("--rate-limit-rate", type=float, default=0, help="Fraction of tweet requests answered with 429")
+    parser.add_argument("--processing-time", type=int, default=1, help="Seconds videos stay in processing after FINALIZE")
+    parser.add_argument("--seed", type=int, default=1)
+
+def default_options(**overrides):
+    """The stand-in options add_arguments defaults to, with some overridden, e.g. for tests."""
+    parser = argparse.ArgumentParser()
+    add_arguments(parser)
+    return argparse.Namespace(**dict(vars(parser.parse_args([])), **overrides))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve local Bluesky and Twitter stand-ins.")
+    add_arguments(parser)
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=6010)
+    args = parser.parse_args()
+
+    standin, base_url = start(args, args.host, args.port)
+    print(f"Serving stand-ins on {base_url}")
+    threading.Event().wait()
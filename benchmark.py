@@ -0,0 +1,453 @@
+"""
+End-to-end benchmark of the mirror loop and the preview server against local stand-ins.
+
+    python benchmark.py mirror --posts 200 --rate 20 --latency 0.05 --rate-limit-rate 0.05
+    python benchmark.py preview --posts 50 --requests 2000 --concurrency 32 [--async]
+    python benchmark.py stream --posts 100 --rate 10
+    python benchmark.py startup --runs 10 [--max-startup 0.5]
+
+The first two run the real entry points (main.py, preview.py) as child processes in a scratch
+directory, with every upstream URL pointed at bench_standins.py, and report throughput, latency
+percentiles, cache hit ratio and peak RSS of the child. The stream run mirrors the same feed in
+the jetstream ingest mode: its events are written to a recorded events file and replayed by
+jetstream_replay.py, main.py is restarted halfway and the replay server is shut down at the end.
+It exits with status 1 unless every post is tweeted exactly once, the restart resumes from the
+saved cursor minus the rewind, the cursor file ends at the last event and the mirror falls back
+to polling once the stream is gone. The startup run imports each entry point in a fresh
+interpreter and reports its startup time, import cost and RSS; it exits with status 1 when an
+entry point loads a module it should only load on first use, or starts slower than
+--max-startup seconds.
+"""
+import argparse
+import collections
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import sleep, time
+from urllib.parse import parse_qs, urlsplit
+import requests
+import bench_standins
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+CRAWLER_USER_AGENT = 'Twitterbot/1.0'
+
+MIRROR_CONFIG = """
+[twitter]
+api_key = "bench"
+api_secret_key = "bench"
+access_token = "bench"
+access_token_secret = "bench"
+
+[bluesky]
+username = "{handle}"
+password = "bench"
+identifier = "bench@example.com"
+did = "{did}"
+pds_url = "{base_url}"
+refresh = {refresh}
+min_refresh = {refresh}
+max_refresh = {refresh}
+refresh_jitter = 0
+page_limit = 100
+max_pages = 100
+
+[mirror]
+media_workers = {media_workers}
+
+[http]
+retries = 1
+
+[endpoints]
+bluesky_auth = "{base_url}"
+bluesky_appview = "{base_url}"
+bluesky_cdn = "{base_url}"
+plc_directory = "{base_url}"
+twitter_api = "{base_url}"
+twitter_upload = "{base_url}"
+"""
+
+# Appended to MIRROR_CONFIG by the stream benchmark; the cursor is saved after every event
+STREAM_CONFIG = """
+[stream]
+mode = "jetstream"
+url = "{stream_url}"
+cursor_file = "jetstream_cursor.json"
+cursor_interval = 0
+safety_poll = {safety_poll}
+"""
+
+# Entry point modules, and the modules they must not load at startup: the other process's
+# dependencies and the heavy ones that are only imported on first use
+STARTUP_ENTRIES = {
+    'mirror': ('main', ('flask', 'jinja2', 'cv2', 'numpy', 'bs4', 'gevent', 'websocket', 'requests_oauthlib')),
+    'preview': ('preview', ('cv2', 'numpy', 'bs4', 'gevent', 'requests_oauthlib', 'websocket'))
+}
+
+# Run in the child: import the entry point and report the import time, peak RSS and loaded modules
+STARTUP_PROBE = """
+import resource, sys, time
+started = time.perf_counter()
+import {module}
+print(time.perf_counter() - started, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+print(' '.join(sys.modules))
+"""
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a list of numbers, None when empty."""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+def peak_rss_mb(pid):
+    """Peak resident set size of a running process in MB, read from /proc (Linux only)."""
+    try:
+        with open(f"/proc/{pid}/status", 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+def wait_for_port(port, timeout=30):
+    deadline = time() + timeout
+    while time() < deadline:
+        with socket.socket() as sock:
+            if sock.connect_ex(('localhost', port)) == 0:
+                return
+        sleep(0.1)
+    raise Exception(f"Nothing listening on port {port} after {timeout}s")
+
+def stop(process):
+    process.terminate()
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+def format_seconds(value):
+    return f"{value * 1000:.0f}ms" if value is not None else "n/a"
+
+def format_mb(value):
+    return f"{value:.1f}MB" if value is not None else "n/a"
+
+def write_mirror_config(args, work_dir, base_url, extra=''):
+    with open(os.path.join(work_dir, 'config.toml'), 'w') as f:
+        f.write(MIRROR_CONFIG.format(
+            handle=bench_standins.BENCH_HANDLE,
+            did=bench_standins.BENCH_DID,
+            base_url=base_url,
+            refresh=args.refresh,
+            media_workers=args.media_workers
+        ) + extra)
+
+def start_mirror(work_dir, log):
+    env = dict(os.environ, PYTHONUNBUFFERED='1')
+    return subprocess.Popen([sys.executable, os.path.join(REPO_DIR, 'main.py')], cwd=work_dir, env=env,
+                            stdout=log, stderr=subprocess.STDOUT)
+
+def wait_for_tweets(standin, process, count, deadline, peak_rss=None):
+    """Wait until count benchmark posts are tweeted or the mirror exits. Returns the peak RSS seen."""
+    while time() < deadline and process.poll() is None:
+        peak_rss = peak_rss_mb(process.pid) or peak_rss
+        if standin.stats()['tweeted'] >= count:
+            break
+        sleep(0.2)
+    return peak_rss
+
+def run_mirror(args, work_dir):
+    """Mirror the synthetic feed with main.py and measure how fast posts reach the stand-in Twitter."""
+    standin, base_url = bench_standins.start(args)
+    write_mirror_config(args, work_dir, base_url)
+
+    with open(os.path.join(work_dir, 'mirror.log'), 'w') as log:
+        process = start_mirror(work_dir, log)
+        try:
+            peak_rss = wait_for_tweets(standin, process, args.posts, time() + args.timeout)
+        finally:
+            stop(process)
+
+    stats = standin.stats()
+    elapsed = (stats['last_tweeted_at'] or time()) - stats['first_published_at']
+    counters = stats['counters']
+    print(f"Mirrored {stats['tweeted']}/{stats['posts']} posts ({stats['replies']} replies) in {elapsed:.1f}s")
+    print(f"  posts/sec      {stats['tweeted'] / elapsed if elapsed > 0 else 0:.2f}")
+    print(f"  latency p50    {format_seconds(percentile(stats['latencies'], 0.5))}")
+    print(f"  latency p99    {format_seconds(percentile(stats['latencies'], 0.99))}")
+    print(f"  peak RSS       {format_mb(peak_rss)}")
+    print(f"  feed requests  {counters.get('feed_requests', 0)} ({counters.get('expired_tokens', 0)} expired tokens, "
+          f"{counters.get('refreshes', 0)} refreshes, {counters.get('logins', 0)} logins)")
+    print(f"  media          {counters.get('image_downloads', 0)} images and {counters.get('blob_downloads', 0)} videos downloaded")
+    print(f"  rate limited   {counters.get('rate_limited', 0)} tweet requests")
+    if stats['tweeted'] < stats['posts']:
+        print(f"  timed out, see {os.path.join(work_dir, 'mirror.log')}")
+
+def start_replay(events, port):
+    """
+    Replay events like Jetstream, each at its time_us, from an event loop in a background thread.
+    Returns the request paths of the connections made so far and a function that shuts the server
+    down, dropping the open connections.
+    """
+    import asyncio
+    import websockets
+    import jetstream_replay
+
+    paths = []
+    loop = asyncio.new_event_loop()
+    stopped = loop.create_future()
+
+    async def handle(websocket):
+        paths.append(websocket.request.path)
+        try:
+            await jetstream_replay.replay(websocket, events, 0, True, realtime=True)
+        except websockets.ConnectionClosed:
+            # The mirror was stopped mid-stream
+            pass
+
+    async def serve():
+        # Don't wait long for the closing handshake when the server shuts down
+        async with websockets.serve(handle, 'localhost', port, close_timeout=1):
+            await stopped
+
+    thread = threading.Thread(target=loop.run_until_complete, args=(serve(),), name="replay", daemon=True)
+    thread.start()
+
+    def shut_down():
+        loop.call_soon_threadsafe(stopped.set_result, None)
+        thread.join(timeout=10)
+    return paths, shut_down
+
+def run_stream(args, work_dir):
+    """
+    Mirror the synthetic feed from a replayed event stream, restarting main.py halfway, and check
+    that every post is tweeted once, the cursor resumes and advances, and polling takes over when
+    the stream goes away.
+    """
+    # Only the stream benchmark needs websockets
+    import jetstream
+    import jetstream_replay
+
+    standin, base_url = bench_standins.start(args)
+    events_path = os.path.join(work_dir, 'events.jsonl')
+    with open(events_path, 'w') as f:
+        for event in standin.post_events():
+            f.write(json.dumps(event) + '\n')
+
+    port = free_port()
+    events = jetstream_replay.load_events(events_path)
+    paths, shut_down_replay = start_replay(events, port)
+    write_mirror_config(args, work_dir, base_url, STREAM_CONFIG.format(
+        stream_url=f"ws://localhost:{port}/subscribe",
+        safety_poll=args.safety_poll
+    ))
+    cursor_path = os.path.join(work_dir, 'jetstream_cursor.json')
+
+    def read_cursor():
+        try:
+            with open(cursor_path, 'r') as f:
+                return json.load(f).get('cursor')
+        except (OSError, ValueError):
+            return None
+
+    failures = []
+    deadline = time() + args.timeout
+    with open(os.path.join(work_dir, 'mirror.log'), 'w') as log:
+        # First run: stop the mirror once half the posts are through
+        process = start_mirror(work_dir, log)
+        try:
+            peak_rss = wait_for_tweets(standin, process, args.posts // 2, deadline)
+        finally:
+            stop(process)
+        restarted_after = standin.stats()['tweeted']
+        saved_cursor = read_cursor()
+        connections = len(paths)
+
+        # Second run: resume from the saved cursor, then drop the stream
+        process = start_mirror(work_dir, log)
+        try:
+            peak_rss = wait_for_tweets(standin, process, args.posts, deadline, peak_rss)
+            feed_requests = standin.stats()['counters'].get('feed_requests', 0)
+            shut_down_replay()
+            fallback_deadline = time() + 10
+            while time() < fallback_deadline and standin.stats()['counters'].get('feed_requests', 0) <= feed_requests:
+                sleep(0.2)
+        finally:
+            stop(process)
+
+    stats = standin.stats()
+    counters = stats['counters']
+    elapsed = (stats['last_tweeted_at'] or time()) - stats['first_published_at']
+    polled_after_drop = counters.get('feed_requests', 0) - feed_requests
+    resumed = [parse_qs(urlsplit(path).query).get('cursor', [None])[0] for path in paths[connections:]]
+    last_event = max(event['time_us'] for event in events) if events else None
+
+    if stats['tweeted'] < stats['posts']:
+        failures.append(f"only {stats['tweeted']}/{stats['posts']} posts tweeted")
+    if counters.get('duplicate_tweets'):
+        failures.append(f"{counters['duplicate_tweets']} posts tweeted more than once")
+    if saved_cursor is None:
+        failures.append("no cursor saved before the restart")
+    elif not resumed or resumed[0] is None or int(resumed[0]) != saved_cursor - jetstream.CURSOR_REWIND_US:
+        failures.append(f"restart did not resume from the saved cursor minus the rewind (asked for {resumed[:1]})")
+    if read_cursor() != last_event:
+        failures.append(f"cursor file at {read_cursor()}, last event at {last_event}")
+    if polled_after_drop <= 0:
+        failures.append("no poll after the stream was shut down")
+
+    print(f"Mirrored {stats['tweeted']}/{stats['posts']} streamed posts in {elapsed:.1f}s (restarted after {restarted_after})")
+    print(f"  posts/sec      {stats['tweeted'] / elapsed if elapsed > 0 else 0:.2f}")
+    print(f"  latency p50    {format_seconds(percentile(stats['latencies'], 0.5))}")
+    print(f"  latency p99    {format_seconds(percentile(stats['latencies'], 0.99))}")
+    print(f"  peak RSS       {format_mb(peak_rss)}")
+    print(f"  stream         {len(paths)} connections, resumed at cursor {resumed[0] if resumed else 'n/a'} "
+          f"(saved {saved_cursor})")
+    print(f"  feed requests  {counters.get('feed_requests', 0)} ({polled_after_drop} after the stream was shut down)")
+    print(f"  media          {counters.get('image_downloads', 0)} images and {counters.get('blob_downloads', 0)} videos downloaded")
+    for failure in failures:
+        print(f"  FAILED: {failure}, see {os.path.join(work_dir, 'mirror.log')}")
+    return not failures
+
+def parse_import_times(stderr):
+    """Sum the self import time (seconds) of each top-level package from -X importtime output."""
+    totals = collections.Counter()
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, _, name = line[len('import time:'):].split('|')
+        totals[name.strip().split('.')[0]] += int(self_us) / 1e6
+    return totals
+
+def measure_startup(module, work_dir):
+    """Import a module in a fresh interpreter. Returns the process wall time, import time, peak RSS (MB), loaded modules and import times."""
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [REPO_DIR, os.environ.get('PYTHONPATH')])))
+    started = time()
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', STARTUP_PROBE.format(module=module)],
+                            cwd=work_dir, env=env, capture_output=True, text=True)
+    wall = time() - started
+    if result.returncode != 0:
+        raise Exception(f"Importing {module} failed:\n{result.stderr[-2000:]}")
+    timing, modules = result.stdout.strip().splitlines()[-2:]
+    import_seconds, max_rss_kb = timing.split()
+    return wall, float(import_seconds), int(max_rss_kb) / 1024, set(modules.split()), parse_import_times(result.stderr)
+
+def run_startup(args, work_dir):
+    """Measure the cold start of each entry point and check that heavy modules stay unloaded."""
+    baseline = percentile([measure_startup('sys', work_dir)[0] for _ in range(args.runs)], 0.5)
+    print(f"Interpreter startup {format_seconds(baseline)}")
+
+    failed = False
+    for name, (module, deferred) in STARTUP_ENTRIES.items():
+        runs = [measure_startup(module, work_dir) for _ in range(args.runs)]
+        wall = percentile([run[0] for run in runs], 0.5)
+        _, _, rss, modules, import_times = runs[-1]
+        loaded = [package for package in deferred if package in modules]
+
+        print(f"{name} ({module}.py)")
+        print(f"  startup p50    {format_seconds(wall)}")
+        print(f"  imports p50    {format_seconds(percentile([run[1] for run in runs], 0.5))} ({len(modules)} modules)")
+        print(f"  peak RSS       {format_mb(rss)}")
+        heaviest = ', '.join(f"{package} {format_seconds(seconds)}" for package, seconds in import_times.most_common(5))
+        print(f"  heaviest       {heaviest}")
+        if loaded:
+            failed = True
+            print(f"  loaded at startup but should be deferred: {', '.join(loaded)}")
+        if args.max_startup is not None and wall > args.max_startup:
+            failed = True
+            print(f"  slower than --max-startup {format_seconds(args.max_startup)}")
+    return not failed
+
+def crawl(session, url):
+    started = time()
+    response = session.get(url, headers={'User-Agent': CRAWLER_USER_AGENT, 'Accept-Encoding': 'gzip'})
+    return time() - started, response.status_code
+
+def run_preview(args, work_dir):
+    """Put preview.py under concurrent crawler load and measure latency and how often it hits its cache."""
+    args.delay = 0
+    args.rate = 0
+    standin, base_url = bench_standins.start(args)
+    port = free_port()
+    env = dict(os.environ, PYTHONUNBUFFERED='1', PREVIEW_APPVIEW_URL=base_url, PREVIEW_BSKY_WEB_URL=base_url,
+               PREVIEW_CDN_URL=base_url)
+    command = [sys.executable, os.path.join(REPO_DIR, 'preview.py'), '--host', 'localhost', '--port', str(port)]
+    if args.use_async:
+        command.append('--async')
+
+    # Crawlers mostly ask for the newest posts; weigh posts by 1/rank
+    rng = random.Random(args.seed)
+    weights = [1 / rank for rank in range(1, args.posts + 1)]
+    targets = rng.choices(range(1, args.posts + 1), weights, k=args.requests)
+    urls = [f"http://localhost:{port}/preview/{bench_standins.BENCH_HANDLE}/post/bench{index:06d}" for index in targets]
+
+    with open(os.path.join(work_dir, 'preview.log'), 'w') as log:
+        process = subprocess.Popen(command, cwd=work_dir, env=env, stdout=log, stderr=subprocess.STDOUT)
+        try:
+            wait_for_port(port)
+            session = requests.Session()
+            session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=args.concurrency))
+            started = time()
+            with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+                results = list(pool.map(lambda url: crawl(session, url), urls))
+            elapsed = time() - started
+            peak_rss = peak_rss_mb(process.pid)
+        finally:
+            stop(process)
+
+    latencies = [latency for latency, _ in results]
+    errors = len([status for _, status in results if status != 200])
+    counters = standin.stats()['counters']
+    upstream_fetches = counters.get('get_posts', 0) + counters.get('page_fetches', 0)
+    print(f"Served {len(results)} crawler requests for {args.posts} posts in {elapsed:.1f}s ({errors} errors)")
+    print(f"  requests/sec   {len(results) / elapsed:.1f}")
+    print(f"  latency p50    {format_seconds(percentile(latencies, 0.5))}")
+    print(f"  latency p99    {format_seconds(percentile(latencies, 0.99))}")
+    print(f"  cache hits     {1 - upstream_fetches / len(results):.1%} ({upstream_fetches} upstream fetches)")
+    print(f"  peak RSS       {format_mb(peak_rss)}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the mirror and the preview server against local stand-ins.")
+    parser.add_argument("scenario", choices=["mirror", "preview", "stream", "startup"])
+    bench_standins.add_arguments(parser)
+    parser.add_argument("--timeout", type=float, default=300, help="Seconds before the mirror benchmark gives up")
+    parser.add_argument("--refresh", type=int, default=1, help="Mirror poll interval in seconds")
+    parser.add_argument("--media-workers", type=int, default=4)
+    parser.add_argument("--safety-poll", type=int, default=600, help="Mirror poll interval in seconds while the stream is up")
+    parser.add_argument("--requests", type=int, default=1000, help="Crawler requests sent to the preview server")
+    parser.add_argument("--concurrency", type=int, default=16, help="Concurrent crawlers")
+    parser.add_argument("--async", dest="use_async", action="store_true", help="Serve previews with gevent")
+    parser.add_argument("--runs", type=int, default=5, help="Fresh interpreters started per entry point by the startup benchmark")
+    parser.add_argument("--max-startup", type=float, help="Fail the startup benchmark when an entry point takes longer (seconds)")
+    parser.add_argument("--keep", action="store_true", help="Keep the scratch directory with the logs and state")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix=f"bench-{args.scenario}-")
+    passed = True
+    try:
+        if args.scenario == "mirror":
+            run_mirror(args, work_dir)
+        elif args.scenario == "preview":
+            run_preview(args, work_dir)
+        elif args.scenario == "stream":
+            passed = run_stream(args, work_dir)
+        else:
+            passed = run_startup(args, work_dir)
+    finally:
+        if args.keep:
+            print(f"Scratch directory: {work_dir}")
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    sys.exit(0 if passed else 1)
@@ -1,111 +1,397 @@
-import requests
+import http_client
+import ratelimit
+import metrics
+import base64
+import json
+import logging
 import os
+import threading
+from time import time
 from config import Config
+from preview_cache import get_preview_data, get_quoted_post_view
+from resolver import get_resolver, get_pds_endpoint, get_post_url, split_post_uri
 
-# File to store the Bearer token
-TOKEN_FILE = 'bsky_token.txt'
+logger = logging.getLogger(__name__)
 
-def save_token(token):
-    """Save the Bearer token to a file."""
-    with open(TOKEN_FILE, 'w') as f:
-        f.write(token)
+# Newest feed position per account, fetched but not yet committed
+pending_feed_states = {}
 
-def load_token():
-    """Load the Bearer token from the file."""
-    if os.path.exists(TOKEN_FILE):
-        with open(TOKEN_FILE, 'r') as f:
-            return f.read().strip()
-    return None
+# Sessions per account, loaded on first use
+sessions = {}
+sessions_lock = threading.Lock()
 
-def login_and_get_token():
-    """Login and retrieve the Bearer token."""
-    login_url = 'https://bsky.social/xrpc/com.atproto.server.createSession'
-    
-    login_data = {
-        "identifier": Config.BLUESKY_IDENTIFIER,
-        "password": Config.BLUESKY_PASSWORD,
-        "authFactorToken": ""
-    }
 
-    login_response = requests.post(login_url, json=login_data)
+def get_jwt_expiry(token):
+    """Read the exp claim (epoch seconds) of a JWT without verifying it. Returns None if unreadable."""
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return json.loads(base64.urlsafe_b64decode(payload)).get('exp')
+    except (IndexError, ValueError, AttributeError):
+        return None
+
+class BlueskySession:
+    """
+    Access and refresh token of one account, kept in memory and persisted atomically.
+    The access token is renewed through refreshSession shortly before it expires, both in the
+    background and on access, and a password login only happens when refreshing fails.
+    """
+
+    def __init__(self, account):
+        self.account = account
+        self.lock = threading.RLock()
+        self.access_jwt = None
+        self.refresh_jwt = None
+        self.timer = None
+        self.load()
+
+    def load(self):
+        """Load the tokens from the session file, or the access token from an older token file."""
+        if os.path.exists(self.account.session_file):
+            with open(self.account.session_file, 'r') as f:
+                data = json.load(f)
+            self.access_jwt = data.get('accessJwt')
+            self.refresh_jwt = data.get('refreshJwt')
+        elif os.path.exists(self.account.token_file):
+            with open(self.account.token_file, 'r') as f:
+                self.access_jwt = f.read().strip() or None
+
+    def save(self):
+        """Write the tokens to the session file without ever leaving a partial file behind."""
+        tmp_path = f"{self.account.session_file}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({'accessJwt': self.access_jwt, 'refreshJwt': self.refresh_jwt}, f)
+        os.replace(tmp_path, self.account.session_file)
+
+    def set_tokens(self, session_data):
+        """Take over the tokens of a createSession or refreshSession response."""
+        self.access_jwt = session_data['accessJwt']
+        self.refresh_jwt = session_data.get('refreshJwt', self.refresh_jwt)
+        if not self.account.bluesky_did:
+            self.account.bluesky_did = session_data.get('did')
+        if not self.account.pds_url and session_data.get('didDoc'):
+            self.account.pds_url = get_pds_endpoint(session_data['didDoc'])
+        if session_data.get('did') and session_data.get('handle'):
+            get_resolver().remember(session_data['handle'], session_data['did'])
+        self.save()
+        self.schedule_refresh()
 
-    if login_response.status_code == 200:
-        login_response_json = login_response.json()
-        if 'accessJwt' in login_response_json:
-            token = login_response_json['accessJwt']
-            save_token(token)
-            return token
+    def login(self):
+        """Login with the account password."""
+        logger.info("Logging in with password...", extra={'account': self.account.name})
+        metrics.TOKEN_REFRESHES.inc(account=self.account.name, kind='login')
+        login_data = {
+            "identifier": self.account.bluesky_identifier,
+            "password": self.account.bluesky_password,
+            "authFactorToken": ""
+        }
+
+        login_response = http_client.post(f"{Config.BLUESKY_AUTH_URL}/xrpc/com.atproto.server.createSession", json=login_data,
+                                          rate_limit=ratelimit.for_account(self.account, ratelimit.CREATE_SESSION))
+
+        if login_response.status_code == 200:
+            login_response_json = login_response.json()
+            if 'accessJwt' in login_response_json:
+                self.set_tokens(login_response_json)
+            else:
+                raise Exception("Login succeeded, but no Bearer token found.")
         else:
-            raise Exception("Login succeeded, but no Bearer token found.")
-    else:
-        raise Exception(f"Login failed with status code {login_response.status_code}: {login_response.text}")
+            raise Exception(f"Login failed with status code {login_response.status_code}: {login_response.text}")
+
+    def refresh(self):
+        """Renew the tokens with the refresh token, falling back to a password login."""
+        with self.lock:
+            if self.refresh_jwt and (get_jwt_expiry(self.refresh_jwt) or float('inf')) > time():
+                response = http_client.post(f"{Config.BLUESKY_AUTH_URL}/xrpc/com.atproto.server.refreshSession",
+                                            headers={"Authorization": f"Bearer {self.refresh_jwt}"})
+                if response.status_code == 200:
+                    metrics.TOKEN_REFRESHES.inc(account=self.account.name, kind='refresh')
+                    self.set_tokens(response.json())
+                    return
+                logger.warning(f"Refreshing the session failed with status code {response.status_code}",
+                               extra={'account': self.account.name})
+            self.login()
+
+    def access_token(self):
+        """Return a valid access token, renewing it first if it is about to expire."""
+        with self.lock:
+            if not self.access_jwt:
+                self.login()
+            elif (get_jwt_expiry(self.access_jwt) or float('inf')) - time() < Config.BLUESKY_TOKEN_REFRESH_MARGIN:
+                self.refresh()
+            return self.access_jwt
+
+    def schedule_refresh(self):
+        """Renew the access token in the background shortly before it expires."""
+        if self.timer is not None:
+            self.timer.cancel()
+        expiry = get_jwt_expiry(self.access_jwt)
+        if expiry is None:
+            return
+        delay = max(0, expiry - time() - Config.BLUESKY_TOKEN_REFRESH_MARGIN)
+        self.timer = threading.Timer(delay, self.background_refresh)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def background_refresh(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            logger.error(f"Background session refresh failed: {e}", extra={'account': self.account.name})
+
+def get_session(account):
+    """Return the session of an account, loading it on first use."""
+    with sessions_lock:
+        session = sessions.get(account.name)
+        if session is None:
+            session = BlueskySession(account)
+            sessions[account.name] = session
+            session.schedule_refresh()
+    return session
 
-def get_fullsize_image_url(embed):
-    """Extract the full-size image URL from the embed block if it's an image."""
+def get_pds_url(account):
+    """Return the URL of the account's PDS, resolving it from the DID document if not configured."""
+    if not account.pds_url:
+        did = get_actor_did(account)
+        pds_url = get_resolver().resolve_pds(did)
+        if not pds_url:
+            raise Exception(f"Failed to resolve the PDS of {did}")
+        account.pds_url = pds_url
+    return account.pds_url
+
+def get_blob_cid(url):
+    """Extract the blob CID from a Bluesky CDN URL (.../<did>/<cid>@jpeg)."""
+    return url.split('/')[-1].split('@')[0]
+
+def get_media_embed(embed):
+    """Return the images or video part of an embed, unwrapping quote posts with media."""
+    if embed.get('$type') == 'app.bsky.embed.recordWithMedia#view':
+        return embed.get('media', {})
+    return embed
+
+def get_fullsize_image_urls(embed):
+    """Extract the full-size image URLs from the embed block if it has images."""
+    embed = get_media_embed(embed)
     if embed.get('$type') == 'app.bsky.embed.images#view':
-        images = embed.get('images', [])
-        if images:
-            return images[0].get('fullsize')  # Get the full-size image URL
+        return [image.get('fullsize') for image in embed.get('images', []) if image.get('fullsize')]
+    return []
+
+def get_video_blob_url(embed, author_did, pds_url):
+    """Construct the URL of the original video blob if the embed is a video."""
+    embed = get_media_embed(embed)
+    if embed.get('$type') == 'app.bsky.embed.video#view' and embed.get('cid'):
+        return f"{pds_url}/xrpc/com.atproto.sync.getBlob?did={author_did}&cid={embed['cid']}"
     return None
 
+def get_media(embed, author_did, pds_url):
+    """
+    Extract all media attached to the embed block.
+    Returns a list of dictionaries with the media type, download URL and blob CID.
+    """
+    media = [
+        {'type': 'image', 'url': url, 'cid': get_blob_cid(url)}
+        for url in get_fullsize_image_urls(embed)
+    ]
+
+    video_url = get_video_blob_url(embed, author_did, pds_url)
+    if video_url:
+        media.append({'type': 'video', 'url': video_url, 'cid': get_media_embed(embed).get('cid')})
+
+    return media
+
 def get_quoted_post_url(embed):
     """Construct the URL for the quoted post."""
+    if embed.get('$type') == 'app.bsky.embed.recordWithMedia#view':
+        # The quoted record view sits one level deeper, next to the media
+        embed = embed.get('record', {})
+
     if embed.get('$type') == 'app.bsky.embed.record#view':
-        quoted_post = embed.get('record', {})
-        author_handle = quoted_post.get('author', {}).get('handle')
-        post_uri = quoted_post.get('uri', '')
-        post_id = post_uri.split('/')[-1]  # Extract the post ID from the URI
-        if author_handle and post_id:
-            return f"https://bsky.app/profile/{author_handle}/post/{post_id}"
+        # Named by the DID in the quoted URI, so the link survives the author renaming
+        return get_post_url(embed.get('record', {}).get('uri'))
     return None
 
-def get_bsky_posts():
-    """Fetch posts and filter for the author and post type."""
-    # Load the token if available, otherwise log in
-    token = load_token()
-    if not token:
-        print("no token... loggin in...")
-        token = login_and_get_token()
+def get_post_previews(post, quoted_post_url):
+    """
+    Build the preview server entries of a post and of the post it quotes, keyed by the DID
+    and post ID that appear in the preview URLs of the tweet and its reply.
+    """
+    did, post_id = split_post_uri(post.get('uri'))
+    previews = [{'handle': did, 'post_id': post_id, 'data': get_preview_data(post, did, post_id, Config.BLUESKY_VIDEO_CDN_URL)}]
+
+    quoted_post = get_quoted_post_view(post.get('embed'))
+    if quoted_post and quoted_post_url:
+        parts = quoted_post_url.split('/')
+        previews.append({'handle': parts[4], 'post_id': parts[6], 'data': get_preview_data(quoted_post, parts[4], parts[6], Config.BLUESKY_VIDEO_CDN_URL)})
+    return previews
+
+def save_feed_state(account, state):
+    """Save the newest feed position seen by the incremental poller without ever leaving a partial file behind."""
+    tmp_path = f"{account.feed_state_file}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, account.feed_state_file)
+
+def load_feed_state(account):
+    """
+    Load the newest feed position seen by the incremental poller. An unreadable file counts as
+    no position; the state store keeps already mirrored posts from being tweeted again.
+    """
+    if not os.path.exists(account.feed_state_file):
+        return None
+    try:
+        with open(account.feed_state_file, 'r') as f:
+            state = json.load(f)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Ignoring unreadable feed position in {account.feed_state_file}: {e}", extra={'account': account.name})
+        return None
+    return state if isinstance(state, dict) else None
+
+def feed_item_sort_key(feed_item):
+    """Return the timestamp the author feed is ordered by for this item (repost time for reposts)."""
+    reason = feed_item.get('reason') or {}
+    return reason.get('indexedAt') or feed_item.get('post', {}).get('indexedAt', '')
 
-    posts_url = "https://porcini.us-east.host.bsky.network/xrpc/app.bsky.feed.getAuthorFeed?actor=did:plc:i4rdsz3ihxtbzkowuqzrhilc&limit=30"
+def is_seen_feed_item(feed_item, feed_state):
+    """Check whether a feed item is at or behind the newest position already seen."""
+    if feed_item.get('post', {}).get('cid') == feed_state.get('cid'):
+        return True
+    return feed_item_sort_key(feed_item) <= feed_state.get('indexedAt', '')
+
+def get_actor_did(account):
+    """Return the DID of the account's Bluesky actor, resolving it from the handle if needed."""
+    if not account.bluesky_did:
+        did = get_resolver().resolve_handle(account.bluesky_username)
+        if not did:
+            raise Exception(f"Failed to resolve handle {account.bluesky_username}")
+        account.bluesky_did = did
+    return account.bluesky_did
+
+def resolve_actor_dids(accounts):
+    """Resolve the DIDs of all accounts that don't have one configured in one batch."""
+    handles = [account.bluesky_username for account in accounts if not account.bluesky_did]
+    if not handles:
+        return
+    resolved = get_resolver().resolve_handles(handles)
+    for account in accounts:
+        if not account.bluesky_did:
+            account.bluesky_did = resolved.get(account.bluesky_username)
+
+def fetch_feed_page(account, limit, cursor=None):
+    """
+    Fetch a single page of the author feed.
+    Returns the page data or None on failure.
+    """
+    session = get_session(account)
+    posts_url = f"{get_pds_url(account)}/xrpc/app.bsky.feed.getAuthorFeed"
+    params = {"actor": get_actor_did(account), "limit": limit}
+    if cursor:
+        params["cursor"] = cursor
 
     headers = {
-        "Authorization": f"Bearer {token}",
+        "Authorization": f"Bearer {session.access_token()}",
         "Accept": "*/*",
         "Accept-Encoding": "gzip, deflate, br, zstd",
         "Cache-Control": "no-cache"
     }
 
     # Send the GET request
-    posts_response = requests.get(posts_url, headers=headers)
+    feed_rate_limit = ratelimit.for_account(account, ratelimit.FEED)
+    posts_response = http_client.get(posts_url, params=params, headers=headers, rate_limit=feed_rate_limit)
 
     if posts_response.status_code == 200:
-        posts_data = posts_response.json()
-        return filter_posts(posts_data)
+        return posts_response.json()
 
-        
     elif posts_response.status_code == 400:
         error_data = posts_response.json()
         if error_data.get("error") == "ExpiredToken":
-            print("Token expired. Attempting to refresh and retry...")
+            logger.info("Token expired. Attempting to refresh and retry...")
             # Refresh token and retry once
-            token = login_and_get_token()
-            headers = {"Authorization": f"Bearer {token}"}
-            response = requests.get(posts_url, headers=headers)
+            session.refresh()
+            headers["Authorization"] = f"Bearer {session.access_token()}"
+            response = http_client.get(posts_url, params=params, headers=headers, rate_limit=feed_rate_limit)
 
             if response.status_code == 200:
-                return filter_posts(response.json())
+                return response.json()
             else:
-                print("Failed after retry. Aborting.")
+                logger.error("Failed after retry. Aborting.")
                 return None
         else:
-            print(f"Failed to fetch posts. Status code: {posts_response.status_code}")
+            logger.error(f"Failed to fetch posts. Status code: {posts_response.status_code}")
+            return None
+    else:
+        logger.error(f"Failed to fetch posts. Status code: {posts_response.status_code}", extra={'response': posts_response.text})
+        return None
+
+def get_bsky_posts(account):
+    """
+    Fetch the posts newer than the last poll and filter for the author and post type.
+    Only the newest page is requested on the first run. Afterwards a small probe page is
+    requested and the cursor is followed until a post that was already seen shows up,
+    so bursts larger than one page are not dropped.
+    """
+    feed_state = load_feed_state(account)
+    limit = Config.BLUESKY_PROBE_LIMIT if feed_state else Config.BLUESKY_PAGE_LIMIT
+    cursor = None
+    new_items = []
+
+    for _ in range(Config.BLUESKY_MAX_PAGES):
+        with metrics.STAGE_SECONDS.time(stage='feed_fetch'):
+            page = fetch_feed_page(account, limit, cursor)
+        if page is None:
             return None
+
+        reached_seen = False
+        for feed_item in page.get('feed', []):
+            if feed_state and is_seen_feed_item(feed_item, feed_state):
+                reached_seen = True
+                break
+            new_items.append(feed_item)
+
+        cursor = page.get('cursor')
+        if reached_seen or not cursor or not feed_state:
+            break
+        limit = Config.BLUESKY_PAGE_LIMIT
     else:
-        print(f"Failed to fetch posts. Status code: {posts_response.status_code}")
-        print(posts_response.text)
+        logger.warning(f"Stopped paging after {Config.BLUESKY_MAX_PAGES} pages without reaching a seen post.")
+
+    # Remember the newest position; it is saved by commit_feed_position once the posts are queued
+    if new_items:
+        newest = max(new_items, key=feed_item_sort_key)
+        pending_feed_states[account.name] = {
+            'indexedAt': feed_item_sort_key(newest),
+            'cid': newest.get('post', {}).get('cid'),
+            'uri': newest.get('post', {}).get('uri')
+        }
 
-def filter_posts(posts_data):
+    with metrics.STAGE_SECONDS.time(stage='filter'):
+        return filter_posts({'feed': new_items}, account)
+
+def iter_feed_pages(account, cursor=None, limit=100):
+    """
+    Page through the complete author feed, newest to oldest, starting at cursor.
+    Yields the filtered posts of each page together with the cursor of the next page (None after
+    the last page), so the feed is never held in memory as a whole.
+    """
+    while True:
+        with metrics.STAGE_SECONDS.time(stage='feed_fetch'):
+            page = fetch_feed_page(account, limit, cursor)
+        if page is None:
+            raise Exception(f"Failed to fetch the author feed page at cursor {cursor}")
+
+        cursor = page.get('cursor') if page.get('feed') else None
+        with metrics.STAGE_SECONDS.time(stage='filter'):
+            posts = filter_posts(page, account)
+        yield posts, cursor
+        if cursor is None:
+            return
+
+def commit_feed_position(account):
+    """Save the newest position returned by get_bsky_posts so the next poll only looks at newer posts."""
+    feed_state = pending_feed_states.pop(account.name, None)
+    if feed_state:
+        save_feed_state(account, feed_state)
+
+def filter_posts(posts_data, account):
     """
     Filters posts from Bluesky, extracting relevant information such as URI, text, media, or quoted post.
     Returns a list of dictionaries containing the post type and necessary details.
@@ -120,9 +406,10 @@ def filter_posts(posts_data):
         record_embed = record.get('embed', {})
         outer_embed = post.get('embed', {})
 
-        # Check if the author matches, if the record type is correct, and if the post is not a reply
+        # Check if the author matches, if the record type is correct, and if the post is not a reply.
+        # The author is matched by DID so posts are still found after the account renames.
         if (
-            author.get('handle') == Config.BLUESKY_USERNAME and
+            author.get('did') == get_actor_did(account) and
             record.get('$type') == 'app.bsky.feed.post' and
             'reply' not in record  # Exclude posts that are replies
         ):
@@ -134,29 +421,94 @@ def filter_posts(posts_data):
                 'uri': uri,
                 'text': text,
                 'type': 'text',  # Default to text-only
-                'media_url': None,
+                'media': [],
                 'quoted_post_url': None,
-                'author_handle': author_handle  # Add author handle
+                'author_handle': author_handle,  # Add author handle
+                'indexed_at': post.get('indexedAt')
             }
 
             # Case 1: Text-only post
             if not record_embed and not outer_embed:
                 post_data['type'] = 'text'
 
-            # Case 2: Post with media (extracting the fullsize image URL)
-            elif outer_embed.get('$type') == 'app.bsky.embed.images#view':
-                media_url = get_fullsize_image_url(outer_embed)
+            # Case 2: Post with media (all fullsize images or the video blob)
+            elif outer_embed.get('$type') in ('app.bsky.embed.images#view', 'app.bsky.embed.video#view'):
                 post_data['type'] = 'media'
-                post_data['media_url'] = media_url
+                post_data['media'] = get_media(outer_embed, author.get('did'), get_pds_url(account))
 
-            # Case 3: Quote retweet (quoted post)
-            elif outer_embed.get('$type') == 'app.bsky.embed.record#view':
+            # Case 3: Quote retweet (quoted post), possibly with its own media
+            elif outer_embed.get('$type') in ('app.bsky.embed.record#view', 'app.bsky.embed.recordWithMedia#view'):
                 quoted_post_url = get_quoted_post_url(outer_embed)
                 post_data['type'] = 'quote'
                 post_data['quoted_post_url'] = quoted_post_url
+                post_data['media'] = get_media(outer_embed, author.get('did'), get_pds_url(account))
+
+            # Preview data for the links in the tweet, pushed to the preview server before tweeting
+            post_data['previews'] = get_post_previews(post, post_data['quoted_post_url'])
 
             # Append the post data to the list
             filtered_posts.append(post_data)
 
     return filtered_posts
 
+
+def get_blob_link(blob):
+    """Return the CID a blob reference in a record points to."""
+    return (blob or {}).get('ref', {}).get('$link')
+
+def record_embed_to_view(embed, did):
+    """
+    Convert the embed of a raw post record (as seen on the event stream) into the view shape
+    getAuthorFeed returns, so filter_posts can handle both.
+    """
+    embed_type = embed.get('$type')
+
+    if embed_type == 'app.bsky.embed.images':
+        return {
+            '$type': 'app.bsky.embed.images#view',
+            'images': [
+                {'fullsize': f"{Config.BLUESKY_CDN_URL}/img/feed_fullsize/plain/{did}/{get_blob_link(image.get('image'))}@jpeg"}
+                for image in embed.get('images', []) if get_blob_link(image.get('image'))
+            ]
+        }
+
+    if embed_type == 'app.bsky.embed.video':
+        return {'$type': 'app.bsky.embed.video#view', 'cid': get_blob_link(embed.get('video'))}
+
+    if embed_type == 'app.bsky.embed.record':
+        # Only the quoted URI is known; the links are built from the DID in it
+        quoted_uri = embed.get('record', {}).get('uri', '')
+        quoted_did = quoted_uri.split('/')[2] if quoted_uri.startswith('at://') else None
+        return {
+            '$type': 'app.bsky.embed.record#view',
+            'record': {'uri': quoted_uri, 'author': {'handle': quoted_did}}
+        }
+
+    if embed_type == 'app.bsky.embed.recordWithMedia':
+        return {
+            '$type': 'app.bsky.embed.recordWithMedia#view',
+            'record': record_embed_to_view(embed.get('record', {}), did),
+            'media': record_embed_to_view(embed.get('media', {}), did)
+        }
+
+    if embed_type == 'app.bsky.embed.external':
+        return {'$type': 'app.bsky.embed.external#view'}
+
+    return {}
+
+def filter_post_record(account, did, rkey, cid, record):
+    """
+    Turn a post record created by the account (e.g. from the event stream) into the same
+    dictionaries filter_posts produces. Returns an empty list for replies and other records.
+    """
+    feed_item = {
+        'post': {
+            'uri': f"at://{did}/app.bsky.feed.post/{rkey}",
+            'cid': cid,
+            'author': {'did': did, 'handle': account.bluesky_username},
+            'record': record,
+            'embed': record_embed_to_view(record.get('embed', {}), did),
+            'indexedAt': record.get('createdAt')
+        }
+    }
+    return filter_posts({'feed': [feed_item]}, account)
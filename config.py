@@ -1,16 +1,64 @@
 import toml
 import os
+import logging
+import logs
+
+logger = logging.getLogger(__name__)
 
 class Config:
     # Class-level attributes to store configuration
-    TWITTER_API_KEY = None
-    TWITTER_API_SECRET_KEY = None
-    TWITTER_ACCESS_TOKEN = None
-    TWITTER_ACCESS_TOKEN_SECRET = None
-    BLUESKY_USERNAME = None
-    BLUESKY_PASSWORD = None
-    BLUESKY_IDENTIFIER = None
     BLUESKY_REFRESH = None
+    BLUESKY_MIN_REFRESH = None
+    BLUESKY_MAX_REFRESH = None
+    BLUESKY_REFRESH_BACKOFF = 2.0
+    BLUESKY_REFRESH_JITTER = 0.1
+    BLUESKY_PAGE_LIMIT = 30
+    BLUESKY_TOKEN_REFRESH_MARGIN = 300
+    BLUESKY_PROBE_LIMIT = 5
+    BLUESKY_MAX_PAGES = 10
+    STATE_DB_FILE = 'mirror_state.db'
+    OUTBOX_MAX_ATTEMPTS = 5
+    MEDIA_WORKERS = 4
+    MEDIA_CACHE_DIR = './media_cache'
+    MEDIA_CACHE_SIZE_LIMIT = 2 ** 30
+    MEDIA_BLOB_TTL = 7 * 24 * 3600
+    REPLY_WORKERS = 2
+    ACCOUNT_WORKERS = 4
+    ACCOUNTS = []
+    INGEST_MODE = 'poll'
+    JETSTREAM_URL = 'wss://jetstream2.us-east.bsky.network/subscribe'
+    JETSTREAM_CURSOR_FILE = 'jetstream_cursor.json'
+    JETSTREAM_CURSOR_INTERVAL = 5
+    JETSTREAM_SAFETY_POLL = 1800
+    JETSTREAM_RECORD_FILE = None
+    RATE_LIMIT_BURST = 5
+    RATE_LIMIT_MAX_RETRIES = 3
+    HTTP_POOL_CONNECTIONS = 4
+    HTTP_POOL_MAXSIZE = 10
+    HTTP_CONNECT_TIMEOUT = 5
+    HTTP_READ_TIMEOUT = 30
+    HTTP_RETRIES = 3
+    HTTP_BACKOFF_FACTOR = 0.5
+    PREVIEW_WARM_URL = None
+    PREVIEW_WARM_TOKEN = None
+    PREVIEW_URL = 'https://bluesky.owo.nexus'
+    BLUESKY_AUTH_URL = 'https://bsky.social'
+    BLUESKY_APPVIEW_URL = 'https://public.api.bsky.app'
+    BLUESKY_CDN_URL = 'https://cdn.bsky.app'
+    BLUESKY_VIDEO_CDN_URL = 'https://video.bsky.app'
+    PLC_DIRECTORY_URL = 'https://plc.directory'
+    TWITTER_API_URL = 'https://api.x.com'
+    TWITTER_UPLOAD_URL = 'https://upload.twitter.com'
+    RESOLVER_CACHE_DIR = './resolver_cache'
+    RESOLVER_TTL = 24 * 3600
+    RESOLVER_NEGATIVE_TTL = 300
+    BACKFILL_PAGE_LIMIT = 100
+    BACKFILL_BATCH_SIZE = 10
+    BACKFILL_POSTS_PER_HOUR = 30
+    LOG_FORMAT = 'text'
+    LOG_LEVEL = 'INFO'
+    METRICS_HOST = '127.0.0.1'
+    METRICS_PORT = None
 
     @classmethod
     def init(cls, config_path="config.toml"):
@@ -26,16 +74,126 @@ class Config:
             config_data = toml.load(f)
 
         # Assign the values from the file to class-level attributes
-        cls.TWITTER_API_KEY = config_data['twitter']['api_key']
-        cls.TWITTER_API_SECRET_KEY = config_data['twitter']['api_secret_key']
-        cls.TWITTER_ACCESS_TOKEN = config_data['twitter']['access_token']
-        cls.TWITTER_ACCESS_TOKEN_SECRET = config_data['twitter']['access_token_secret']
+        twitter_config = config_data.get('twitter', {})
+        bluesky_config = config_data.get('bluesky', {})
+
+        cls.BLUESKY_REFRESH = bluesky_config.get('refresh', 300)
+        cls.BLUESKY_MIN_REFRESH = bluesky_config.get('min_refresh', cls.BLUESKY_REFRESH)
+        cls.BLUESKY_MAX_REFRESH = bluesky_config.get('max_refresh', cls.BLUESKY_REFRESH)
+        cls.BLUESKY_REFRESH_BACKOFF = bluesky_config.get('refresh_backoff', cls.BLUESKY_REFRESH_BACKOFF)
+        cls.BLUESKY_REFRESH_JITTER = bluesky_config.get('refresh_jitter', cls.BLUESKY_REFRESH_JITTER)
+        cls.BLUESKY_PAGE_LIMIT = bluesky_config.get('page_limit', cls.BLUESKY_PAGE_LIMIT)
+        cls.BLUESKY_TOKEN_REFRESH_MARGIN = bluesky_config.get('token_refresh_margin', cls.BLUESKY_TOKEN_REFRESH_MARGIN)
+        cls.BLUESKY_PROBE_LIMIT = bluesky_config.get('probe_limit', cls.BLUESKY_PROBE_LIMIT)
+        cls.BLUESKY_MAX_PAGES = bluesky_config.get('max_pages', cls.BLUESKY_MAX_PAGES)
+
+        mirror_config = config_data.get('mirror', {})
+        cls.STATE_DB_FILE = mirror_config.get('state_db', cls.STATE_DB_FILE)
+        cls.OUTBOX_MAX_ATTEMPTS = mirror_config.get('max_attempts', cls.OUTBOX_MAX_ATTEMPTS)
+        cls.MEDIA_WORKERS = mirror_config.get('media_workers', cls.MEDIA_WORKERS)
+        cls.REPLY_WORKERS = mirror_config.get('reply_workers', cls.REPLY_WORKERS)
+        cls.ACCOUNT_WORKERS = mirror_config.get('account_workers', cls.ACCOUNT_WORKERS)
+        cls.MEDIA_CACHE_DIR = mirror_config.get('media_cache_dir', cls.MEDIA_CACHE_DIR)
+        cls.MEDIA_CACHE_SIZE_LIMIT = mirror_config.get('media_cache_size_limit', cls.MEDIA_CACHE_SIZE_LIMIT)
+        cls.MEDIA_BLOB_TTL = mirror_config.get('media_blob_ttl', cls.MEDIA_BLOB_TTL)
+
+        stream_config = config_data.get('stream', {})
+        cls.INGEST_MODE = stream_config.get('mode', cls.INGEST_MODE)
+        cls.JETSTREAM_URL = stream_config.get('url', cls.JETSTREAM_URL)
+        cls.JETSTREAM_CURSOR_FILE = stream_config.get('cursor_file', cls.JETSTREAM_CURSOR_FILE)
+        cls.JETSTREAM_CURSOR_INTERVAL = stream_config.get('cursor_interval', cls.JETSTREAM_CURSOR_INTERVAL)
+        cls.JETSTREAM_SAFETY_POLL = stream_config.get('safety_poll', cls.JETSTREAM_SAFETY_POLL)
+        cls.JETSTREAM_RECORD_FILE = stream_config.get('record_file', cls.JETSTREAM_RECORD_FILE)
+
+        rate_limit_config = config_data.get('rate_limit', {})
+        cls.RATE_LIMIT_BURST = rate_limit_config.get('burst', cls.RATE_LIMIT_BURST)
+        cls.RATE_LIMIT_MAX_RETRIES = rate_limit_config.get('max_retries', cls.RATE_LIMIT_MAX_RETRIES)
+
+        http_config = config_data.get('http', {})
+        cls.HTTP_POOL_CONNECTIONS = http_config.get('pool_connections', cls.HTTP_POOL_CONNECTIONS)
+        cls.HTTP_POOL_MAXSIZE = http_config.get('pool_maxsize', cls.HTTP_POOL_MAXSIZE)
+        cls.HTTP_CONNECT_TIMEOUT = http_config.get('connect_timeout', cls.HTTP_CONNECT_TIMEOUT)
+        cls.HTTP_READ_TIMEOUT = http_config.get('read_timeout', cls.HTTP_READ_TIMEOUT)
+        cls.HTTP_RETRIES = http_config.get('retries', cls.HTTP_RETRIES)
+        cls.HTTP_BACKOFF_FACTOR = http_config.get('backoff_factor', cls.HTTP_BACKOFF_FACTOR)
+
+        preview_config = config_data.get('preview', {})
+        cls.PREVIEW_WARM_URL = preview_config.get('warm_url', cls.PREVIEW_WARM_URL)
+        cls.PREVIEW_WARM_TOKEN = preview_config.get('warm_token', cls.PREVIEW_WARM_TOKEN)
+        cls.PREVIEW_URL = preview_config.get('url', cls.PREVIEW_URL).rstrip('/')
+
+        # Base URLs of the upstream services, e.g. to point the mirror at local stand-ins
+        endpoints_config = config_data.get('endpoints', {})
+        cls.BLUESKY_AUTH_URL = endpoints_config.get('bluesky_auth', cls.BLUESKY_AUTH_URL).rstrip('/')
+        cls.BLUESKY_APPVIEW_URL = endpoints_config.get('bluesky_appview', cls.BLUESKY_APPVIEW_URL).rstrip('/')
+        cls.BLUESKY_CDN_URL = endpoints_config.get('bluesky_cdn', cls.BLUESKY_CDN_URL).rstrip('/')
+        cls.BLUESKY_VIDEO_CDN_URL = endpoints_config.get('bluesky_video_cdn', cls.BLUESKY_VIDEO_CDN_URL).rstrip('/')
+        cls.PLC_DIRECTORY_URL = endpoints_config.get('plc_directory', cls.PLC_DIRECTORY_URL).rstrip('/')
+        cls.TWITTER_API_URL = endpoints_config.get('twitter_api', cls.TWITTER_API_URL).rstrip('/')
+        cls.TWITTER_UPLOAD_URL = endpoints_config.get('twitter_upload', cls.TWITTER_UPLOAD_URL).rstrip('/')
+
+        resolver_config = config_data.get('resolver', {})
+        cls.RESOLVER_CACHE_DIR = resolver_config.get('cache_dir', cls.RESOLVER_CACHE_DIR)
+        cls.RESOLVER_TTL = resolver_config.get('ttl', cls.RESOLVER_TTL)
+        cls.RESOLVER_NEGATIVE_TTL = resolver_config.get('negative_ttl', cls.RESOLVER_NEGATIVE_TTL)
+
+        backfill_config = config_data.get('backfill', {})
+        cls.BACKFILL_PAGE_LIMIT = backfill_config.get('page_limit', cls.BACKFILL_PAGE_LIMIT)
+        cls.BACKFILL_BATCH_SIZE = backfill_config.get('batch_size', cls.BACKFILL_BATCH_SIZE)
+        cls.BACKFILL_POSTS_PER_HOUR = backfill_config.get('posts_per_hour', cls.BACKFILL_POSTS_PER_HOUR)
+
+        logging_config = config_data.get('logging', {})
+        cls.LOG_FORMAT = logging_config.get('format', cls.LOG_FORMAT)
+        cls.LOG_LEVEL = logging_config.get('level', cls.LOG_LEVEL)
+        logs.setup(cls.LOG_FORMAT, cls.LOG_LEVEL)
+
+        metrics_config = config_data.get('metrics', {})
+        cls.METRICS_HOST = metrics_config.get('host', cls.METRICS_HOST)
+        cls.METRICS_PORT = metrics_config.get('port', cls.METRICS_PORT)
+
+        # Mirror pairs: either a list of [[accounts]] or the single [twitter]/[bluesky] pair
+        if 'accounts' in config_data:
+            cls.ACCOUNTS = [Account(entry['name'], entry['twitter'], entry['bluesky']) for entry in config_data['accounts']]
+        else:
+            cls.ACCOUNTS = [Account('default', twitter_config, bluesky_config, legacy=True)]
+
+        names = [account.name for account in cls.ACCOUNTS]
+        if len(set(names)) != len(names):
+            raise ValueError("Account names in the config file must be unique.")
+
+        logger.info("Configuration initialized successfully.")
+
+
+class Account:
+    """
+    Credentials and settings of one Bluesky to Twitter mirror pair.
+    Settings that are not given for the pair fall back to the global [bluesky] values.
+    """
+
+    def __init__(self, name, twitter_config, bluesky_config, legacy=False):
+        self.name = name
+        self.legacy = legacy
+
+        self.twitter_api_key = twitter_config['api_key']
+        self.twitter_api_secret_key = twitter_config['api_secret_key']
+        self.twitter_access_token = twitter_config['access_token']
+        self.twitter_access_token_secret = twitter_config['access_token_secret']
+
+        self.bluesky_username = bluesky_config['username']
+        self.bluesky_password = bluesky_config['password']
+        self.bluesky_identifier = bluesky_config['identifier']
+        self.bluesky_did = bluesky_config.get('did')
+        self.pds_url = bluesky_config.get('pds_url')
 
-        cls.BLUESKY_USERNAME = config_data['bluesky']['username']
-        cls.BLUESKY_PASSWORD = config_data['bluesky']['password']
-        cls.BLUESKY_IDENTIFIER = config_data['bluesky']['identifier']
-        cls.BLUESKY_REFRESH = config_data['bluesky']['refresh']
+        self.min_refresh = bluesky_config.get('min_refresh', bluesky_config.get('refresh', Config.BLUESKY_MIN_REFRESH))
+        self.max_refresh = bluesky_config.get('max_refresh', bluesky_config.get('refresh', Config.BLUESKY_MAX_REFRESH))
 
-        print("Configuration initialized successfully.")
+        # The single-pair setup keeps the original file names
+        suffix = '' if legacy else f'_{name}'
+        self.session_file = f'bsky_session{suffix}.json'
+        # Plain access token file of older versions, read once when there is no session file yet
+        self.token_file = f'bsky_token{suffix}.txt'
+        self.feed_state_file = f'bsky_feed_state{suffix}.json'
+        self.state_db = Config.STATE_DB_FILE if legacy else f'mirror_state{suffix}.db'
 
 
@@ -0,0 +1,78 @@
+import logging
+import threading
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from config import Config
+import ratelimit
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# One pooled keep-alive session per upstream host
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+def create_session():
+    """Create a session with a pooled adapter that retries idempotent requests on connection errors."""
+    retry = Retry(
+        total=Config.HTTP_RETRIES,
+        backoff_factor=Config.HTTP_BACKOFF_FACTOR,
+        status_forcelist=(500, 502, 503, 504),
+        allowed_methods=frozenset(["GET", "HEAD", "OPTIONS"]),
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(
+        pool_connections=Config.HTTP_POOL_CONNECTIONS,
+        pool_maxsize=Config.HTTP_POOL_MAXSIZE,
+        max_retries=retry
+    )
+
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+def get_session(url):
+    """Return the shared session for the host of the given URL, creating it on first use."""
+    host = urlsplit(url).netloc
+    session = _sessions.get(host)
+    if session is None:
+        with _sessions_lock:
+            session = _sessions.get(host)
+            if session is None:
+                session = create_session()
+                _sessions[host] = session
+    return session
+
+def request(method, url, rate_limit=None, **kwargs):
+    """
+    Send a request through the pooled session for the URL's host with the configured timeout.
+    With a rate_limit endpoint name the request waits for that endpoint's budget, and a 429 is
+    queued until the window resets and sent again instead of being returned.
+    """
+    kwargs.setdefault('timeout', (Config.HTTP_CONNECT_TIMEOUT, Config.HTTP_READ_TIMEOUT))
+    session = get_session(url)
+    if rate_limit is None:
+        return session.request(method, url, **kwargs)
+
+    limiter = ratelimit.get_limiter(rate_limit)
+    for attempt in range(Config.RATE_LIMIT_MAX_RETRIES + 1):
+        waited = limiter.acquire()
+        if waited:
+            metrics.RATE_LIMIT_WAIT_SECONDS.inc(waited, endpoint=rate_limit)
+        response = session.request(method, url, **kwargs)
+        limiter.update(response)
+        if response.status_code == 429:
+            metrics.RATE_LIMITED_RESPONSES.inc(endpoint=rate_limit)
+        if response.status_code != 429 or attempt == Config.RATE_LIMIT_MAX_RETRIES:
+            return response
+        logger.warning(f"Rate limited on {rate_limit}, retrying after the window resets", extra={'endpoint': rate_limit})
+        response.close()
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
@@ -0,0 +1,137 @@
+import json
+import logging
+import os
+import threading
+from time import sleep, time
+from urllib.parse import urlencode
+from config import Config
+import logs
+
+logger = logging.getLogger(__name__)
+
+try:
+    import websocket  # websocket-client, only needed for the streaming ingest mode
+except ImportError:
+    websocket = None
+
+POST_COLLECTION = 'app.bsky.feed.post'
+# Events are re-read from slightly before the saved cursor after a reconnect; duplicates are
+# dropped by the state store
+CURSOR_REWIND_US = 5 * 1000 * 1000
+# Seconds between reconnect attempts, doubled up to the maximum while the stream keeps failing
+RECONNECT_DELAY = 1
+MAX_RECONNECT_DELAY = 300
+
+def save_cursor(cursor):
+    """Save the time_us of the last handled event."""
+    tmp_path = f"{Config.JETSTREAM_CURSOR_FILE}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump({'cursor': cursor}, f)
+    os.replace(tmp_path, Config.JETSTREAM_CURSOR_FILE)
+
+def load_cursor():
+    """Load the time_us of the last handled event."""
+    if os.path.exists(Config.JETSTREAM_CURSOR_FILE):
+        with open(Config.JETSTREAM_CURSOR_FILE, 'r') as f:
+            return json.load(f).get('cursor')
+    return None
+
+class JetstreamSubscriber:
+    """
+    Push ingest from a Jetstream-style JSON event stream, filtered to the mirrored DIDs.
+    Every app.bsky.feed.post create event is handed to on_post(did, commit). The cursor is
+    persisted after the handler returns so a restart resumes where it stopped, and
+    on_disconnect is called whenever the stream drops so the caller can fall back to polling.
+    """
+
+    def __init__(self, dids, on_post, on_disconnect):
+        self.dids = sorted(set(dids))
+        self.on_post = on_post
+        self.on_disconnect = on_disconnect
+        self.cursor = load_cursor()
+        self.cursor_saved_at = 0
+        self.connected = False
+        self.stopped = False
+        self.ws = None
+
+    def get_url(self):
+        params = [('wantedCollections', POST_COLLECTION)] + [('wantedDids', did) for did in self.dids]
+        if self.cursor:
+            params.append(('cursor', max(0, self.cursor - CURSOR_REWIND_US)))
+        return f"{Config.JETSTREAM_URL}?{urlencode(params)}"
+
+    def start(self):
+        """Run the subscription in a background thread. Returns False if websocket-client is missing."""
+        if websocket is None:
+            logger.warning("websocket-client is not installed, staying with polling.")
+            return False
+        threading.Thread(target=self.run, name="jetstream", daemon=True).start()
+        return True
+
+    def stop(self):
+        self.stopped = True
+        if self.ws is not None:
+            self.ws.close()
+
+    def run(self):
+        """Keep the subscription open, reconnecting with exponential backoff."""
+        delay = RECONNECT_DELAY
+        while not self.stopped:
+            url = self.get_url()
+            logger.info(f"Connecting to event stream {url}")
+            self.ws = websocket.WebSocketApp(
+                url,
+                on_open=self.handle_open,
+                on_message=self.handle_message,
+                on_error=lambda ws, error: logger.error(f"Event stream error: {error}")
+            )
+            opened_at = time()
+            self.ws.run_forever(ping_interval=30, ping_timeout=10)
+
+            was_connected = self.connected
+            self.connected = False
+            if self.cursor:
+                save_cursor(self.cursor)
+            if was_connected:
+                self.on_disconnect()
+            if self.stopped:
+                break
+
+            # A connection that stayed up for a while starts the backoff over
+            delay = RECONNECT_DELAY if time() - opened_at > MAX_RECONNECT_DELAY else min(delay * 2, MAX_RECONNECT_DELAY)
+            logger.warning(f"Event stream closed, reconnecting in {delay}s")
+            sleep(delay)
+
+    def handle_open(self, ws):
+        logger.info("Event stream connected.")
+        self.connected = True
+
+    def handle_message(self, ws, message):
+        event = json.loads(message)
+
+        if Config.JETSTREAM_RECORD_FILE:
+            with open(Config.JETSTREAM_RECORD_FILE, 'a') as f:
+                f.write(message if isinstance(message, str) else message.decode())
+                f.write('\n')
+
+        commit = event.get('commit') or {}
+        if (
+            event.get('kind') == 'commit' and
+            commit.get('operation') == 'create' and
+            commit.get('collection') == POST_COLLECTION and
+            event.get('did') in self.dids
+        ):
+            try:
+                self.on_post(event['did'], commit)
+            except Exception as e:
+                # Leave the cursor behind this event so it is read again after a reconnect
+                with logs.context(post=commit.get('rkey')):
+                    logger.error(f"Failed to handle event {commit.get('rkey')}: {e}")
+                ws.close()
+                return
+
+        if event.get('time_us'):
+            self.cursor = event['time_us']
+            if time() - self.cursor_saved_at >= Config.JETSTREAM_CURSOR_INTERVAL:
+                save_cursor(self.cursor)
+                self.cursor_saved_at = time()
@@ -0,0 +1,67 @@
+"""
+Local stand-in for a Jetstream endpoint that replays recorded events.
+
+Record events by setting `record_file` under [stream] in config.toml, then serve them with
+    python jetstream_replay.py events.jsonl --port 6008
+and point `url` under [stream] at ws://localhost:6008/subscribe.
+
+Like Jetstream, the server honours the wantedDids, wantedCollections and cursor (time_us)
+query parameters. With --realtime each event is held back until its time_us comes up, like a
+live stream; benchmark.py's stream scenario replays the synthetic feed this way.
+"""
+import argparse
+import asyncio
+import json
+from time import time
+from urllib.parse import urlsplit, parse_qs
+
+import websockets
+
+def load_events(path):
+    with open(path, 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def matches(event, query):
+    """Check an event against the Jetstream filter query parameters."""
+    wanted_dids = query.get('wantedDids')
+    if wanted_dids and event.get('did') not in wanted_dids:
+        return False
+
+    wanted_collections = query.get('wantedCollections')
+    collection = (event.get('commit') or {}).get('collection')
+    if wanted_collections and collection is not None and collection not in wanted_collections:
+        return False
+
+    cursor = query.get('cursor')
+    if cursor and event.get('time_us', 0) <= int(cursor[0]):
+        return False
+    return True
+
+async def replay(websocket, events, delay, hold, realtime=False):
+    query = parse_qs(urlsplit(websocket.request.path).query)
+    for event in events:
+        if matches(event, query):
+            if realtime:
+                await asyncio.sleep(max(0, event.get('time_us', 0) / 1e6 - time()))
+            await websocket.send(json.dumps(event))
+            await asyncio.sleep(delay)
+
+    # Keep the connection open like a live stream until the client goes away
+    if hold:
+        await websocket.wait_closed()
+
+async def serve(events, host, port, delay, hold, realtime=False):
+    async with websockets.serve(lambda websocket: replay(websocket, events, delay, hold, realtime), host, port):
+        print(f"Replaying {len(events)} events on ws://{host}:{port}/subscribe")
+        await asyncio.Future()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay recorded Jetstream events over a local WebSocket.")
+    parser.add_argument("events", help="JSON lines file with one recorded event per line")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=6008)
+    parser.add_argument("--delay", type=float, default=0.0, help="Seconds between events")
+    parser.add_argument("--close", action="store_true", help="Close the connection after the last event")
+    parser.add_argument("--realtime", action="store_true", help="Send each event when its time_us comes up")
+    args = parser.parse_args()
+    asyncio.run(serve(load_events(args.events), args.host, args.port, args.delay, not args.close, args.realtime))
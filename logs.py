@@ -0,0 +1,67 @@
+import contextvars
+import json
+import logging
+import sys
+from contextlib import contextmanager
+
+# Fields attached to every log line written while they are set, e.g. the account and the post
+# being mirrored. The post field doubles as the correlation id: it is the post's record key,
+# which is also the post ID the preview server sees in its URLs.
+_context = contextvars.ContextVar('log_context', default={})
+
+# Attributes every LogRecord has; anything else was passed through extra=
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+@contextmanager
+def context(**fields):
+    """Attach fields to every log line written inside the block, including nested blocks."""
+    token = _context.set({**_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+def carry_context(fn):
+    """Wrap a function so it runs with the current log context, e.g. when handed to a thread pool."""
+    ctx = contextvars.copy_context()
+    return lambda *args, **kwargs: ctx.run(fn, *args, **kwargs)
+
+def get_fields(record):
+    fields = dict(_context.get())
+    fields.update({key: value for key, value in vars(record).items() if key not in _RECORD_ATTRIBUTES})
+    return fields
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line with the time, level, logger, message and all fields."""
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        entry.update(get_fields(record))
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+class TextFormatter(logging.Formatter):
+    """Readable lines with the fields appended as key=value pairs."""
+
+    def format(self, record):
+        line = f"{self.formatTime(record)} {record.levelname} {record.name}: {record.getMessage()}"
+        fields = get_fields(record)
+        if fields:
+            line += ' ' + ' '.join(f"{key}={value}" for key, value in fields.items())
+        if record.exc_info:
+            line += '\n' + self.formatException(record.exc_info)
+        return line
+
+def setup(log_format='text', level='INFO'):
+    """Send all log lines to stdout in the given format ('text' or 'json')."""
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(JsonFormatter() if log_format == 'json' else TextFormatter())
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(level.upper() if isinstance(level, str) else level)
@@ -1,92 +1,409 @@
 import json
+import logging
 import os
-from time import sleep
-from bluesky import get_bsky_posts
-from twitter import post_tweet_with_media_and_quote, upload_media, comment_with_original_post
+from time import sleep, time
+from datetime import datetime
+import argparse
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from bluesky import get_bsky_posts, commit_feed_position, get_actor_did, resolve_actor_dids, filter_post_record, iter_feed_pages
+from twitter import post_tweet_with_media_and_quote, upload_media, comment_with_original_post, warm_preview_cache, MAX_MEDIA_PER_TWEET
 from config import Config
-from requests_oauthlib import OAuth1
+from scheduler import PollScheduler
+from state import StateStore, OUTBOX_PENDING, OUTBOX_MEDIA_UPLOADED, OUTBOX_TWEETING, OUTBOX_TWEETED, OUTBOX_FAILED
+from requests.exceptions import RequestException
+import logs
+import metrics
 
+logger = logging.getLogger(__name__)
 
-# File to store the last processed posts
+
+# Legacy file with the last processed posts, imported into the state store on first start
 LAST_POSTS_FILE = 'last_posts.json'
+# Twitter media ids expire after a day; older uploads are redone before tweeting
+MEDIA_IDS_MAX_AGE = 23 * 3600
 
 def load_last_posts():
-    """Load the last processed posts from the file."""
+    """Load the last processed posts from the legacy file."""
     if os.path.exists(LAST_POSTS_FILE):
         with open(LAST_POSTS_FILE, 'r') as f:
             return json.load(f)
     return []
 
-def save_last_posts(posts):
-    """Save the latest posts to the file."""
-    with open(LAST_POSTS_FILE, 'w') as f:
-        json.dump(posts, f)
-
-def get_new_posts(current_posts, last_posts):
-    """Compare current posts with the last processed posts to find new posts."""
-    # Assuming each post has a unique 'uri', filter out the posts that were already processed
-    last_post_uris = {post['uri'] for post in last_posts}
-    new_posts = [post for post in current_posts if post['uri'] not in last_post_uris]
-    return new_posts
-
-def process_posts_and_tweet(new_posts):
-    """Process each new post and post it to Twitter."""
-    for post in new_posts:
-        ptype = post.get("type", None)
-        text = post.get('text', '')
-        media_url = post.get('media_url', None)
-        quoted_post_url = post.get('quoted_post_url', None)
-        bluesky_url = post.get('uri', '')  # URL to the original Bluesky post
-
-        tweet_response = None
-        
-        
-        # Case 1: Text-only post
-        if ptype == "text":
-            print(f"Processing text-only post: {text}")
-            tweet_response = post_tweet_with_media_and_quote(text)
-        
-        # Case 2: Post with media
-        elif ptype == "media":
-            print(f"Processing post with media: {text}")
-            media_id = upload_media(media_url)
-            tweet_response = post_tweet_with_media_and_quote(text, media_id)
-        
-        # Case 3: Quote retweet post
-        elif ptype == "quote":
-            print(f"Processing quote retweet post: {text}")
-            tweet_response = post_tweet_with_media_and_quote(text, quoted_url=quoted_post_url)
-
-        # Post a comment with the original Bluesky link after tweeting
-        if tweet_response and tweet_response.status_code == 201:
-            tweet_data = tweet_response.json()
-            tweet_id = tweet_data['data']['id']
-            comment_with_original_post(tweet_id, post)
-
-def main():
-    Config.init()
-    
-    while(True): 
-    # Step 1: Load the last processed posts
+def open_state(account):
+    """Open the account's processed-post state store, importing the legacy file when the store is new."""
+    state = StateStore(account.state_db)
+    if account.legacy and not state.processed_uris:
         last_posts = load_last_posts()
+        if last_posts:
+            logger.info(f"Importing {len(last_posts)} posts from {LAST_POSTS_FILE}")
+            state.import_posts(last_posts)
+    return state
 
-    # Step 2: Get current posts from Bluesky
-        current_posts = get_bsky_posts()
+def has_fresh_media(item):
+    """Check whether the media ids recorded for an outbox item can still be attached to a tweet."""
+    return (
+        item['media_ids'] is not None and
+        item['media_uploaded_at'] is not None and
+        time() - item['media_uploaded_at'] < MEDIA_IDS_MAX_AGE
+    )
 
-    # Step 3: Identify new posts
-        new_posts = get_new_posts(current_posts, last_posts)
+def get_post_id(uri):
+    """The record key of a post, used as the correlation id of everything done for it."""
+    return uri.split('/')[-1]
 
-        if not new_posts:
-            print("No new posts found.")
+def parse_timestamp(value):
+    """Parse an ISO 8601 timestamp as used by Bluesky into epoch seconds. Returns None if unreadable."""
+    try:
+        return datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+    except (AttributeError, ValueError):
+        return None
 
-    # Step 4: Process and tweet new posts
-        process_posts_and_tweet(new_posts)
+def submit_media_uploads(media_pool, account, item):
+    """
+    Queue the uploads of all media attached to an outbox item that still needs them.
+    Returns the futures in attachment order.
+    """
+    if item['tweet_id'] is not None or has_fresh_media(item):
+        return []
+    media = item['post'].get('media', [])[:MAX_MEDIA_PER_TWEET]
+    with logs.context(post=get_post_id(item['uri'])):
+        return [media_pool.submit(logs.carry_context(upload_media), account, entry['url'], entry['type'], entry.get('cid'))
+                for entry in media]
 
-    # Step 5: Save the latest posts for next time
-        save_last_posts(current_posts)
+def reply_and_complete(account, state, item, tweet_id):
+    """Post the reply with the original Bluesky link and retire the outbox item once it went out."""
+    try:
+        with metrics.STAGE_SECONDS.time(stage='reply'):
+            reply_response = comment_with_original_post(account, tweet_id, item['post'])
+    except Exception as e:
+        state.record_failure(item['uri'], e, OUTBOX_TWEETED)
+        return
 
-        sleep(Config.BLUESKY_REFRESH)
+    if reply_response.status_code == 201:
+        state.complete(item['uri'], tweet_id)
+    else:
+        state.record_failure(item['uri'], f"Reply failed with status code {reply_response.status_code}", OUTBOX_TWEETED)
 
-if __name__ == "__main__":
-    main()
+def tweet_post(account, post, media_ids=None):
+    """Post a single Bluesky post to Twitter. Returns the tweet response or None."""
+    ptype = post.get("type", None)
+    text = post.get('text', '')
+    quoted_post_url = post.get('quoted_post_url', None)
+
+    tweet_response = None
+
+    # Case 1: Text-only post
+    if ptype == "text":
+        logger.info(f"Processing text-only post: {text}")
+        tweet_response = post_tweet_with_media_and_quote(account, text)
+
+    # Case 2: Post with media
+    elif ptype == "media":
+        logger.info(f"Processing post with media: {text}")
+        tweet_response = post_tweet_with_media_and_quote(account, text, media_ids)
+
+    # Case 3: Quote retweet post
+    elif ptype == "quote":
+        logger.info(f"Processing quote retweet post: {text}")
+        tweet_response = post_tweet_with_media_and_quote(account, text, media_ids, quoted_url=quoted_post_url)
+
+    return tweet_response
+
+def process_posts_and_tweet(account, items, state):
+    """
+    Work through the outbox items, resuming each one at its first unfinished step.
+    Media for the whole batch is downloaded and uploaded concurrently, tweets go out one by one
+    in the given order and the replies with the original Bluesky link run in the background.
+    Every finished step is recorded in the state store before the next one starts. The batch
+    stops at the first item that failed but will be retried, so no later post is tweeted before
+    it; the rest stays in the outbox for the next poll.
+    """
+    # Link cards are fetched right after the tweets go out; have them cached by then
+    warm_preview_cache([item['post'] for item in items])
+
+    with ThreadPoolExecutor(max_workers=Config.MEDIA_WORKERS) as media_pool, \
+            ThreadPoolExecutor(max_workers=Config.REPLY_WORKERS) as reply_pool:
+        media_futures = [submit_media_uploads(media_pool, account, item) for item in items]
+
+        for index, (item, item_media_futures) in enumerate(zip(items, media_futures)):
+            with logs.context(post=get_post_id(item['uri'])):
+                if process_item(account, state, reply_pool, item, item_media_futures):
+                    continue
+                logger.warning(f"Holding back {len(items) - index - 1} later posts until it is retried")
+            for future in (future for futures in media_futures[index + 1:] for future in futures):
+                future.cancel()
+            break
+
+def process_item(account, state, reply_pool, item, media_futures):
+    """
+    Take one outbox item through the steps it still needs, submitting its reply to the reply pool.
+    Returns False when the item failed and will be retried, so later items have to wait for it.
+    """
+    uri = item['uri']
+    tweet_id = item['tweet_id']
+
+    if tweet_id is None:
+        # Step 1: Media uploaded
+        if has_fresh_media(item):
+            media_ids = item['media_ids']
+        else:
+            try:
+                media_ids = [future.result() for future in media_futures]
+            except Exception as e:
+                logger.error(f"Failed to prepare media for {uri}: {e}")
+                metrics.POSTS.inc(account=account.name, result='failed')
+                return not state.record_failure(uri, e, OUTBOX_PENDING)
+            state.update_item(uri, media_ids=media_ids, media_uploaded_at=time(), status=OUTBOX_MEDIA_UPLOADED)
+
+        # Step 2: Tweet posted. The in-flight state lets a restart tell that the tweet may have gone out.
+        state.update_item(uri, status=OUTBOX_TWEETING)
+        try:
+            with metrics.STAGE_SECONDS.time(stage='tweet'):
+                tweet_response = tweet_post(account, item['post'], media_ids)
+        except Exception as e:
+            # The request may have reached Twitter (e.g. a read timeout), so don't retry it blindly
+            logger.error(f"Tweet for {uri} failed and may have been posted: {e}")
+            metrics.POSTS.inc(account=account.name, result='failed')
+            state.update_item(uri, status=OUTBOX_FAILED, last_error=f"Tweet request failed and may have been posted: {e}")
+            return True
+
+        if tweet_response is None or tweet_response.status_code != 201:
+            status_code = tweet_response.status_code if tweet_response is not None else None
+            metrics.POSTS.inc(account=account.name, result='failed')
+            return not state.record_failure(uri, f"Tweet failed with status code {status_code}", OUTBOX_MEDIA_UPLOADED)
+
+        tweet_id = tweet_response.json()['data']['id']
+        state.update_item(uri, tweet_id=tweet_id, status=OUTBOX_TWEETED)
+        metrics.POSTS.inc(account=account.name, result='tweeted')
+        indexed_at = parse_timestamp(item['post'].get('indexed_at'))
+        if indexed_at is not None:
+            metrics.MIRROR_LAG_SECONDS.observe(max(0, time() - indexed_at), account=account.name)
+
+    # Step 3: Reply with the original Bluesky link posted
+    reply_pool.submit(logs.carry_context(reply_and_complete), account, state, item, tweet_id)
+    return True
+
+class MirrorPair:
+    """Runtime state of one mirror pair: its account, processed-post store and poll scheduler."""
+
+    def __init__(self, account, retry_failed=False):
+        self.account = account
+
+        # Load the processed posts once, the store is updated as posts are tweeted
+        self.state = open_state(account)
+        if retry_failed:
+            self.state.retry_failed()
+        for uri in self.state.recover_interrupted():
+            logger.warning(f"Tweet for {uri} was interrupted and may have been posted; "
+                           "run with --retry-failed to post it again", extra={'account': account.name})
+
+        self.poll_scheduler = PollScheduler(
+            account.min_refresh,
+            account.max_refresh,
+            Config.BLUESKY_REFRESH_BACKOFF,
+            Config.BLUESKY_REFRESH_JITTER
+        )
+
+def poll_pair(pair, fetch=True, streaming=False):
+    """
+    Run one poll of a mirror pair. Without fetch only the outbox is worked through, which is
+    how posts pushed by the event stream get tweeted. Returns the seconds until its next poll.
+    """
+    account, state, poll_scheduler = pair.account, pair.state, pair.poll_scheduler
+
+    try:
+        new_posts = []
+        if fetch:
+    # Step 1: Get posts newer than the last poll from Bluesky
+            try:
+                current_posts = get_bsky_posts(account)
+            except RequestException as e:
+                logger.error(f"Failed to fetch posts: {e}")
+                current_posts = None
+
+            if current_posts is None:
+                poll_scheduler.record_poll(0)
+                metrics.POLL_INTERVAL_SECONDS.set(poll_scheduler.interval, account=account.name)
+                return poll_scheduler.next_delay()
+
+    # Step 2: Identify new posts and queue them in the outbox, oldest first
+            new_posts = state.enqueue(current_posts[::-1])
+            commit_feed_position(account)
+
+            if not new_posts:
+                logger.info("No new posts found.")
 
+    # Step 3: Process and tweet everything still in the outbox, including retries of earlier failures
+        process_posts_and_tweet(account, state.pending_items(), state)
+
+    # Step 4: Poll again sooner after activity, back off while the account is quiet
+        if fetch:
+            poll_scheduler.record_poll(len(new_posts))
+    except Exception as e:
+        logger.exception(f"Poll failed: {e}")
+        poll_scheduler.record_poll(0)
+
+    metrics.POLL_INTERVAL_SECONDS.set(poll_scheduler.interval, account=account.name)
+
+    # While the event stream delivers new posts, polling is only a safety net
+    delay = poll_scheduler.next_delay()
+    if streaming:
+        delay = max(delay, Config.JETSTREAM_SAFETY_POLL)
+    if fetch:
+        logger.info(f"Next poll in {delay:.0f}s (interval {poll_scheduler.interval:.0f}s)")
+    return delay
+
+def start_event_stream(pairs, signals):
+    """
+    Subscribe to the event stream for all pairs. Posts it pushes are queued in the pair's outbox
+    and the pair is woken up to tweet them; when the stream drops every pair polls right away.
+    Returns the subscriber, or None if streaming is unavailable.
+    """
+    # Only the streaming ingest mode needs the subscriber and websocket-client
+    from jetstream import JetstreamSubscriber
+
+    # One batched lookup for every account without a configured DID instead of one request each
+    resolve_actor_dids([pair.account for pair in pairs])
+    pairs_by_did = {}
+    for index, pair in enumerate(pairs):
+        try:
+            pairs_by_did[get_actor_did(pair.account)] = index
+        except Exception as e:
+            logger.warning(f"Can't stream without a DID, polling instead: {e}", extra={'account': pair.account.name})
+
+    def on_post(did, commit):
+        index = pairs_by_did[did]
+        pair = pairs[index]
+        with logs.context(account=pair.account.name, post=commit['rkey']):
+            logger.info("Post received from the event stream")
+        posts = filter_post_record(pair.account, did, commit['rkey'], commit.get('cid'), commit.get('record', {}))
+        if pair.state.enqueue(posts):
+            signals.put(('wake', index))
+
+    def on_disconnect():
+        for index in pairs_by_did.values():
+            signals.put(('poll', index))
+
+    subscriber = JetstreamSubscriber(pairs_by_did.keys(), on_post, on_disconnect)
+    if not pairs_by_did or not subscriber.start():
+        return None
+    return subscriber
+
+def main(retry_failed=False):
+    Config.init()
+    if Config.METRICS_PORT:
+        metrics.serve(Config.METRICS_HOST, Config.METRICS_PORT)
+        logger.info(f"Serving metrics on {Config.METRICS_HOST}:{Config.METRICS_PORT}/metrics")
+
+    pairs = [MirrorPair(account, retry_failed) for account in Config.ACCOUNTS]
+
+    # Everything that changes a pair's schedule arrives on this queue: finished polls,
+    # posts pushed by the event stream and stream disconnects
+    signals = queue.Queue()
+    subscriber = start_event_stream(pairs, signals) if Config.INGEST_MODE == 'jetstream' else None
+
+    # All pairs share one loop that decides which pair runs next; the polls themselves run
+    # in a bounded pool so a slow pair doesn't hold up the others
+    next_poll = {index: 0 for index in range(len(pairs))}
+    woken = set()
+    in_flight = set()
+    # Pairs whose stream dropped while they were polling; their poll may have used the safety interval
+    repoll = set()
+
+    with ThreadPoolExecutor(max_workers=Config.ACCOUNT_WORKERS) as poll_pool:
+        while True:
+            now = time()
+            for index, pair in enumerate(pairs):
+                if index in in_flight or (index not in woken and next_poll[index] > now):
+                    continue
+                fetch = next_poll[index] <= now
+                streaming = subscriber is not None and subscriber.connected
+                woken.discard(index)
+                in_flight.add(index)
+                with logs.context(account=pair.account.name):
+                    future = poll_pool.submit(logs.carry_context(poll_pair), pair, fetch, streaming)
+                future.add_done_callback(
+                    lambda future, index=index, fetch=fetch: signals.put(('done', index, fetch, future.result()))
+                )
+
+            idle = [next_poll[index] for index in next_poll if index not in in_flight]
+            timeout = max(0, min(idle) - time()) if idle else None
+            try:
+                signal = signals.get(timeout=timeout)
+            except queue.Empty:
+                continue
+
+            if signal[0] == 'done':
+                _, index, fetch, delay = signal
+                in_flight.discard(index)
+                if index in repoll:
+                    repoll.discard(index)
+                    next_poll[index] = 0
+                elif fetch:
+                    next_poll[index] = time() + delay
+            elif signal[0] == 'wake':
+                woken.add(signal[1])
+            elif signal[0] == 'poll':
+                next_poll[signal[1]] = 0
+                if signal[1] in in_flight:
+                    repoll.add(signal[1])
+
+def backfill(account_name=None, retry_failed=False):
+    """
+    Mirror the complete history of one account, oldest post first.
+    The whole author feed is paged through once and its posts are stored in the state database
+    page by page; they are then moved into the outbox in small batches and tweeted at no more
+    than posts_per_hour. Both phases checkpoint after every page or batch, so an interrupted
+    run picks up where it stopped. Don't run the mirror for the same account at the same time.
+    """
+    Config.init()
+    if account_name is None and len(Config.ACCOUNTS) == 1:
+        account = Config.ACCOUNTS[0]
+    else:
+        account = next((account for account in Config.ACCOUNTS if account.name == account_name), None)
+        if account is None:
+            raise Exception(f"Unknown account {account_name!r}; pass one of: {', '.join(a.name for a in Config.ACCOUNTS)}")
+
+    with logs.context(account=account.name):
+        pair = MirrorPair(account, retry_failed)
+        state = pair.state
+
+        # Phase 1: collect the full feed, resuming after the last stored page
+        cursor, pages, complete = state.get_backfill_progress()
+        if not complete:
+            logger.info(f"Scanning the author feed, {pages} pages stored so far")
+            for posts, cursor in iter_feed_pages(account, cursor, Config.BACKFILL_PAGE_LIMIT):
+                state.save_backfill_page(posts, cursor)
+                pages += 1
+                if pages % 10 == 0:
+                    logger.info(f"Scanned {pages} pages")
+        logger.info(f"Feed scan complete, {state.count_backfill_remaining()} posts left to backfill")
+
+        # Phase 2: tweet oldest first, finishing whatever the outbox still holds before each batch
+        seconds_per_post = 3600 / Config.BACKFILL_POSTS_PER_HOUR
+        while True:
+            started = time()
+            queued = state.enqueue_backfill(state.next_backfill_batch(Config.BACKFILL_BATCH_SIZE))
+            items = state.pending_items()
+            if not items:
+                break
+            process_posts_and_tweet(account, items, state)
+
+            remaining = state.count_backfill_remaining()
+            logger.info(f"Backfilled a batch of {len(queued)} posts, {remaining} left")
+            if remaining:
+                sleep(max(0, started + len(items) * seconds_per_post - time()))
+
+        logger.info("Backfill complete")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mirror Bluesky posts to Twitter.")
+    parser.add_argument("--retry-failed", action="store_true", help="Queue posts that failed or were interrupted again")
+    parser.add_argument("--backfill", nargs="?", const="", metavar="ACCOUNT",
+                        help="Mirror the complete history of an account (the only one if omitted) instead of new posts")
+    args = parser.parse_args()
+    if args.backfill is not None:
+        backfill(args.backfill or None, retry_failed=args.retry_failed)
+    else:
+        main(retry_failed=args.retry_failed)
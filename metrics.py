@@ -0,0 +1,146 @@
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter
+
+# Upper bounds (seconds) of the histogram buckets for request-sized work and for mirror lag
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+LAG_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, 21600)
+
+# Every metric created in this process, in creation order
+_registry = []
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = [(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for name, value in pairs]
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+class Counter:
+    """A monotonically increasing value per label combination."""
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.lock = threading.Lock()
+        self.values = {}
+        _registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, '') for name in self.labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def collect(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{format_labels(self.labels, key)} {value}")
+        return lines
+
+class Gauge:
+    """A value per label combination that can go up and down."""
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.lock = threading.Lock()
+        self.values = {}
+        _registry.append(self)
+
+    def set(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.labels)
+        with self.lock:
+            self.values[key] = value
+
+    def collect(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} gauge"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{format_labels(self.labels, key)} {value}")
+        return lines
+
+class Histogram:
+    """Observations sorted into cumulative buckets per label combination, Prometheus style."""
+
+    def __init__(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.values = {}
+        _registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.labels)
+        with self.lock:
+            series = self.values.setdefault(key, {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0})
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series['buckets'][index] += 1
+            series['sum'] += value
+            series['count'] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the wall time of the block, also when it raises."""
+        started = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - started, **labels)
+
+    def collect(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for key, series in sorted(self.values.items()):
+                for bound, bucket_count in zip(self.buckets, series['buckets']):
+                    lines.append(f"{self.name}_bucket{format_labels(self.labels, key, [('le', bound)])} {bucket_count}")
+                lines.append(f"{self.name}_bucket{format_labels(self.labels, key, [('le', '+Inf')])} {series['count']}")
+                lines.append(f"{self.name}_sum{format_labels(self.labels, key)} {series['sum']}")
+                lines.append(f"{self.name}_count{format_labels(self.labels, key)} {series['count']}")
+        return lines
+
+def render():
+    """All metrics in the Prometheus text exposition format."""
+    return '\n'.join(line for metric in _registry for line in metric.collect()) + '\n'
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def serve(host, port):
+    """Serve /metrics from a background thread."""
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
+
+# Time spent per stage: feed_fetch, filter, media_download, media_upload, tweet, reply,
+# preview_fetch and preview_render
+STAGE_SECONDS = Histogram('mirror_stage_seconds', 'Seconds spent in each stage of mirroring or serving previews', ('stage',))
+# Lookups per cache (media_id, blob, preview) by result (hit, stale, miss)
+CACHE_REQUESTS = Counter('mirror_cache_requests_total', 'Cache lookups by cache and result', ('cache', 'result'))
+TOKEN_REFRESHES = Counter('mirror_token_refreshes_total', 'Bluesky session renewals by kind (refresh or login)', ('account', 'kind'))
+RATE_LIMIT_WAIT_SECONDS = Counter('mirror_rate_limit_wait_seconds_total', 'Seconds requests waited for a rate limit budget', ('endpoint',))
+RATE_LIMITED_RESPONSES = Counter('mirror_rate_limited_responses_total', 'Responses with status 429', ('endpoint',))
+POSTS = Counter('mirror_posts_total', 'Mirrored posts by result (tweeted or failed)', ('account', 'result'))
+POLL_INTERVAL_SECONDS = Gauge('mirror_poll_interval_seconds', 'Current adaptive poll interval of each account, before jitter', ('account',))
+MIRROR_LAG_SECONDS = Histogram('mirror_lag_seconds', 'Seconds from a post being indexed on Bluesky to its tweet being created',
+                               ('account',), buckets=LAG_BUCKETS)
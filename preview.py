@@ -1,13 +1,109 @@
-from flask import Flask, request, jsonify, render_template_string, redirect
-import requests
-from bs4 import BeautifulSoup
-import cv2  # For handling video frames
+import sys
+if __name__ == "__main__" and "--async" in sys.argv:
+    # gevent has to patch the standard library before anything else imports it
+    from gevent import monkey
+    monkey.patch_all()
+
+from flask import Flask, Response, request, jsonify, redirect
+import argparse
+import gzip
+import hashlib
+import hmac
+import logging
+import multiprocessing
+import os
+import threading
+from urllib.parse import urlsplit
+from time import time
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import http_client
+from requests.exceptions import RequestException
 from diskcache import Cache
+from preview_cache import PreviewCache, get_preview_data
+from resolver import Resolver
+import thumbnails
+import logs
+import metrics
+
+try:
+    import brotli  # Optional, adds a brotli-compressed copy of each preview
+except ImportError:
+    brotli = None
+
 # Initialize cache (stored in a directory on disk)
 cache_dir = './cache'  # You can change this to your preferred cache directory
 cache = Cache(cache_dir)
+# Seconds a post stays fresh, and how much longer it may still be served while it is refreshed
+preview_ttl = 3600
+preview_stale_ttl = 7 * 24 * 3600
+# Posts kept in memory in front of the disk cache
+preview_memory_items = 1024
+preview_cache = PreviewCache(cache, max_items=preview_memory_items, ttl=preview_ttl, stale_ttl=preview_stale_ttl)
+# Log format ('text' or 'json') and level
+logs.setup(os.environ.get('PREVIEW_LOG_FORMAT', 'text'), os.environ.get('PREVIEW_LOG_LEVEL', 'INFO'))
+logger = logging.getLogger('preview')
+
+# Card-sized og:images are kept for a month (the source images never change), failed ones are retried
+# after five minutes, and sources larger than this are not downloaded at all
+image_cache_ttl = 30 * 24 * 3600
+image_retry_ttl = 300
+image_max_bytes = 20 * 1024 * 1024
+# Processes that decode and resize images, so request threads only wait on them
+image_workers = 2
+
+# Public base URL of this server for the card-sized og:image links, e.g. https://preview.example.com;
+# without it the links point at the original images on the Bluesky CDN
+public_url = os.environ.get('PREVIEW_PUBLIC_URL')
+# Shared secret the mirror sends when warming the cache; without it warming is disabled, since
+# behind a reverse proxy every request would look local
+warm_token = os.environ.get('PREVIEW_WARM_TOKEN')
 app = Flask(__name__)
 
+
+class SingleFlight:
+    """
+    Runs a function at most once per key at a time. Callers that arrive while a call for the
+    same key is in flight wait for it and share its result (or exception).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, fn):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = Future()
+                self.calls[key] = call
+
+        if not leader:
+            return call.result()
+
+        try:
+            call.set_result(fn())
+        except BaseException as e:
+            # Also GreenletExit and gevent.Timeout, or the followers would wait forever
+            call.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+        return call.result()
+
+# Concurrent cache misses for the same post share one upstream fetch
+preview_flights = SingleFlight()
+# Stale posts are refetched here while the stale copy is served
+refresh_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="preview-refresh")
+refreshing = set()
+refreshing_lock = threading.Lock()
+# Concurrent requests for the same card image share one download and resize
+image_flights = SingleFlight()
+image_pool = None
+image_pool_lock = threading.Lock()
+
 # Template for the dynamic HTML preview
 
 
@@ -80,14 +176,73 @@ preview_template = """
 """
 
 
+# Upstream base URLs, overridable e.g. to benchmark against local stand-ins
+APPVIEW_BASE_URL = os.environ.get('PREVIEW_APPVIEW_URL', "https://public.api.bsky.app").rstrip('/')
+APPVIEW_URL = APPVIEW_BASE_URL + "/xrpc"
+BSKY_WEB_URL = os.environ.get('PREVIEW_BSKY_WEB_URL', "https://bsky.app").rstrip('/')
+CDN_URL = os.environ.get('PREVIEW_CDN_URL', "https://cdn.bsky.app").rstrip('/')
+VIDEO_CDN_URL = os.environ.get('PREVIEW_VIDEO_CDN_URL', "https://video.bsky.app").rstrip('/')
+# The only hosts card images are downloaded from and crawlers are sent to
+IMAGE_ORIGINS = {(urlsplit(url).scheme, urlsplit(url).netloc.lower()) for url in (CDN_URL, VIDEO_CDN_URL)}
+
+def is_allowed_image_url(url):
+    """Check that an image URL points at the Bluesky image or video CDN."""
+    parts = urlsplit(url or '')
+    return (parts.scheme, parts.netloc.lower()) in IMAGE_ORIGINS
+
+# Seconds a resolved handle stays cached, and how long a handle that doesn't resolve is remembered
+HANDLE_CACHE_TTL = 24 * 3600
+HANDLE_NEGATIVE_TTL = 300
+# Handles are resolved in memory first, then from the disk cache, then from the AppView
+resolver = Resolver(APPVIEW_BASE_URL, disk_cache=cache, ttl=HANDLE_CACHE_TTL, negative_ttl=HANDLE_NEGATIVE_TTL)
+
+def get_actor(handle):
+    """
+    The DID of the author in a preview URL, so URLs with the handle and with the DID (or with an
+    old and a new handle) share one cache entry. Handles that don't resolve are used as they are.
+    """
+    return resolver.resolve_handle(handle) or handle
+
+def fetch_bluesky_post_api(handle, post_id):
+    """Build the preview data straight from the AppView getPosts API. Returns None if that fails."""
+    did = resolver.resolve_handle(handle)
+    if not did:
+        return None
+
+    response = http_client.get(f"{APPVIEW_URL}/app.bsky.feed.getPosts",
+                               params={"uris": f"at://{did}/app.bsky.feed.post/{post_id}"})
+    if response.status_code != 200:
+        logger.warning(f"Failed to fetch Bluesky post from the API. Status code: {response.status_code}")
+        return None
+
+    posts = response.json().get('posts', [])
+    if not posts:
+        return None
+
+    return get_preview_data(posts[0], handle, post_id, VIDEO_CDN_URL)
+
 def fetch_bluesky_post(handle, post_id):
+    """Fetch the preview data of a post, from the API when possible and by scraping bsky.app otherwise."""
+    try:
+        post_data = fetch_bluesky_post_api(handle, post_id)
+    except (RequestException, KeyError, TypeError, AttributeError, ValueError) as e:
+        logger.warning(f"Error while fetching the post from the API: {e}")
+        post_data = None
+
+    if post_data:
+        return post_data
+    return scrape_bluesky_post(handle, post_id)
+
+def scrape_bluesky_post(handle, post_id):
     post_url = f"https://bsky.app/profile/{handle}/post/{post_id}"
-    response = requests.get(post_url)
+    response = http_client.get(f"{BSKY_WEB_URL}/profile/{handle}/post/{post_id}")
 
     if response.status_code != 200:
-        print(f"Failed to fetch Bluesky post. Status code: {response.status_code}")
+        logger.error(f"Failed to fetch Bluesky post. Status code: {response.status_code}")
         return None
 
+    # Only this scraping fallback needs BeautifulSoup, so it is imported on first use
+    from bs4 import BeautifulSoup
     soup = BeautifulSoup(response.text, 'html.parser')
     
     # Extract necessary information with error handling
@@ -103,8 +258,8 @@ def fetch_bluesky_post(handle, post_id):
 
         # If the card type indicates a summary (e.g., video or embed), fetch additional info
         if twitter_card and twitter_card['content'] == 'summary':
-            api_url = f"https://public.api.bsky.app/xrpc/app.bsky.feed.getPostThread?uri=at%3A%2F%2F{handle}%2Fapp.bsky.feed.post%2F{post_id}&depth=10"
-            api_response = requests.get(api_url)
+            api_url = f"{APPVIEW_URL}/app.bsky.feed.getPostThread?uri=at%3A%2F%2F{handle}%2Fapp.bsky.feed.post%2F{post_id}&depth=10"
+            api_response = http_client.get(api_url)
 
             if api_response.status_code == 200:
                 data = api_response.json()
@@ -113,11 +268,11 @@ def fetch_bluesky_post(handle, post_id):
                 video_link = post.get('record', {}).get('embed', {}).get('video', {}).get('ref', {}).get('$link')
                 if video_link:
                     did = author['did']
-                    thumbnail_url = f"https://video.bsky.app/watch/{did}/{video_link}/thumbnail.jpg"
+                    thumbnail_url = f"{VIDEO_CDN_URL}/watch/{did}/{video_link}/thumbnail.jpg"
                     image_url = thumbnail_url
 
     except (KeyError, TypeError, AttributeError) as e:
-        print(f"Error while extracting data: {e}")
+        logger.error(f"Error while extracting data: {e}")
         return None
 
     # Return the post data
@@ -128,56 +283,332 @@ def fetch_bluesky_post(handle, post_id):
         "bluesky_url": post_url
     }
 
+# Post data the preview template is rendered from
+PREVIEW_FIELDS = ('display_name', 'text', 'image_url', 'bluesky_url')
+
+# Compiled once; rendered bodies remember the template they came from
+preview_page = app.jinja_env.from_string(preview_template)
+TEMPLATE_VERSION = hashlib.sha256(preview_template.encode('utf-8')).hexdigest()[:12]
+
+# Previews only differ between crawlers and browsers (who get redirected)
+PREVIEW_VARY = 'User-Agent, Accept-Encoding'
+
 @app.route("/preview/<handle>/post/<post_id>", methods=["GET"])
 def generate_preview(handle, post_id):
+    # The post ID is the correlation id the mirror logs the same post under
+    with logs.context(post=post_id, handle=handle):
+        return serve_preview(handle, post_id)
+
+def serve_preview(handle, post_id):
     # Check if the request is from a web browser (not for embedding)
     user_agent = request.headers.get('User-Agent', '').lower()
 
     # Detect if the request is for a direct visit (not an embed) and redirect
     if 'twitterbot/1.0' not in user_agent and 'facebookexternalhit' not in user_agent and 'linkedinbot' not in user_agent:
-        return redirect(f"https://bsky.app/profile/{handle}/post/{post_id}")
+        response = redirect(f"https://bsky.app/profile/{handle}/post/{post_id}")
+        response.headers['Vary'] = PREVIEW_VARY
+        return response
 
-    # Define the cache key
-    cache_key = f"{handle}/{post_id}"
+    actor = get_actor(handle)
+    cache_key = f"post:{actor}/{post_id}"
+    entry = get_post_entry(actor, post_id)
+    if not entry:
+        return "Post not found or unsupported post type", 404
 
-    # Check if the fully rendered HTML is in the cache
-    cached_html = cache.get(cache_key)
+    # Bodies rendered with an older template or another og:image are rendered and compressed again once
+    image_url = get_card_image_url(actor, post_id, entry['data'])
+    body = entry.get('body')
+    if not body or body['template'] != TEMPLATE_VERSION or body.get('image_url') != image_url:
+        entry = preview_cache.set_body(cache_key, entry, render_body(entry['data'], image_url))
+    return preview_response(entry)
 
-    if cached_html:
-        # Return the cached HTML without further processing
-        print(f"Cache hit for {cache_key}")
-        return cached_html
+def get_post_entry(handle, post_id):
+    """Return the cache entry of a post, fetching it on a miss and refreshing it in the background when stale."""
+    cache_key = f"post:{handle}/{post_id}"
 
-    print(f"Cache miss for {cache_key}, generating preview...")
+    # Check if the post data is in the cache, stale or not
+    entry, fresh = preview_cache.get(cache_key)
+
+    if entry is None:
+        metrics.CACHE_REQUESTS.inc(cache='preview', result='miss')
+        # Crawlers tend to arrive together right after a tweet goes out; only the first one fetches
+        entry = preview_flights.do(cache_key, lambda: load_post(handle, post_id))
+    elif fresh:
+        metrics.CACHE_REQUESTS.inc(cache='preview', result='hit')
+        logger.info(f"Cache hit for {cache_key}")
+    else:
+        metrics.CACHE_REQUESTS.inc(cache='preview', result='stale')
+        logger.info(f"Stale cache hit for {cache_key}, refreshing in the background")
+        refresh_post(handle, post_id)
+    return entry
+
+def get_card_image_url(handle, post_id, post_data):
+    """
+    URL of the og:image of a post: its card-sized copy served here, or the original image on the
+    Bluesky CDN when the public URL of this server isn't configured. None when the post has no image there.
+    """
+    if not is_allowed_image_url(post_data.get('image_url')):
+        return None
+    if not public_url:
+        # The requested host is the proxy's upstream address behind a reverse proxy, not a public one
+        return post_data['image_url']
+    return f"{public_url.rstrip('/')}/preview/{handle}/post/{post_id}/image"
+
+def is_valid_warm_entry(entry):
+    """Check that a pushed entry names a post and carries all of its preview data as strings."""
+    if not isinstance(entry, dict) or not isinstance(entry.get('data'), dict):
+        return False
+    if not all(isinstance(entry.get(key), str) and entry[key] for key in ('handle', 'post_id')):
+        return False
+    data = entry['data']
+    if not all(isinstance(data.get(key), str) for key in PREVIEW_FIELDS if key != 'image_url'):
+        return False
+    # Posts without an image have None; images elsewhere would make the image route fetch and
+    # redirect to arbitrary URLs
+    image_url = data.get('image_url', '')
+    return image_url is None or (isinstance(image_url, str) and is_allowed_image_url(image_url))
+
+@app.route("/preview/warm", methods=["POST"])
+def warm_previews():
+    """Store post data pushed by the mirror right before it tweets the preview links."""
+    if not warm_token:
+        return jsonify({"error": "Warming is disabled, set PREVIEW_WARM_TOKEN to enable it"}), 403
+    if not hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {warm_token}"):
+        return jsonify({"error": "Unauthorized"}), 401
+
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict) or not isinstance(payload.get('posts'), list):
+        return jsonify({"error": "Expected a JSON object with a list of posts"}), 400
+    entries = [entry for entry in payload['posts'] if is_valid_warm_entry(entry)]
+    # Entries keyed by handle are stored under the DID, resolved in batches
+    actors = resolver.resolve_handles([entry['handle'] for entry in entries])
+
+    warmed = 0
+    for entry in entries:
+        actor = actors.get(entry['handle']) or entry['handle']
+        data = {key: entry['data'][key] for key in PREVIEW_FIELDS}
+        body = render_body(data, get_card_image_url(actor, entry['post_id'], data))
+        preview_cache.set(f"post:{actor}/{entry['post_id']}", data, body)
+        warmed += 1
+
+    logger.info(f"Warmed {warmed} previews")
+    return jsonify({"warmed": warmed})
+
+def load_post(handle, post_id):
+    """
+    Fetch a post and cache its data and its rendered body.
+    Returns the cache entry or None if the post can't be fetched.
+    """
+    cache_key = f"post:{handle}/{post_id}"
+    logger.info(f"Fetching {cache_key}...")
 
     # Fetch the Bluesky post data
-    post_data = fetch_bluesky_post(handle, post_id)
+    with metrics.STAGE_SECONDS.time(stage='preview_fetch'):
+        post_data = fetch_bluesky_post(handle, post_id)
 
     if post_data:
-        # Truncate the text to the first 200 characters
-        preview_text = post_data["text"][:200] + "..." if len(post_data["text"]) > 200 else post_data["text"]
-
-        # Render the preview HTML
-        rendered_html = render_template_string(preview_template,
-                                               display_name=post_data["display_name"],
-                                               preview_text=preview_text,
-                                               image_url=post_data["image_url"],
-                                               handle=handle,
-                                               post_id=post_id)
-
-        # Cache the rendered HTML
-        cache.set(cache_key, rendered_html, expire=3600)  # Cache for 1 hour
-
-        # Return the rendered HTML
-        return rendered_html
+        image_url = get_card_image_url(handle, post_id, post_data)
+        return preview_cache.set(cache_key, post_data, render_body(post_data, image_url))
+    return None
+
+def refresh_post(handle, post_id):
+    """Refetch a stale post in the background, at most once at a time per post."""
+    cache_key = f"post:{handle}/{post_id}"
+    with refreshing_lock:
+        if cache_key in refreshing:
+            return
+        refreshing.add(cache_key)
+
+    def refresh():
+        try:
+            preview_flights.do(cache_key, lambda: load_post(handle, post_id))
+        except Exception as e:
+            # The stale copy keeps being served until a refresh succeeds
+            logger.error(f"Failed to refresh {cache_key}: {e}")
+        finally:
+            with refreshing_lock:
+                refreshing.discard(cache_key)
+
+    refresh_pool.submit(logs.carry_context(refresh))
+
+def render_preview(post_data, image_url):
+    """Render the preview HTML from post data, showing the image at image_url."""
+    # Truncate the text to the first 200 characters
+    preview_text = post_data["text"][:200] + "..." if len(post_data["text"]) > 200 else post_data["text"]
+
+    return preview_page.render(display_name=post_data["display_name"],
+                               preview_text=preview_text,
+                               image_url=image_url,
+                               bluesky_url=post_data["bluesky_url"])
+
+@metrics.STAGE_SECONDS.time(stage='preview_render')
+def render_body(post_data, image_url):
+    """
+    Render the preview HTML once and keep it with its content hash and compressed copies,
+    so requests only pick an encoding instead of rendering and compressing again.
+    """
+    html = render_preview(post_data, image_url).encode('utf-8')
+    body = {
+        'template': TEMPLATE_VERSION,
+        'image_url': image_url,
+        'etag': hashlib.sha256(html).hexdigest()[:32],
+        'identity': html,
+        'gzip': gzip.compress(html, compresslevel=9)
+    }
+    if brotli is not None:
+        body['br'] = brotli.compress(html)
+    return body
+
+def choose_encoding(body):
+    """Pick the smallest stored encoding the client accepts."""
+    encodings = [encoding for encoding in ('br', 'gzip') if encoding in body and request.accept_encodings[encoding]]
+    return encodings[0] if encodings else 'identity'
+
+def preview_response(entry):
+    """Build the response for a cached preview, answering conditional requests with 304."""
+    body = entry['body']
+    encoding = choose_encoding(body)
+
+    response = Response(body[encoding], mimetype='text/html')
+    if encoding != 'identity':
+        response.headers['Content-Encoding'] = encoding
+    # Each encoding is a different representation and gets its own strong ETag
+    response.set_etag(body['etag'] if encoding == 'identity' else f"{body['etag']}-{encoding}")
+    response.last_modified = entry['fetched_at']
+    response.headers['Vary'] = PREVIEW_VARY
+
+    # Shared caches may keep the preview until it goes stale here, then serve it while they revalidate
+    max_age = max(0, int(preview_ttl - (time() - entry['fetched_at'])))
+    response.headers['Cache-Control'] = f"public, max-age={max_age}, stale-while-revalidate={preview_stale_ttl}"
+
+    # Turns into a 304 without a body when If-None-Match or If-Modified-Since match
+    return response.make_conditional(request)
+
+@app.route("/preview/<handle>/post/<post_id>/image", methods=["GET"])
+def generate_preview_image(handle, post_id):
+    with logs.context(post=post_id, handle=handle):
+        return serve_preview_image(handle, post_id)
+
+def serve_preview_image(handle, post_id):
+    """Serve the og:image of a post scaled down and recompressed to card size."""
+    entry = get_post_entry(get_actor(handle), post_id)
+    if not entry or not is_allowed_image_url(entry['data'].get('image_url')):
+        return "Post not found or has no image", 404
+
+    source_url = entry['data']['image_url']
+    image = cache.get(f"image:{source_url}")
+    if image is None:
+        metrics.CACHE_REQUESTS.inc(cache='image', result='miss')
+        image = image_flights.do(source_url, lambda: load_card_image(source_url))
     else:
-        return "Post not found or unsupported post type", 404
+        metrics.CACHE_REQUESTS.inc(cache='image', result='hit')
+
+    if image['body'] is None:
+        # Let the crawler try the original rather than showing a card without an image
+        response = redirect(source_url)
+        response.headers['Cache-Control'] = f"public, max-age={image_retry_ttl}"
+        return response
+
+    response = Response(image['body'], mimetype='image/jpeg')
+    response.set_etag(image['etag'])
+    response.headers['Cache-Control'] = f"public, max-age={image_cache_ttl}, immutable"
+    return response.make_conditional(request)
+
+def get_image_pool():
+    """
+    Start the image worker processes on first use. They are spawned rather than forked,
+    as forking a process that already runs request threads can deadlock the children.
+    """
+    global image_pool
+    with image_pool_lock:
+        if image_pool is None:
+            image_pool = ProcessPoolExecutor(max_workers=image_workers, mp_context=multiprocessing.get_context('spawn'))
+        return image_pool
+
+def reset_image_pool():
+    global image_pool
+    with image_pool_lock:
+        if image_pool is not None:
+            image_pool.shutdown(wait=False)
+        image_pool = None
+
+def download_image(url):
+    """Download a source image. Returns None if it can't be fetched or is too large."""
+    # Redirects are not followed, so nothing but the allowed image hosts is ever fetched
+    response = http_client.get(url, stream=True, allow_redirects=False)
+    try:
+        if response.status_code != 200:
+            logger.warning(f"Failed to fetch image {url}. Status code: {response.status_code}")
+            return None
+        data = bytearray()
+        for chunk in response.iter_content(64 * 1024):
+            data += chunk
+            if len(data) > image_max_bytes:
+                logger.warning(f"Image {url} is larger than {image_max_bytes} bytes")
+                return None
+        return bytes(data)
+    finally:
+        response.close()
+
+def load_card_image(source_url):
+    """
+    Fetch a source image once, make the card-sized copy in the process pool and cache it.
+    Videos without a thumbnail get a poster frame from the video instead.
+    Returns the cache entry; its body is None when no image could be made.
+    """
+    logger.info(f"Making the card image of {source_url}...")
+    body = None
+    try:
+        with metrics.STAGE_SECONDS.time(stage='image_fetch'):
+            data = download_image(source_url)
+        with metrics.STAGE_SECONDS.time(stage='image_resize'):
+            if data is not None:
+                body = get_image_pool().submit(thumbnails.make_card_image, data).result()
+            video_url = thumbnails.get_video_playlist_url(source_url, VIDEO_CDN_URL)
+            if body is None and video_url:
+                body = get_image_pool().submit(thumbnails.extract_poster_frame, video_url).result()
+    except BrokenProcessPool as e:
+        # A worker died (e.g. on a malformed video); start fresh workers for the next image
+        logger.error(f"Image workers failed while making the card image of {source_url}: {e}")
+        reset_image_pool()
+    except Exception as e:
+        logger.warning(f"Error while making the card image of {source_url}: {e}")
+
+    if body is None:
+        image = {'body': None}
+        cache.set(f"image:{source_url}", image, expire=image_retry_ttl)
+        return image
+
+    image = {'body': body, 'etag': hashlib.sha256(body).hexdigest()[:32]}
+    cache.set(f"image:{source_url}", image, expire=image_cache_ttl)
+    return image
 
-# Don't forget to close the cache properly
-@app.teardown_appcontext
-def close_cache(exception):
-    cache.close()
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    """Prometheus metrics of this process."""
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+def serve_async(host, port):
+    """
+    Serve the app from gevent greenlets instead of worker threads, so slow upstream fetches
+    only park a cheap greenlet while other requests keep being served.
+    The standard library is patched at the top of this module when started with --async.
+    """
+    from gevent.pywsgi import WSGIServer
+
+    logger.info(f"Serving previews asynchronously on {host}:{port}")
+    WSGIServer((host, port), app).serve_forever()
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", debug=False, port=3030)
+    parser = argparse.ArgumentParser(description="Serve link previews for Bluesky posts.")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=3030)
+    parser.add_argument("--async", dest="use_async", action="store_true",
+                        help="Serve with gevent so slow upstream fetches don't tie up worker threads (needs gevent)")
+    args = parser.parse_args()
+
+    if args.use_async:
+        serve_async(args.host, args.port)
+    else:
+        app.run(host=args.host, debug=False, port=args.port)
 
@@ -0,0 +1,141 @@
+import threading
+from collections import OrderedDict
+from time import time
+
+class PreviewCache:
+    """
+    Two-tier cache for preview post data: a bounded in-process LRU in front of a diskcache.Cache.
+
+    Entries stay fresh for `ttl` seconds. After that they are still returned for up to
+    `stale_ttl` more seconds, flagged as stale, so the caller can serve them right away and
+    refresh them in the background.
+    """
+
+    def __init__(self, disk_cache, max_items=1024, ttl=3600, stale_ttl=7 * 24 * 3600):
+        self.disk_cache = disk_cache
+        self.max_items = max_items
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.lock = threading.Lock()
+        self.memory = OrderedDict()
+
+    def remember(self, key, entry):
+        """Put an entry into the memory tier, evicting the least recently used one when full."""
+        with self.lock:
+            self.memory[key] = entry
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.max_items:
+                self.memory.popitem(last=False)
+
+    def get(self, key):
+        """
+        Look up an entry in memory first, then on disk.
+        Returns (entry, fresh); entry is None when there is no usable entry. Entries are dicts
+        with the post 'data', its 'fetched_at' time and optionally a rendered 'body'.
+        """
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None:
+                self.memory.move_to_end(key)
+
+        if entry is None:
+            entry = self.disk_cache.get(key)
+            if entry is None:
+                return None, False
+            self.remember(key, entry)
+
+        age = time() - entry['fetched_at']
+        if age >= self.ttl + self.stale_ttl:
+            return None, False
+        return entry, age < self.ttl
+
+    def set(self, key, data, body=None):
+        """Store data, and optionally its rendered body, in both tiers. Returns the new entry."""
+        entry = {'data': data, 'fetched_at': time(), 'body': body}
+        self.remember(key, entry)
+        self.disk_cache.set(key, entry, expire=self.ttl + self.stale_ttl)
+        return entry
+
+    def set_body(self, key, entry, body):
+        """Attach a rendered body to an existing entry without changing its age. Returns the new entry."""
+        entry = dict(entry, body=body)
+        self.remember(key, entry)
+        expire = self.ttl + self.stale_ttl - (time() - entry['fetched_at'])
+        if expire > 0:
+            self.disk_cache.set(key, entry, expire=expire)
+        return entry
+
+
+# Where Bluesky serves video thumbnails and playlists
+VIDEO_CDN_URL = "https://video.bsky.app"
+
+def get_embed_image_url(embed, did, video_cdn_url=VIDEO_CDN_URL):
+    """Pick the image that best represents an embed view: image, video thumbnail, link card or quoted media."""
+    embed_type = (embed or {}).get('$type')
+
+    if embed_type == 'app.bsky.embed.images#view':
+        images = embed.get('images', [])
+        return (images[0].get('thumb') or images[0].get('fullsize')) if images else None
+
+    if embed_type == 'app.bsky.embed.video#view':
+        if embed.get('thumbnail'):
+            return embed['thumbnail']
+        if embed.get('cid'):
+            return f"{video_cdn_url}/watch/{did}/{embed['cid']}/thumbnail.jpg"
+        return None
+
+    if embed_type == 'app.bsky.embed.external#view':
+        return embed.get('external', {}).get('thumb')
+
+    if embed_type == 'app.bsky.embed.recordWithMedia#view':
+        return get_embed_image_url(embed.get('media'), did, video_cdn_url)
+
+    if embed_type == 'app.bsky.embed.record#view':
+        quoted = embed.get('record', {})
+        for quoted_embed in quoted.get('embeds', []):
+            image_url = get_embed_image_url(quoted_embed, quoted.get('author', {}).get('did'), video_cdn_url)
+            if image_url:
+                return image_url
+    return None
+
+def get_quoted_text(embed):
+    """Return the text of the post quoted by an embed view, if any."""
+    embed_type = (embed or {}).get('$type')
+    if embed_type == 'app.bsky.embed.recordWithMedia#view':
+        embed = embed.get('record', {})
+        embed_type = embed.get('$type')
+    if embed_type == 'app.bsky.embed.record#view':
+        return embed.get('record', {}).get('value', {}).get('text')
+    return None
+
+def get_preview_data(post, handle, post_id, video_cdn_url=VIDEO_CDN_URL):
+    """Build the cached preview data of a post view (as returned by getPosts or getAuthorFeed)."""
+    author = post.get('author', {})
+    author_handle = author.get('handle') or handle
+    display_name = author.get('displayName') or author_handle
+    post_text = post.get('record', {}).get('text') or get_quoted_text(post.get('embed')) or ""
+
+    return {
+        "display_name": f"{display_name} (@{author_handle})",
+        "text": post_text,
+        "image_url": get_embed_image_url(post.get('embed'), author.get('did'), video_cdn_url) or author.get('avatar'),
+        "bluesky_url": f"https://bsky.app/profile/{handle}/post/{post_id}"
+    }
+
+def get_quoted_post_view(embed):
+    """
+    Return the post quoted by an embed view in the shape of a post view, or None if the embed
+    doesn't carry the quoted post itself (e.g. embeds rebuilt from a raw record).
+    """
+    embed_type = (embed or {}).get('$type')
+    if embed_type == 'app.bsky.embed.recordWithMedia#view':
+        embed = embed.get('record', {})
+        embed_type = embed.get('$type')
+    if embed_type != 'app.bsky.embed.record#view':
+        return None
+
+    quoted = embed.get('record', {})
+    if 'value' not in quoted:
+        return None
+    embeds = quoted.get('embeds') or [None]
+    return {'uri': quoted.get('uri', ''), 'author': quoted.get('author', {}), 'record': quoted['value'], 'embed': embeds[0]}
@@ -0,0 +1,125 @@
+import logging
+import threading
+from email.utils import parsedate_to_datetime
+from time import sleep, time
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+# Endpoint names used to pick a budget
+FEED = 'feed'
+CREATE_SESSION = 'createSession'
+MEDIA_UPLOAD = 'media_upload'
+TWEET_CREATE = 'tweet_create'
+
+# Seconds to wait after a 429 that carries no reset information
+DEFAULT_RETRY_AFTER = 60
+
+# One limiter per endpoint, created on first use
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+class RateLimiter:
+    """
+    Token bucket for a single endpoint that learns its budget from rate-limit response headers.
+    The remaining requests of the current window are spread evenly until the reset time, with a
+    small burst allowance so a lone request is never delayed. Until the first response arrives
+    the budget is unknown and requests pass straight through.
+    """
+
+    def __init__(self, name, burst):
+        self.name = name
+        self.burst = burst
+        self.lock = threading.Lock()
+        self.tokens = burst
+        self.rate = None
+        self.remaining = None
+        self.reset_at = None
+        self.updated_at = time()
+
+    def refill(self, now):
+        if self.rate is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def acquire(self):
+        """Block until a request may be sent. Returns the seconds spent waiting."""
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time()
+                if self.reset_at is not None and now >= self.reset_at:
+                    # The window is over, the next response tells us the new budget
+                    self.rate = None
+                    self.remaining = None
+                    self.reset_at = None
+                    self.tokens = self.burst
+
+                if self.remaining is not None and self.remaining <= 0:
+                    wait = self.reset_at - now
+                else:
+                    self.refill(now)
+                    if self.rate is None or self.tokens >= 1:
+                        self.tokens = max(0, self.tokens - 1)
+                        if self.remaining is not None:
+                            self.remaining -= 1
+                        return waited
+                    wait = (1 - self.tokens) / self.rate
+
+            # Sleep without the lock so responses can update the budget meanwhile; it is checked again after
+            if wait >= 1:
+                logger.info(f"Rate limit for {self.name}: waiting {wait:.1f}s", extra={'endpoint': self.name})
+            sleep(wait)
+            waited += wait
+
+    def update(self, response):
+        """Learn the current budget from the rate-limit headers of a response."""
+        headers = response.headers
+        remaining = headers.get('x-rate-limit-remaining', headers.get('ratelimit-remaining'))
+        reset = headers.get('x-rate-limit-reset', headers.get('ratelimit-reset'))
+
+        if response.status_code == 429:
+            remaining = 0
+            if reset is None:
+                reset = time() + parse_retry_after(headers.get('retry-after'))
+
+        if remaining is None or reset is None:
+            return
+
+        with self.lock:
+            now = time()
+            self.remaining = int(remaining)
+            self.reset_at = float(reset)
+            self.refill(now)
+            window_left = max(self.reset_at - now, 1)
+            self.rate = self.remaining / window_left
+            if self.remaining <= 0:
+                self.tokens = 0
+
+def parse_retry_after(value):
+    """Seconds to wait from a Retry-After header in delta-seconds or HTTP-date form, or the default."""
+    if not value:
+        return DEFAULT_RETRY_AFTER
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time())
+    except (TypeError, ValueError):
+        return DEFAULT_RETRY_AFTER
+
+def for_account(account, endpoint):
+    """Return the limiter name of an endpoint within the budget of a single mirror pair."""
+    return f"{account.name}:{endpoint}"
+
+def get_limiter(name):
+    """Return the shared limiter for an endpoint, creating it on first use."""
+    limiter = _limiters.get(name)
+    if limiter is None:
+        with _limiters_lock:
+            limiter = _limiters.get(name)
+            if limiter is None:
+                limiter = RateLimiter(name, Config.RATE_LIMIT_BURST)
+                _limiters[name] = limiter
+    return limiter
@@ -0,0 +1,211 @@
+import logging
+import threading
+from collections import OrderedDict
+from time import time
+from requests.exceptions import RequestException
+from diskcache import Cache
+import http_client
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+# getProfiles accepts at most this many actors per request
+PROFILES_BATCH_SIZE = 25
+
+def get_pds_endpoint(did_doc):
+    """Extract the PDS service endpoint from a DID document, or None if it has none."""
+    for service in did_doc.get('service', []):
+        if service.get('id', '').endswith('#atproto_pds') or service.get('type') == 'AtprotoPersonalDataServer':
+            return service.get('serviceEndpoint', '').rstrip('/') or None
+    return None
+
+def split_post_uri(uri):
+    """Split an at:// post URI into its authority (normally a DID) and record key."""
+    parts = (uri or '').split('/')
+    if len(parts) < 5 or parts[0] != 'at:':
+        return None, None
+    return parts[2], parts[-1]
+
+class Resolver:
+    """
+    Handle→DID and DID→PDS lookups, cached for `ttl` seconds in a bounded in-process LRU and
+    optionally in a diskcache.Cache shared with later runs.
+
+    Lookups that definitively fail (an unknown handle, a DID document without a PDS) are cached
+    for `negative_ttl` seconds so they aren't repeated on every request. Transient failures
+    (network errors, 5xx) are not cached. Failed lookups return None.
+    """
+
+    def __init__(self, appview_url, plc_url='https://plc.directory', disk_cache=None,
+                 ttl=24 * 3600, negative_ttl=300, max_items=4096):
+        self.appview_url = appview_url.rstrip('/')
+        self.plc_url = plc_url.rstrip('/')
+        self.disk_cache = disk_cache
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_items = max_items
+        self.lock = threading.Lock()
+        self.memory = OrderedDict()
+
+    def lookup(self, key):
+        """Return (found, value) for a cached lookup; value is None for a cached failure."""
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None:
+                if entry[1] > time():
+                    self.memory.move_to_end(key)
+                    return True, entry[0]
+                del self.memory[key]
+
+        if self.disk_cache is not None:
+            entry = self.disk_cache.get(f"resolve:{key}")
+            if entry is not None:
+                self.remember_entry(key, entry)
+                return True, entry[0]
+        return False, None
+
+    def remember_entry(self, key, entry):
+        with self.lock:
+            self.memory[key] = entry
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.max_items:
+                self.memory.popitem(last=False)
+
+    def store(self, key, value):
+        """Cache a lookup result; None is cached as a failure for the shorter negative TTL."""
+        ttl = self.ttl if value is not None else self.negative_ttl
+        entry = (value, time() + ttl)
+        self.remember_entry(key, entry)
+        if self.disk_cache is not None:
+            self.disk_cache.set(f"resolve:{key}", entry, expire=ttl)
+
+    def remember(self, handle, did):
+        """Record a handle→DID pair that is already known, e.g. from a post view or a session."""
+        self.store(f"handle:{handle.lower()}", did)
+
+    def resolve_handle(self, handle):
+        """Resolve a handle to its DID. DIDs are returned as they are."""
+        if not handle or handle.startswith('did:'):
+            return handle
+        key = f"handle:{handle.lower()}"
+        found, did = self.lookup(key)
+        if found:
+            return did
+
+        try:
+            response = http_client.get(f"{self.appview_url}/xrpc/com.atproto.identity.resolveHandle", params={"handle": handle})
+        except RequestException as e:
+            logger.warning(f"Failed to resolve handle {handle}: {e}")
+            return None
+        if response.status_code in (400, 404):
+            logger.warning(f"Handle {handle} does not resolve")
+            self.store(key, None)
+            return None
+        if response.status_code != 200:
+            logger.warning(f"Failed to resolve handle {handle}. Status code: {response.status_code}")
+            return None
+
+        did = response.json().get('did')
+        self.store(key, did)
+        return did
+
+    def resolve_handles(self, handles):
+        """
+        Resolve many handles at once, with one getProfiles request per 25 uncached handles.
+        Returns a dict of handle to DID (or None when it doesn't resolve).
+        """
+        resolved = {}
+        missing = []
+        for handle in dict.fromkeys(handles):
+            if not handle or handle.startswith('did:'):
+                resolved[handle] = handle
+                continue
+            found, did = self.lookup(f"handle:{handle.lower()}")
+            if found:
+                resolved[handle] = did
+            else:
+                missing.append(handle)
+
+        for start in range(0, len(missing), PROFILES_BATCH_SIZE):
+            batch = missing[start:start + PROFILES_BATCH_SIZE]
+            try:
+                response = http_client.get(f"{self.appview_url}/xrpc/app.bsky.actor.getProfiles", params={"actors": batch})
+            except RequestException as e:
+                logger.warning(f"Failed to resolve {len(batch)} handles: {e}")
+                continue
+            if response.status_code != 200:
+                # Some AppViews reject a whole batch for one bad handle; fall back to single lookups
+                logger.warning(f"Failed to resolve {len(batch)} handles. Status code: {response.status_code}")
+                resolved.update((handle, self.resolve_handle(handle)) for handle in batch)
+                continue
+
+            profiles = {profile.get('handle', '').lower(): profile.get('did') for profile in response.json().get('profiles', [])}
+            for handle in batch:
+                did = profiles.get(handle.lower())
+                self.store(f"handle:{handle.lower()}", did)
+                resolved[handle] = did
+        return resolved
+
+    def resolve_did_document(self, did):
+        """Fetch the DID document of a did:plc or did:web identity (uncached). Returns None if that fails."""
+        if did.startswith('did:plc:'):
+            did_doc_url = f"{self.plc_url}/{did}"
+        elif did.startswith('did:web:'):
+            did_doc_url = f"https://{did[len('did:web:'):]}/.well-known/did.json"
+        else:
+            logger.warning(f"Unsupported DID method: {did}")
+            return None
+
+        try:
+            response = http_client.get(did_doc_url)
+        except RequestException as e:
+            logger.warning(f"Failed to resolve DID document for {did}: {e}")
+            return None
+        if response.status_code != 200:
+            logger.warning(f"Failed to resolve DID document for {did}. Status code: {response.status_code}")
+            return None
+        return response.json()
+
+    def resolve_pds(self, did):
+        """Resolve a DID to the URL of its PDS."""
+        key = f"pds:{did}"
+        found, pds_url = self.lookup(key)
+        if found:
+            return pds_url
+
+        did_doc = self.resolve_did_document(did)
+        if did_doc is None:
+            return None
+        pds_url = get_pds_endpoint(did_doc)
+        self.store(key, pds_url)
+        return pds_url
+
+# Resolver of the mirror, shared by every account
+_resolver = None
+_resolver_lock = threading.Lock()
+
+def get_resolver():
+    """Return the mirror's resolver, configured from Config on first use."""
+    global _resolver
+    with _resolver_lock:
+        if _resolver is None:
+            _resolver = Resolver(
+                Config.BLUESKY_APPVIEW_URL,
+                Config.PLC_DIRECTORY_URL,
+                disk_cache=Cache(Config.RESOLVER_CACHE_DIR),
+                ttl=Config.RESOLVER_TTL,
+                negative_ttl=Config.RESOLVER_NEGATIVE_TTL
+            )
+        return _resolver
+
+def get_post_url(uri):
+    """
+    Build the bsky.app URL of a post from its at:// URI. The URL names the author by DID, which
+    bsky.app accepts in place of the handle, so it keeps working after the author renames.
+    """
+    actor, post_id = split_post_uri(uri)
+    if not actor or not post_id:
+        return None
+    if not actor.startswith('did:'):
+        actor = get_resolver().resolve_handle(actor) or actor
+    return f"https://bsky.app/profile/{actor}/post/{post_id}"
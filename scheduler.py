@@ -0,0 +1,28 @@
+import random
+
+class PollScheduler:
+    """
+    Adaptive poll interval. Drops to the minimum right after new posts show up and backs off
+    exponentially while polls come back empty, never leaving the configured bounds.
+    The current interval is kept in `interval` for monitoring; the mirror exports it as the
+    mirror_poll_interval_seconds gauge.
+    """
+
+    def __init__(self, min_interval, max_interval, backoff=2.0, jitter=0.1):
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.backoff = backoff
+        self.jitter = jitter
+        self.interval = self.min_interval
+
+    def record_poll(self, new_post_count):
+        """Adjust the interval to the outcome of a poll."""
+        if new_post_count:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.max_interval, self.interval * self.backoff)
+
+    def next_delay(self):
+        """Return the seconds to sleep before the next poll, with jitter applied."""
+        delay = self.interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+        return min(self.max_interval, max(self.min_interval, delay))
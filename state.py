@@ -0,0 +1,250 @@
+import json
+import sqlite3
+import threading
+import time
+from config import Config
+
+# Outbox item states, in the order an item moves through them
+OUTBOX_PENDING = 'pending'
+OUTBOX_MEDIA_UPLOADED = 'media_uploaded'
+OUTBOX_TWEETING = 'tweeting'
+OUTBOX_TWEETED = 'tweeted'
+OUTBOX_FAILED = 'failed'
+
+OUTBOX_COLUMNS = ('uri', 'post', 'status', 'media_ids', 'media_uploaded_at', 'tweet_id', 'attempts', 'last_error')
+
+class StateStore:
+    """
+    Durable record of the Bluesky posts that were already processed and the tweets they became.
+    Loaded once at startup into an in-memory set for constant-time lookups; every change is
+    committed to SQLite (WAL mode) right away so a crash never loses or corrupts the history.
+
+    New posts first go into an outbox that tracks each step (media uploaded, tweet posted,
+    reply posted), so after a restart only the unfinished steps are resumed.
+    """
+
+    def __init__(self, path=None):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path or Config.STATE_DB_FILE, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS processed_posts (
+                uri TEXT PRIMARY KEY,
+                tweet_id TEXT,
+                processed_at REAL NOT NULL
+            )
+        """)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS outbox (
+                uri TEXT PRIMARY KEY,
+                post TEXT NOT NULL,
+                status TEXT NOT NULL,
+                media_ids TEXT,
+                media_uploaded_at REAL,
+                tweet_id TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                last_error TEXT,
+                created_at REAL NOT NULL
+            )
+        """)
+        # Posts of the full author feed collected by a backfill, and how far the feed was paged
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS backfill_posts (
+                uri TEXT PRIMARY KEY,
+                indexed_at TEXT NOT NULL,
+                post TEXT NOT NULL,
+                queued INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS backfill_posts_order ON backfill_posts (queued, indexed_at)")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS backfill_progress (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                cursor TEXT,
+                pages INTEGER NOT NULL DEFAULT 0,
+                complete INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        self.conn.commit()
+        self.processed_uris = {row[0] for row in self.conn.execute("SELECT uri FROM processed_posts")}
+        self.outbox_uris = {row[0] for row in self.conn.execute("SELECT uri FROM outbox")}
+
+    def import_posts(self, posts):
+        """Record posts from an older state file as processed without tweet ids."""
+        with self.lock:
+            with self.conn:
+                self.conn.executemany(
+                    "INSERT OR IGNORE INTO processed_posts (uri, tweet_id, processed_at) VALUES (?, NULL, ?)",
+                    [(post['uri'], time.time()) for post in posts]
+                )
+            self.processed_uris.update(post['uri'] for post in posts)
+
+    def enqueue(self, posts):
+        """
+        Persist new posts as pending outbox items, keeping the given order.
+        Posts that were processed or queued in the meantime are skipped; the queued ones are returned.
+        """
+        now = time.time()
+        with self.lock:
+            posts = [
+                post for post in posts
+                if post['uri'] not in self.processed_uris and post['uri'] not in self.outbox_uris
+            ]
+            with self.conn:
+                self.conn.executemany(
+                    "INSERT OR IGNORE INTO outbox (uri, post, status, created_at) VALUES (?, ?, ?, ?)",
+                    [(post['uri'], json.dumps(post), OUTBOX_PENDING, now) for post in posts]
+                )
+            self.outbox_uris.update(post['uri'] for post in posts)
+        return posts
+
+    def pending_items(self):
+        """Return the unfinished outbox items in the order they were queued."""
+        with self.lock:
+            rows = self.conn.execute(
+                f"SELECT {', '.join(OUTBOX_COLUMNS)} FROM outbox WHERE status != ? ORDER BY rowid",
+                (OUTBOX_FAILED,)
+            ).fetchall()
+
+        items = []
+        for row in rows:
+            item = dict(zip(OUTBOX_COLUMNS, row))
+            item['post'] = json.loads(item['post'])
+            item['media_ids'] = json.loads(item['media_ids']) if item['media_ids'] is not None else None
+            items.append(item)
+        return items
+
+    def update_item(self, uri, **fields):
+        """Update the given columns of an outbox item."""
+        if 'media_ids' in fields and fields['media_ids'] is not None:
+            fields['media_ids'] = json.dumps(fields['media_ids'])
+        assignments = ', '.join(f"{column} = ?" for column in fields)
+        with self.lock:
+            with self.conn:
+                self.conn.execute(f"UPDATE outbox SET {assignments} WHERE uri = ?", (*fields.values(), uri))
+
+    def record_failure(self, uri, error, status):
+        """
+        Count a failed attempt and put the item back into the given state,
+        or give up on it once it failed too often. Returns whether the item will be retried.
+        """
+        with self.lock:
+            with self.conn:
+                self.conn.execute("""
+                    UPDATE outbox SET
+                        attempts = attempts + 1,
+                        last_error = ?,
+                        status = CASE WHEN attempts + 1 >= ? THEN ? ELSE ? END
+                    WHERE uri = ?
+                """, (str(error), Config.OUTBOX_MAX_ATTEMPTS, OUTBOX_FAILED, status, uri))
+                row = self.conn.execute("SELECT status FROM outbox WHERE uri = ?", (uri,)).fetchone()
+        return row is not None and row[0] != OUTBOX_FAILED
+
+    def complete(self, uri, tweet_id):
+        """Move a fully mirrored item from the outbox into the processed posts."""
+        with self.lock:
+            with self.conn:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO processed_posts (uri, tweet_id, processed_at) VALUES (?, ?, ?)",
+                    (uri, tweet_id, time.time())
+                )
+                self.conn.execute("DELETE FROM outbox WHERE uri = ?", (uri,))
+            self.processed_uris.add(uri)
+            self.outbox_uris.discard(uri)
+
+    def recover_interrupted(self):
+        """
+        Park items whose tweet request was in flight when the process stopped.
+        The tweet may or may not have been posted, so they are not retried automatically.
+        Returns the URIs of the parked items.
+        """
+        with self.lock:
+            with self.conn:
+                uris = [row[0] for row in self.conn.execute(
+                    "SELECT uri FROM outbox WHERE status = ?", (OUTBOX_TWEETING,)
+                )]
+                self.conn.execute(
+                    "UPDATE outbox SET status = ?, last_error = ? WHERE status = ?",
+                    (OUTBOX_FAILED, "Interrupted while tweeting; check Twitter before retrying", OUTBOX_TWEETING)
+                )
+        return uris
+
+    def retry_failed(self):
+        """Put every failed outbox item back into the queue with a fresh attempt count."""
+        with self.lock:
+            with self.conn:
+                self.conn.execute("""
+                    UPDATE outbox SET
+                        attempts = 0,
+                        status = CASE WHEN tweet_id IS NOT NULL THEN ? ELSE ? END
+                    WHERE status = ?
+                """, (OUTBOX_TWEETED, OUTBOX_PENDING, OUTBOX_FAILED))
+
+    def get_backfill_progress(self):
+        """Return the feed cursor to continue the backfill scan from, the pages scanned so far and whether the scan is complete."""
+        with self.lock:
+            row = self.conn.execute("SELECT cursor, pages, complete FROM backfill_progress WHERE id = 1").fetchone()
+        if row is None:
+            return None, 0, False
+        return row[0], row[1], bool(row[2])
+
+    def save_backfill_page(self, posts, cursor):
+        """
+        Store the new posts of one scanned feed page together with the cursor of the next page,
+        in one transaction so an interrupted scan neither loses nor refetches a page.
+        Without a next cursor the scan is complete.
+        """
+        with self.lock:
+            posts = [
+                post for post in posts
+                if post['uri'] not in self.processed_uris and post['uri'] not in self.outbox_uris
+            ]
+            with self.conn:
+                self.conn.executemany(
+                    "INSERT OR IGNORE INTO backfill_posts (uri, indexed_at, post) VALUES (?, ?, ?)",
+                    [(post['uri'], post.get('indexed_at') or '', json.dumps(post)) for post in posts]
+                )
+                self.conn.execute("""
+                    INSERT INTO backfill_progress (id, cursor, pages, complete) VALUES (1, ?, 1, ?)
+                    ON CONFLICT (id) DO UPDATE SET cursor = excluded.cursor, pages = pages + 1, complete = excluded.complete
+                """, (cursor, int(cursor is None)))
+
+    def next_backfill_batch(self, limit):
+        """Return the oldest backfill posts that were not queued yet."""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT post FROM backfill_posts WHERE queued = 0 ORDER BY indexed_at, uri LIMIT ?", (limit,)
+            ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def enqueue_backfill(self, posts):
+        """
+        Move backfill posts into the outbox, keeping the given order, and mark them as queued in
+        the same transaction. Returns the posts that were queued.
+        """
+        now = time.time()
+        with self.lock:
+            new_posts = [
+                post for post in posts
+                if post['uri'] not in self.processed_uris and post['uri'] not in self.outbox_uris
+            ]
+            with self.conn:
+                self.conn.executemany(
+                    "INSERT OR IGNORE INTO outbox (uri, post, status, created_at) VALUES (?, ?, ?, ?)",
+                    [(post['uri'], json.dumps(post), OUTBOX_PENDING, now) for post in new_posts]
+                )
+                self.conn.executemany(
+                    "UPDATE backfill_posts SET queued = 1 WHERE uri = ?", [(post['uri'],) for post in posts]
+                )
+            self.outbox_uris.update(post['uri'] for post in new_posts)
+        return new_posts
+
+    def count_backfill_remaining(self):
+        """Return how many backfill posts were not queued yet."""
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM backfill_posts WHERE queued = 0").fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,224 @@
+import json
+from time import time
+import pytest
+import bench_standins
+from bench_standins import BENCH_DID, BENCH_HANDLE, QUOTED_DID, make_jwt
+import bluesky
+import resolver
+from bluesky import BlueskySession, get_session, get_bsky_posts, commit_feed_position, is_seen_feed_item, load_feed_state, filter_posts, filter_post_record
+from config import Config, Account
+
+@pytest.fixture
+def standin(monkeypatch, tmp_path):
+    standin, base_url = bench_standins.start(bench_standins.default_options(posts=5, delay=0, latency=0, image_size=1, video_size=1))
+    # Session, feed position and resolver cache files go to a scratch directory
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(Config, 'BLUESKY_AUTH_URL', base_url)
+    monkeypatch.setattr(Config, 'BLUESKY_CDN_URL', base_url)
+    monkeypatch.setattr(bluesky, 'sessions', {})
+    monkeypatch.setattr(bluesky, 'pending_feed_states', {})
+    monkeypatch.setattr(resolver, '_resolver', None)
+    yield standin
+    for session in bluesky.sessions.values():
+        if session.timer is not None:
+            session.timer.cancel()
+
+@pytest.fixture
+def account(standin):
+    keys = {'api_key': 'key', 'api_secret_key': 'secret', 'access_token': 'token', 'access_token_secret': 'token secret'}
+    return Account('test', keys, {
+        'username': BENCH_HANDLE,
+        'password': 'password',
+        'identifier': 'test@example.com',
+        'did': BENCH_DID,
+        'pds_url': standin.base_url
+    })
+
+def publish(standin, count):
+    """Add text posts to the stand-in feed, published (a millisecond apart) right after the existing ones."""
+    start = len(standin.posts)
+    for index in range(start, start + count):
+        standin.posts.append(standin.make_post(index, 'text', standin.posts[-1]['published_at'] + 0.001))
+    return [f"at://{BENCH_DID}/app.bsky.feed.post/{post['rkey']}" for post in standin.posts[start:]]
+
+def make_post(standin, index, kind, images=0):
+    return standin.make_post(index, kind, 1700000000 + index) | {'images': images}
+
+def filter_views(standin, account, *posts):
+    return filter_posts({'feed': [{'post': standin.post_view(post)} for post in posts]}, account)
+
+def count(standin, name):
+    return standin.stats()['counters'].get(name, 0)
+
+def feed_requests(standin):
+    return count(standin, 'feed_requests')
+
+def make_session(account, access_ttl, refresh_ttl):
+    """A session whose tokens expire in the given seconds (None for a token without an expiry)."""
+    session = BlueskySession(account)
+    session.access_jwt = make_jwt(BENCH_DID, time() + access_ttl) if access_ttl is not None else 'opaque'
+    session.refresh_jwt = make_jwt(BENCH_DID, time() + refresh_ttl) if refresh_ttl is not None else 'opaque'
+    return session
+
+def test_seen_feed_items():
+    feed_state = {'indexedAt': '2024-01-01T00:00:10Z', 'cid': 'bafynewest'}
+
+    def feed_item(cid, indexed_at, reposted_at=None):
+        item = {'post': {'cid': cid, 'indexedAt': indexed_at}}
+        if reposted_at:
+            item['reason'] = {'$type': 'app.bsky.feed.defs#reasonRepost', 'indexedAt': reposted_at}
+        return item
+
+    assert is_seen_feed_item(feed_item('bafynewest', '2024-01-01T00:00:11Z'), feed_state)
+    assert is_seen_feed_item(feed_item('bafyolder', '2024-01-01T00:00:09Z'), feed_state)
+    assert not is_seen_feed_item(feed_item('bafynewer', '2024-01-01T00:00:11Z'), feed_state)
+    # Reposts are ordered by the time of the repost, not of the reposted post
+    assert not is_seen_feed_item(feed_item('bafyold', '2023-01-01T00:00:00Z', '2024-01-01T00:00:12Z'), feed_state)
+
+def test_polls_follow_the_cursor_until_a_seen_post(standin, account, monkeypatch):
+    monkeypatch.setattr(Config, 'BLUESKY_PAGE_LIMIT', 3)
+    monkeypatch.setattr(Config, 'BLUESKY_PROBE_LIMIT', 2)
+
+    # The first poll only looks at the newest page
+    first = get_bsky_posts(account)
+    assert len(first) == 3
+    commit_feed_position(account)
+    assert load_feed_state(account)['uri'] == first[0]['uri']
+
+    # A burst larger than the probe and one page is paged through completely
+    before = feed_requests(standin)
+    burst = publish(standin, 7)
+    assert [post['uri'] for post in get_bsky_posts(account)] == burst[::-1]
+    # A probe of 2, then pages of 3 until the seen post shows up on the third
+    assert feed_requests(standin) - before == 3
+    commit_feed_position(account)
+
+    # A quiet poll costs a single probe request
+    before = feed_requests(standin)
+    assert get_bsky_posts(account) == []
+    assert feed_requests(standin) - before == 1
+
+def test_position_is_only_saved_when_committed(standin, account):
+    get_bsky_posts(account)
+    assert load_feed_state(account) is None
+    commit_feed_position(account)
+    assert load_feed_state(account) is not None
+
+def test_unreadable_feed_position_is_ignored(standin, account, monkeypatch):
+    monkeypatch.setattr(Config, 'BLUESKY_PAGE_LIMIT', 3)
+    with open(account.feed_state_file, 'w') as f:
+        f.write('{"indexedAt": "2024-')
+
+    assert load_feed_state(account) is None
+    assert len(get_bsky_posts(account)) == 3
+    commit_feed_position(account)
+    assert load_feed_state(account)['cid'] is not None
+
+def test_only_top_level_posts_of_the_account_are_kept(standin, account):
+    own, renamed, other, reply = (standin.post_view(make_post(standin, index, 'text')) for index in range(1, 5))
+    # Authors are matched by DID, so posts from before a rename still count
+    renamed['author']['handle'] = 'old-name.test'
+    other['author'] = {'did': QUOTED_DID, 'handle': BENCH_HANDLE}
+    reply['record']['reply'] = {'root': {'uri': own['uri']}, 'parent': {'uri': own['uri']}}
+
+    posts = filter_posts({'feed': [{'post': view} for view in (own, renamed, other, reply)]}, account)
+
+    assert [post['uri'] for post in posts] == [own['uri'], renamed['uri']]
+    assert posts[0]['type'] == 'text'
+    assert posts[0]['media'] == []
+    assert posts[0]['text'].startswith('bench post 1 ')
+
+def test_image_and_video_embeds_become_media(standin, account):
+    images, video = filter_views(standin, account, make_post(standin, 1, 'images', images=2), make_post(standin, 2, 'video'))
+
+    assert images['type'] == 'media'
+    assert images['media'] == [
+        {'type': 'image', 'url': f"{standin.base_url}/img/feed_fullsize/plain/{BENCH_DID}/bafyimg1x{i}@jpeg", 'cid': f"bafyimg1x{i}"}
+        for i in range(2)
+    ]
+    assert video['type'] == 'media'
+    assert video['media'] == [{
+        'type': 'video',
+        'url': f"{standin.base_url}/xrpc/com.atproto.sync.getBlob?did={BENCH_DID}&cid=bafyvideo2",
+        'cid': 'bafyvideo2'
+    }]
+
+def test_quote_links_the_quoted_post_by_did(standin, account):
+    quote, = filter_views(standin, account, make_post(standin, 1, 'quote'))
+
+    assert quote['type'] == 'quote'
+    assert quote['quoted_post_url'] == f"https://bsky.app/profile/{QUOTED_DID}/post/quoted000001"
+    # The media of the quoted post belongs to that post, not to the quote
+    assert quote['media'] == []
+    # Previews of the post and of the quoted post, keyed like the links in the tweets
+    assert [(preview['handle'], preview['post_id']) for preview in quote['previews']] == [
+        (BENCH_DID, 'bench000001'), (QUOTED_DID, 'quoted000001')
+    ]
+
+def test_quote_with_media_keeps_both(standin, account):
+    images_view = standin.post_view(make_post(standin, 1, 'images', images=2))
+    quote_view = standin.post_view(make_post(standin, 1, 'quote'))
+    quote_view['embed'] = {
+        '$type': 'app.bsky.embed.recordWithMedia#view',
+        'record': {'$type': 'app.bsky.embed.record#view', 'record': quote_view['embed']['record']},
+        'media': images_view['embed']
+    }
+
+    quote, = filter_posts({'feed': [{'post': quote_view}]}, account)
+    assert quote['type'] == 'quote'
+    assert quote['quoted_post_url'] == f"https://bsky.app/profile/{QUOTED_DID}/post/quoted000001"
+    assert [media['cid'] for media in quote['media']] == ['bafyimg1x0', 'bafyimg1x1']
+
+@pytest.mark.parametrize('kind, images', [('text', 0), ('images', 3), ('video', 0), ('quote', 0)])
+def test_stream_records_decode_like_feed_views(standin, account, kind, images):
+    post = make_post(standin, 1, kind, images)
+    from_feed, = filter_views(standin, account, post)
+    from_stream, = filter_post_record(account, BENCH_DID, post['rkey'], f"bafypost{post['index']}", standin.post_record(post))
+
+    for field in ('uri', 'text', 'type', 'media', 'quoted_post_url', 'author_handle'):
+        assert from_stream[field] == from_feed[field]
+
+def test_stream_replies_are_skipped(standin, account):
+    record = standin.post_record(make_post(standin, 1, 'text'))
+    record['reply'] = {'root': {'uri': 'at://x/app.bsky.feed.post/1'}, 'parent': {'uri': 'at://x/app.bsky.feed.post/1'}}
+    assert filter_post_record(account, BENCH_DID, 'bench000001', 'bafypost1', record) == []
+
+def test_first_use_logs_in_and_saves_the_session(standin, account):
+    token = get_session(account).access_token()
+    assert count(standin, 'logins') == 1
+    with open(account.session_file, 'r') as f:
+        assert json.load(f)['accessJwt'] == token
+
+    # A restart picks the saved session up instead of logging in again
+    assert BlueskySession(account).access_token() == token
+    assert count(standin, 'logins') == 1
+
+def test_valid_token_is_used_as_it_is(standin, account):
+    session = make_session(account, 3600, 3600)
+    token = session.access_jwt
+    assert session.access_token() == token
+    assert count(standin, 'refreshes') + count(standin, 'logins') == 0
+
+def test_token_about_to_expire_is_refreshed(standin, account):
+    session = make_session(account, 60, 3600)
+    token = session.access_jwt
+    assert session.access_token() != token
+    assert (count(standin, 'refreshes'), count(standin, 'logins')) == (1, 0)
+
+def test_expired_refresh_token_falls_back_to_a_login(standin, account):
+    session = make_session(account, -60, -60)
+    session.access_token()
+    # The refresh token is known to be expired, so it isn't even tried
+    assert (count(standin, 'rejected_refreshes'), count(standin, 'logins')) == (0, 1)
+
+def test_rejected_refresh_falls_back_to_a_login(standin, account):
+    session = make_session(account, -60, None)
+    session.access_token()
+    assert (count(standin, 'rejected_refreshes'), count(standin, 'logins')) == (1, 1)
+
+def test_legacy_token_file_is_picked_up(standin, account):
+    token = make_jwt(BENCH_DID, time() + 3600)
+    with open(account.token_file, 'w') as f:
+        f.write(token + '\n')
+    assert BlueskySession(account).access_token() == token
+    assert count(standin, 'logins') == 0
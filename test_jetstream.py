@@ -0,0 +1,66 @@
+import json
+from urllib.parse import parse_qs, urlsplit
+import pytest
+import jetstream
+from jetstream import JetstreamSubscriber, CURSOR_REWIND_US, load_cursor
+from config import Config
+
+DID = 'did:plc:test'
+
+class Connection:
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+@pytest.fixture(autouse=True)
+def cursor_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(Config, 'JETSTREAM_CURSOR_FILE', str(tmp_path / 'cursor.json'))
+    monkeypatch.setattr(Config, 'JETSTREAM_CURSOR_INTERVAL', 0)
+    monkeypatch.setattr(Config, 'JETSTREAM_RECORD_FILE', None)
+
+def make_event(time_us, did=DID, collection=jetstream.POST_COLLECTION, operation='create'):
+    return json.dumps({
+        'did': did,
+        'time_us': time_us,
+        'kind': 'commit',
+        'commit': {'operation': operation, 'collection': collection, 'rkey': f"post{time_us}", 'record': {'text': 'hi'}}
+    })
+
+def test_only_post_creates_of_the_wanted_dids_are_handled():
+    handled = []
+    subscriber = JetstreamSubscriber([DID], lambda did, commit: handled.append(commit['rkey']), lambda: None)
+    connection = Connection()
+    for message in (make_event(1), make_event(2, did='did:plc:other'), make_event(3, operation='delete'),
+                    make_event(4, collection='app.bsky.feed.like'), make_event(5)):
+        subscriber.handle_message(connection, message)
+
+    assert handled == ['post1', 'post5']
+    # Every event moves the cursor, handled or not
+    assert load_cursor() == 5
+
+def test_failed_event_is_read_again_after_a_reconnect():
+    def on_post(did, commit):
+        raise Exception("state store unavailable")
+
+    subscriber = JetstreamSubscriber([DID], on_post, lambda: None)
+    subscriber.cursor = 1
+    connection = Connection()
+    subscriber.handle_message(connection, make_event(2))
+
+    assert connection.closed
+    assert subscriber.cursor == 1
+
+def test_reconnect_resumes_before_the_saved_cursor():
+    subscriber = JetstreamSubscriber([DID], lambda did, commit: None, lambda: None)
+    subscriber.handle_message(Connection(), make_event(10 * CURSOR_REWIND_US))
+
+    query = parse_qs(urlsplit(JetstreamSubscriber([DID], None, None).get_url()).query)
+    assert query['wantedDids'] == [DID]
+    assert query['wantedCollections'] == [jetstream.POST_COLLECTION]
+    assert query['cursor'] == [str(9 * CURSOR_REWIND_US)]
+
+def test_first_connection_has_no_cursor():
+    query = parse_qs(urlsplit(JetstreamSubscriber([DID], None, None).get_url()).query)
+    assert 'cursor' not in query
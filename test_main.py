@@ -0,0 +1,121 @@
+from types import SimpleNamespace
+import pytest
+import main
+from config import Config
+from state import StateStore, OUTBOX_MEDIA_UPLOADED, OUTBOX_PENDING
+
+ACCOUNT = SimpleNamespace(name='test')
+
+@pytest.fixture
+def state(tmp_path):
+    store = StateStore(str(tmp_path / 'state.db'))
+    store.enqueue([{'uri': f"at://did:plc:test/app.bsky.feed.post/post{index}", 'type': 'text', 'text': f"post {index}"}
+                   for index in range(1, 5)])
+    yield store
+    store.close()
+
+@pytest.fixture
+def twitter(monkeypatch):
+    """Stand-in for the Twitter calls of the mirror loop; tweets of the URIs in `failing` get a 503."""
+    twitter = SimpleNamespace(tweeted=[], failing=set())
+
+    def tweet_post(account, post, media_ids=None):
+        if post['uri'] in twitter.failing:
+            return SimpleNamespace(status_code=503)
+        twitter.tweeted.append(post['uri'])
+        return SimpleNamespace(status_code=201, json=lambda: {'data': {'id': str(len(twitter.tweeted))}})
+
+    monkeypatch.setattr(main, 'tweet_post', tweet_post)
+    monkeypatch.setattr(main, 'warm_preview_cache', lambda posts: None)
+    monkeypatch.setattr(main, 'comment_with_original_post', lambda account, tweet_id, post: SimpleNamespace(status_code=201))
+    return twitter
+
+def uris(items):
+    return [item['uri'] for item in items]
+
+def test_tweets_go_out_in_order_and_complete(state, twitter):
+    items = state.pending_items()
+    main.process_posts_and_tweet(ACCOUNT, items, state)
+    assert twitter.tweeted == uris(items)
+    assert state.pending_items() == []
+
+def test_failed_post_holds_back_the_later_ones(state, twitter):
+    items = state.pending_items()
+    twitter.failing.add(items[1]['uri'])
+
+    main.process_posts_and_tweet(ACCOUNT, items, state)
+    assert twitter.tweeted == uris(items[:1])
+    pending = state.pending_items()
+    assert [(item['uri'], item['status'], item['attempts']) for item in pending] == [
+        (items[1]['uri'], OUTBOX_MEDIA_UPLOADED, 1), (items[2]['uri'], OUTBOX_PENDING, 0), (items[3]['uri'], OUTBOX_PENDING, 0)
+    ]
+
+    # Once it goes through, the rest follows in the original order
+    twitter.failing.clear()
+    main.process_posts_and_tweet(ACCOUNT, pending, state)
+    assert twitter.tweeted == uris(items)
+
+def test_post_that_gave_up_no_longer_holds_back_the_queue(state, twitter, monkeypatch):
+    monkeypatch.setattr(Config, 'OUTBOX_MAX_ATTEMPTS', 1)
+    items = state.pending_items()
+    twitter.failing.add(items[1]['uri'])
+
+    main.process_posts_and_tweet(ACCOUNT, items, state)
+    assert twitter.tweeted == [items[0]['uri']] + uris(items[2:])
+    assert state.pending_items() == []
+
+@pytest.fixture
+def feed(monkeypatch, tmp_path):
+    """An author feed of seven posts in pages of three; the scan fails before page `fail_at` while it is set."""
+    posts = [{'uri': f"at://did:plc:test/app.bsky.feed.post/post{index}", 'type': 'text', 'text': f"post {index}",
+              'indexed_at': f"2024-01-01T00:00:{index:02}Z"} for index in range(7, 0, -1)]
+    feed = SimpleNamespace(posts=posts, cursors=[], fail_at=None)
+
+    def iter_feed_pages(account, cursor=None, limit=100):
+        while True:
+            feed.cursors.append(cursor)
+            page = int(cursor or 0)
+            if page == feed.fail_at:
+                raise Exception("Failed to fetch the author feed page")
+            cursor = str(page + 1) if (page + 1) * 3 < len(posts) else None
+            yield posts[page * 3:(page + 1) * 3], cursor
+            if cursor is None:
+                return
+
+    account = SimpleNamespace(name='test', state_db=str(tmp_path / 'backfill.db'), legacy=False, min_refresh=60, max_refresh=600)
+    monkeypatch.setattr(main, 'iter_feed_pages', iter_feed_pages)
+    monkeypatch.setattr(main, 'sleep', lambda seconds: None)
+    monkeypatch.setattr(Config, 'init', lambda: None)
+    monkeypatch.setattr(Config, 'ACCOUNTS', [account])
+    monkeypatch.setattr(Config, 'BACKFILL_BATCH_SIZE', 2)
+    return feed
+
+def test_backfill_resumes_the_scan_and_tweets_oldest_first(feed, twitter):
+    feed.fail_at = 2
+    with pytest.raises(Exception):
+        main.backfill()
+    assert twitter.tweeted == []
+
+    feed.fail_at = None
+    main.backfill()
+    # The second run continues at the cursor of the page that failed
+    assert feed.cursors == [None, '1', '2', '2']
+    assert twitter.tweeted == [post['uri'] for post in reversed(feed.posts)]
+
+def test_backfill_stopped_between_batches_picks_up_the_queued_posts(feed, twitter, monkeypatch):
+    batches = []
+
+    def warm_preview_cache(posts):
+        batches.append(len(posts))
+        if len(batches) == 2:
+            raise KeyboardInterrupt
+    monkeypatch.setattr(main, 'warm_preview_cache', warm_preview_cache)
+
+    with pytest.raises(KeyboardInterrupt):
+        main.backfill()
+    assert twitter.tweeted == [post['uri'] for post in reversed(feed.posts)][:2]
+
+    main.backfill()
+    # The batch queued before the stop goes out first, nothing is tweeted twice
+    assert twitter.tweeted == [post['uri'] for post in reversed(feed.posts)]
+    assert feed.cursors == [None, '1', '2']
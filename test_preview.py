@@ -0,0 +1,200 @@
+import gzip
+import os
+import threading
+import time
+import pytest
+from diskcache import Cache
+from preview_cache import PreviewCache
+
+DID = 'did:plc:test'
+CRAWLER = {'User-Agent': 'Twitterbot/1.0'}
+
+class Interrupted(BaseException):
+    """Stands in for GreenletExit and gevent.Timeout, which aren't Exceptions."""
+
+@pytest.fixture(scope='module')
+def preview(tmp_path_factory):
+    # The module opens its disk cache in the working directory when it is imported
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp('preview'))
+    try:
+        import preview
+    finally:
+        os.chdir(cwd)
+    return preview
+
+@pytest.fixture
+def client(preview, monkeypatch, tmp_path):
+    """A test client of the preview server with an empty cache and warming enabled."""
+    with Cache(str(tmp_path / 'cache')) as disk_cache:
+        monkeypatch.setattr(preview, 'preview_cache', PreviewCache(disk_cache))
+        monkeypatch.setattr(preview, 'warm_token', 'secret')
+        monkeypatch.setattr(preview, 'public_url', None)
+        yield preview.app.test_client()
+
+def post_data(**overrides):
+    return {
+        'display_name': 'Test', 'text': 'hello', 'image_url': f"https://cdn.bsky.app/img/feed_fullsize/plain/{DID}/bafyimg@jpeg",
+        'bluesky_url': f"https://bsky.app/profile/{DID}/post/post1"
+    } | overrides
+
+def warm(client, payload):
+    return client.post('/preview/warm', json=payload, headers={'Authorization': 'Bearer secret'})
+
+def run_concurrently(flights, key, fn, count):
+    """Call flights.do from `count` threads at once; returns each thread's result or exception."""
+    outcomes = [None] * count
+
+    def call(index):
+        try:
+            outcomes[index] = flights.do(key, fn)
+        except BaseException as e:
+            outcomes[index] = e
+
+    threads = [threading.Thread(target=call, args=(index,)) for index in range(count)]
+    for thread in threads:
+        thread.start()
+    return threads, outcomes
+
+def blocking(release, result):
+    """A call that counts how often it ran and only finishes once released."""
+    calls = []
+
+    def fn():
+        calls.append(1)
+        release.wait(5)
+        if isinstance(result, BaseException):
+            raise result
+        return result
+    return fn, calls
+
+def test_concurrent_calls_share_one_run(preview):
+    flights, release = preview.SingleFlight(), threading.Event()
+    fn, calls = blocking(release, 'card')
+
+    threads, outcomes = run_concurrently(flights, 'post', fn, 5)
+    # Let the followers pile up behind the leader
+    time.sleep(0.2)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert outcomes == ['card'] * 5
+    assert flights.calls == {}
+
+def test_different_keys_run_separately(preview):
+    flights = preview.SingleFlight()
+    assert flights.do('a', lambda: 1) == 1
+    assert flights.do('b', lambda: 2) == 2
+    # Finished calls are not cached, the next call runs again
+    assert flights.do('a', lambda: 3) == 3
+
+@pytest.mark.parametrize('error', [ValueError("upstream failed"), Interrupted()])
+def test_leader_failure_reaches_the_followers(preview, error):
+    flights, release = preview.SingleFlight(), threading.Event()
+    fn, calls = blocking(release, error)
+
+    threads, outcomes = run_concurrently(flights, 'post', fn, 3)
+    time.sleep(0.2)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    # Nobody is left waiting, and everyone sees the leader's exception
+    assert not any(thread.is_alive() for thread in threads)
+    assert len(calls) == 1
+    assert outcomes == [error] * 3
+    assert flights.do('post', lambda: 'retried') == 'retried'
+
+def test_warmed_posts_are_cached(preview, client):
+    response = warm(client, {'posts': [
+        {'handle': DID, 'post_id': 'post1', 'data': post_data()},
+        {'handle': DID, 'post_id': 'post2', 'data': post_data(image_url=None)}
+    ]})
+    assert response.status_code == 200
+    assert response.get_json() == {'warmed': 2}
+    entry, fresh = preview.preview_cache.get(f"post:{DID}/post2")
+    assert fresh and entry['data']['image_url'] is None
+
+def test_warming_needs_the_token(client):
+    response = client.post('/preview/warm', json={'posts': []}, headers={'Authorization': 'Bearer wrong'})
+    assert response.status_code == 401
+
+@pytest.mark.parametrize('payload', [[1], {'posts': 'x'}, {}, 'posts', None])
+def test_malformed_warm_body_is_rejected(client, payload):
+    assert warm(client, payload).status_code == 400
+
+@pytest.mark.parametrize('entry', [
+    'x',
+    1,
+    {'handle': DID, 'post_id': 'post1'},
+    {'handle': DID, 'post_id': 'post1', 'data': ['x']},
+    {'handle': DID, 'post_id': 1, 'data': post_data()},
+    {'handle': '', 'post_id': 'post1', 'data': post_data()},
+    {'handle': DID, 'post_id': 'post1', 'data': post_data(text=['hello'])},
+    {'handle': DID, 'post_id': 'post1', 'data': post_data(image_url=7)},
+    {'handle': DID, 'post_id': 'post1', 'data': post_data(image_url='https://example.com/image.jpg')},
+    {'handle': DID, 'post_id': 'post1', 'data': {key: value for key, value in post_data().items() if key != 'image_url'}},
+])
+def test_malformed_warm_entries_are_skipped(preview, client, entry):
+    response = warm(client, {'posts': [entry, {'handle': DID, 'post_id': 'good', 'data': post_data()}]})
+    assert response.status_code == 200
+    assert response.get_json() == {'warmed': 1}
+    assert preview.preview_cache.get(f"post:{DID}/post1")[0] is None
+
+def get_preview(client, **headers):
+    return client.get(f"/preview/{DID}/post/post1", headers=CRAWLER | headers)
+
+@pytest.fixture
+def warmed(client):
+    warm(client, {'posts': [{'handle': DID, 'post_id': 'post1', 'data': post_data()}]})
+    return client
+
+def test_browsers_are_redirected_to_bluesky(warmed):
+    response = warmed.get(f"/preview/{DID}/post/post1", headers={'User-Agent': 'Mozilla/5.0'})
+    assert response.status_code == 302
+    assert response.headers['Location'] == f"https://bsky.app/profile/{DID}/post/post1"
+
+def test_each_encoding_has_its_own_etag(warmed):
+    plain = get_preview(warmed)
+    compressed = get_preview(warmed, **{'Accept-Encoding': 'gzip'})
+
+    assert 'Content-Encoding' not in plain.headers
+    assert compressed.headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(compressed.data) == plain.data
+    assert b'hello' in plain.data
+    assert compressed.headers['ETag'] == plain.headers['ETag'][:-1] + '-gzip"'
+    assert plain.headers['Vary'] == compressed.headers['Vary'] == 'User-Agent, Accept-Encoding'
+
+def test_matching_etag_gets_a_304(warmed):
+    etag = get_preview(warmed, **{'Accept-Encoding': 'gzip'}).headers['ETag']
+
+    response = get_preview(warmed, **{'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.data == b''
+    assert response.headers['ETag'] == etag
+
+    # The gzip ETag doesn't match the uncompressed representation
+    assert get_preview(warmed, **{'If-None-Match': etag}).status_code == 200
+
+def test_unmodified_preview_gets_a_304(warmed):
+    last_modified = get_preview(warmed).headers['Last-Modified']
+    assert get_preview(warmed, **{'If-Modified-Since': last_modified}).status_code == 304
+
+def test_og_image_is_the_original_without_a_public_url(warmed):
+    assert f'content="{post_data()["image_url"]}"'.encode() in get_preview(warmed).data
+
+def test_og_image_is_the_card_copy_with_a_public_url(preview, client, monkeypatch):
+    monkeypatch.setattr(preview, 'public_url', 'https://preview.example.com/')
+    warm(client, {'posts': [{'handle': DID, 'post_id': 'post1', 'data': post_data()}]})
+    # Whatever host the request came in on
+    response = client.get(f"/preview/{DID}/post/post1", headers=CRAWLER, base_url='http://10.0.0.5:3030')
+    assert f'content="https://preview.example.com/preview/{DID}/post/post1/image"'.encode() in response.data
+
+def test_video_playlists_are_found_on_the_configured_video_cdn():
+    import thumbnails
+    cdn = 'http://localhost:8080'
+    assert thumbnails.get_video_playlist_url(f"{cdn}/watch/{DID}/bafyvideo/thumbnail.jpg", cdn) == f"{cdn}/watch/{DID}/bafyvideo/playlist.m3u8"
+    assert thumbnails.get_video_playlist_url(f"https://video.bsky.app/watch/{DID}/bafyvideo/thumbnail.jpg", cdn) is None
+    assert thumbnails.get_video_playlist_url(f"{cdn}/img/{DID}/bafyimg@jpeg", cdn) is None
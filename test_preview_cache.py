@@ -0,0 +1,74 @@
+import pytest
+from diskcache import Cache
+import preview_cache
+from preview_cache import PreviewCache
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(preview_cache, 'time', clock)
+    return clock
+
+@pytest.fixture
+def disk_cache(tmp_path):
+    with Cache(str(tmp_path / 'cache')) as cache:
+        yield cache
+
+def test_entries_are_fresh_then_stale_then_gone(clock, disk_cache):
+    cache = PreviewCache(disk_cache, ttl=60, stale_ttl=600)
+    cache.set('post', {'text': 'hello'})
+
+    entry, fresh = cache.get('post')
+    assert entry['data'] == {'text': 'hello'}
+    assert fresh
+
+    clock.now += 61
+    entry, fresh = cache.get('post')
+    assert entry['data'] == {'text': 'hello'}
+    assert not fresh
+
+    clock.now += 600
+    assert cache.get('post') == (None, False)
+    assert cache.get('missing') == (None, False)
+
+def test_disk_tier_is_shared_and_refills_memory(clock, disk_cache):
+    PreviewCache(disk_cache).set('post', {'text': 'hello'}, body=b'<html>')
+
+    cache = PreviewCache(disk_cache)
+    entry, fresh = cache.get('post')
+    assert (entry['body'], fresh) == (b'<html>', True)
+    assert 'post' in cache.memory
+
+def test_memory_tier_evicts_least_recently_used(clock, disk_cache):
+    cache = PreviewCache(disk_cache, max_items=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+    assert list(cache.memory) == ['a', 'c']
+    # Evicted entries are still found on disk
+    assert cache.get('b')[0]['data'] == 2
+
+def test_set_body_keeps_the_entry_age(clock, disk_cache):
+    cache = PreviewCache(disk_cache, ttl=60, stale_ttl=600)
+    entry = cache.set('post', {'text': 'hello'})
+
+    clock.now += 61
+    cache.set_body('post', entry, b'<html>')
+    entry, fresh = cache.get('post')
+    assert entry['body'] == b'<html>'
+    assert not fresh
+
+def test_video_thumbnails_point_at_the_given_video_cdn():
+    embed = {'$type': 'app.bsky.embed.video#view', 'cid': 'bafyvideo'}
+    assert preview_cache.get_embed_image_url(embed, 'did:plc:test') == "https://video.bsky.app/watch/did:plc:test/bafyvideo/thumbnail.jpg"
+    quote = {'$type': 'app.bsky.embed.record#view', 'record': {'author': {'did': 'did:plc:quoted'}, 'embeds': [embed]}}
+    assert preview_cache.get_embed_image_url(quote, 'did:plc:test', 'http://localhost:8080') == \
+        "http://localhost:8080/watch/did:plc:quoted/bafyvideo/thumbnail.jpg"
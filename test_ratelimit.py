@@ -0,0 +1,76 @@
+import threading
+from email.utils import format_datetime
+from datetime import datetime, timezone
+from time import time
+from types import SimpleNamespace
+import pytest
+import ratelimit
+from ratelimit import RateLimiter, parse_retry_after, DEFAULT_RETRY_AFTER
+
+def make_response(status_code=200, **headers):
+    return SimpleNamespace(status_code=status_code, headers={name.replace('_', '-'): value for name, value in headers.items()})
+
+def test_unknown_budget_passes_through():
+    limiter = RateLimiter('test', burst=1)
+    assert [limiter.acquire() for _ in range(5)] == [0.0] * 5
+
+def test_remaining_requests_are_spread_until_the_reset():
+    limiter = RateLimiter('test', burst=1)
+    limiter.update(make_response(x_rate_limit_remaining='20', x_rate_limit_reset=str(time() + 2)))
+    assert limiter.rate == pytest.approx(10, rel=0.1)
+
+    # The burst allowance goes first, then requests are 1/rate apart
+    assert limiter.acquire() == 0.0
+    assert limiter.acquire() == pytest.approx(0.1, abs=0.05)
+    assert limiter.remaining == 18
+
+def test_exhausted_budget_waits_for_the_reset():
+    limiter = RateLimiter('test', burst=5)
+    limiter.update(make_response(x_rate_limit_remaining='0', x_rate_limit_reset=str(time() + 0.3)))
+    assert limiter.acquire() == pytest.approx(0.3, abs=0.1)
+    # The next window's budget is unknown until a response arrives
+    assert limiter.rate is None
+    assert limiter.acquire() == 0.0
+
+def test_update_is_not_blocked_by_a_waiting_request():
+    limiter = RateLimiter('test', burst=1)
+    limiter.update(make_response(x_rate_limit_remaining='0', x_rate_limit_reset=str(time() + 1)))
+    waiter = threading.Thread(target=limiter.acquire)
+    waiter.start()
+    try:
+        started = time()
+        limiter.update(make_response(x_rate_limit_remaining='100', x_rate_limit_reset=str(time() + 60)))
+        assert time() - started < 0.5
+    finally:
+        waiter.join()
+
+@pytest.mark.parametrize('value, expected', [
+    ('120', 120),
+    ('0.5', 0.5),
+    ('-3', 0),
+    (None, DEFAULT_RETRY_AFTER),
+    ('', DEFAULT_RETRY_AFTER),
+    ('soon', DEFAULT_RETRY_AFTER),
+    ('Wed, 21 Oct 2015 07:28:00 GMT', 0)
+])
+def test_parse_retry_after(value, expected):
+    assert parse_retry_after(value) == pytest.approx(expected)
+
+def test_parse_retry_after_http_date():
+    value = format_datetime(datetime.fromtimestamp(time() + 30, timezone.utc), usegmt=True)
+    assert parse_retry_after(value) == pytest.approx(30, abs=1.5)
+
+def test_429_without_reset_uses_retry_after():
+    limiter = RateLimiter('test', burst=1)
+    retry_at = datetime.fromtimestamp(time() + 30, timezone.utc)
+    limiter.update(make_response(429, retry_after=format_datetime(retry_at, usegmt=True)))
+    assert limiter.remaining == 0
+    assert limiter.reset_at == pytest.approx(retry_at.timestamp(), abs=1.5)
+
+    limiter = RateLimiter('test', burst=1)
+    limiter.update(make_response(429))
+    assert limiter.reset_at == pytest.approx(time() + DEFAULT_RETRY_AFTER, abs=1)
+
+def test_limiters_are_shared_per_name():
+    assert ratelimit.get_limiter('test:shared') is ratelimit.get_limiter('test:shared')
+    assert ratelimit.get_limiter('test:shared') is not ratelimit.get_limiter('test:other')
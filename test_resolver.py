@@ -0,0 +1,68 @@
+import pytest
+from diskcache import Cache
+import bench_standins
+from bench_standins import BENCH_HANDLE, BENCH_DID, QUOTED_HANDLE, QUOTED_DID
+from resolver import Resolver, get_pds_endpoint, split_post_uri
+
+@pytest.fixture(scope='module')
+def standin():
+    standin, _ = bench_standins.start(bench_standins.default_options(posts=0, latency=0, image_size=1, video_size=1))
+    return standin
+
+def lookups(standin, name):
+    return standin.stats()['counters'].get(name, 0)
+
+def test_resolved_handles_are_cached(standin):
+    resolver = Resolver(standin.base_url)
+    before = lookups(standin, 'resolve_handle')
+
+    assert resolver.resolve_handle(BENCH_HANDLE) == BENCH_DID
+    assert resolver.resolve_handle(BENCH_HANDLE.upper()) == BENCH_DID
+    assert resolver.resolve_handle(BENCH_DID) == BENCH_DID
+    assert lookups(standin, 'resolve_handle') == before + 1
+
+def test_unknown_handles_are_cached_for_the_negative_ttl(standin):
+    resolver = Resolver(standin.base_url, negative_ttl=300)
+    before = lookups(standin, 'resolve_handle')
+    assert resolver.resolve_handle('nobody.test') is None
+    assert resolver.resolve_handle('nobody.test') is None
+    assert lookups(standin, 'resolve_handle') == before + 1
+
+    resolver = Resolver(standin.base_url, negative_ttl=0)
+    before = lookups(standin, 'resolve_handle')
+    assert resolver.resolve_handle('nobody.test') is None
+    assert resolver.resolve_handle('nobody.test') is None
+    assert lookups(standin, 'resolve_handle') == before + 2
+
+def test_transient_failures_are_not_cached():
+    # Nothing listens on the discard port
+    resolver = Resolver('http://localhost:9')
+    assert resolver.resolve_handle('nobody.test') is None
+    assert resolver.lookup('handle:nobody.test') == (False, None)
+
+def test_batch_resolution_caches_hits_and_misses(standin):
+    resolver = Resolver(standin.base_url)
+    before = lookups(standin, 'get_profiles')
+
+    resolved = resolver.resolve_handles([BENCH_HANDLE, QUOTED_HANDLE, 'nobody.test', BENCH_DID])
+    assert resolved == {BENCH_HANDLE: BENCH_DID, QUOTED_HANDLE: QUOTED_DID, 'nobody.test': None, BENCH_DID: BENCH_DID}
+    assert resolver.resolve_handles(['nobody.test', BENCH_HANDLE]) == {'nobody.test': None, BENCH_HANDLE: BENCH_DID}
+    assert lookups(standin, 'get_profiles') == before + 1
+
+def test_disk_cache_is_shared_between_resolvers(standin, tmp_path):
+    with Cache(str(tmp_path / 'resolver')) as disk_cache:
+        Resolver(standin.base_url, disk_cache=disk_cache).resolve_handle(BENCH_HANDLE)
+        Resolver(standin.base_url, disk_cache=disk_cache).resolve_handle('nobody.test')
+        before = lookups(standin, 'resolve_handle')
+
+        resolver = Resolver(standin.base_url, disk_cache=disk_cache)
+        assert resolver.resolve_handle(BENCH_HANDLE) == BENCH_DID
+        assert resolver.resolve_handle('nobody.test') is None
+        assert lookups(standin, 'resolve_handle') == before
+
+def test_pds_endpoint_and_post_uri_parsing():
+    did_doc = {'service': [{'id': '#atproto_pds', 'type': 'AtprotoPersonalDataServer', 'serviceEndpoint': 'https://pds.example/'}]}
+    assert get_pds_endpoint(did_doc) == 'https://pds.example'
+    assert get_pds_endpoint({'service': []}) is None
+    assert split_post_uri(f"at://{BENCH_DID}/app.bsky.feed.post/abc") == (BENCH_DID, 'abc')
+    assert split_post_uri('https://bsky.app/profile/x') == (None, None)
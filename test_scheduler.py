@@ -0,0 +1,30 @@
+from scheduler import PollScheduler
+
+def test_backs_off_while_quiet_and_resets_on_new_posts():
+    scheduler = PollScheduler(10, 60, backoff=2.0, jitter=0)
+    intervals = []
+    for _ in range(5):
+        scheduler.record_poll(0)
+        intervals.append(scheduler.interval)
+    assert intervals == [20, 40, 60, 60, 60]
+
+    scheduler.record_poll(3)
+    assert scheduler.interval == 10
+
+def test_delay_stays_within_bounds_with_jitter():
+    scheduler = PollScheduler(10, 60, backoff=2.0, jitter=0.5)
+    delays = [scheduler.next_delay() for _ in range(200)]
+    assert min(delays) >= 10
+    assert 10 < max(delays) <= 15
+
+    for _ in range(5):
+        scheduler.record_poll(0)
+    delays = [scheduler.next_delay() for _ in range(200)]
+    assert 30 <= min(delays) < 60
+    assert max(delays) <= 60
+
+def test_maximum_below_minimum_means_a_fixed_interval():
+    scheduler = PollScheduler(30, 5, jitter=0.2)
+    scheduler.record_poll(0)
+    assert scheduler.interval == 30
+    assert scheduler.next_delay() == 30
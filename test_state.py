@@ -0,0 +1,140 @@
+import pytest
+from config import Config
+from state import StateStore, OUTBOX_PENDING, OUTBOX_MEDIA_UPLOADED, OUTBOX_TWEETING, OUTBOX_TWEETED, OUTBOX_FAILED
+
+def make_post(index):
+    return {'uri': f"at://did:plc:test/app.bsky.feed.post/post{index}", 'text': f"post {index}"}
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / 'state.db')
+
+@pytest.fixture
+def state(db_path):
+    store = StateStore(db_path)
+    yield store
+    store.close()
+
+def test_enqueue_keeps_order_and_skips_known_posts(state):
+    state.import_posts([make_post(1)])
+    assert state.enqueue([make_post(2)]) == [make_post(2)]
+
+    queued = state.enqueue([make_post(1), make_post(2), make_post(3), make_post(4)])
+
+    assert queued == [make_post(3), make_post(4)]
+    assert [item['post'] for item in state.pending_items()] == [make_post(2), make_post(3), make_post(4)]
+
+def test_processed_posts_survive_a_restart(db_path):
+    state = StateStore(db_path)
+    state.import_posts([make_post(1)])
+    state.enqueue([make_post(2)])
+    state.complete(make_post(2)['uri'], '200')
+    state.close()
+
+    state = StateStore(db_path)
+    try:
+        assert state.processed_uris == {make_post(1)['uri'], make_post(2)['uri']}
+        assert state.enqueue([make_post(1), make_post(2)]) == []
+        tweet_ids = dict(state.conn.execute("SELECT uri, tweet_id FROM processed_posts"))
+        assert tweet_ids == {make_post(1)['uri']: None, make_post(2)['uri']: '200'}
+    finally:
+        state.close()
+
+def test_item_moves_through_the_outbox(state):
+    uri = make_post(1)['uri']
+    state.enqueue([make_post(1)])
+    assert state.pending_items()[0]['status'] == OUTBOX_PENDING
+
+    state.update_item(uri, status=OUTBOX_MEDIA_UPLOADED, media_ids=['m1', 'm2'], media_uploaded_at=1.0)
+    item = state.pending_items()[0]
+    assert (item['status'], item['media_ids']) == (OUTBOX_MEDIA_UPLOADED, ['m1', 'm2'])
+
+    state.update_item(uri, status=OUTBOX_TWEETING)
+    state.update_item(uri, status=OUTBOX_TWEETED, tweet_id='200')
+    assert state.pending_items()[0]['tweet_id'] == '200'
+
+    state.complete(uri, '200')
+    assert state.pending_items() == []
+    assert uri in state.processed_uris
+    assert state.enqueue([make_post(1)]) == []
+
+def test_failures_are_retried_until_the_attempt_limit(state, monkeypatch):
+    monkeypatch.setattr(Config, 'OUTBOX_MAX_ATTEMPTS', 2)
+    uri = make_post(1)['uri']
+    state.enqueue([make_post(1)])
+
+    assert state.record_failure(uri, Exception("upload failed"), OUTBOX_PENDING)
+    item = state.pending_items()[0]
+    assert (item['status'], item['attempts'], item['last_error']) == (OUTBOX_PENDING, 1, "upload failed")
+
+    assert not state.record_failure(uri, Exception("upload failed again"), OUTBOX_PENDING)
+    assert state.pending_items() == []
+
+    state.retry_failed()
+    item = state.pending_items()[0]
+    assert (item['status'], item['attempts']) == (OUTBOX_PENDING, 0)
+
+def test_restart_resumes_unfinished_items(db_path):
+    state = StateStore(db_path)
+    for index in range(1, 5):
+        state.enqueue([make_post(index)])
+    state.update_item(make_post(2)['uri'], status=OUTBOX_MEDIA_UPLOADED, media_ids=['m2'])
+    state.update_item(make_post(3)['uri'], status=OUTBOX_TWEETING)
+    state.update_item(make_post(4)['uri'], status=OUTBOX_TWEETED, tweet_id='400')
+    state.close()
+
+    state = StateStore(db_path)
+    try:
+        # The tweet of an item that was in flight may or may not exist, so it is parked
+        assert state.recover_interrupted() == [make_post(3)['uri']]
+        items = {item['uri']: item for item in state.pending_items()}
+        assert list(items) == [make_post(1)['uri'], make_post(2)['uri'], make_post(4)['uri']]
+        assert items[make_post(2)['uri']]['media_ids'] == ['m2']
+        assert items[make_post(4)['uri']]['tweet_id'] == '400'
+        assert state.enqueue([make_post(3)]) == []
+
+        # A retried item that already has its tweet only needs the remaining steps
+        state.update_item(make_post(4)['uri'], status=OUTBOX_FAILED)
+        state.retry_failed()
+        statuses = {item['uri']: item['status'] for item in state.pending_items()}
+        assert statuses[make_post(3)['uri']] == OUTBOX_PENDING
+        assert statuses[make_post(4)['uri']] == OUTBOX_TWEETED
+    finally:
+        state.close()
+
+def make_backfill_page(indexes):
+    return [make_post(index) | {'indexed_at': f"2024-01-01T00:00:{index:02}Z"} for index in indexes]
+
+def test_backfill_scan_resumes_after_the_last_stored_page(db_path):
+    state = StateStore(db_path)
+    assert state.get_backfill_progress() == (None, 0, False)
+    state.save_backfill_page(make_backfill_page([6, 5, 4]), 'page2')
+    state.close()
+
+    state = StateStore(db_path)
+    try:
+        assert state.get_backfill_progress() == ('page2', 1, False)
+        state.save_backfill_page(make_backfill_page([3, 2, 1]), None)
+        assert state.get_backfill_progress() == (None, 2, True)
+        # Oldest first, whatever order the pages came in
+        assert [post['uri'] for post in state.next_backfill_batch(10)] == [make_post(index)['uri'] for index in range(1, 7)]
+    finally:
+        state.close()
+
+def test_backfill_skips_known_posts_and_queues_each_post_once(db_path):
+    state = StateStore(db_path)
+    state.import_posts([make_post(1)])
+    state.save_backfill_page(make_backfill_page([4, 3, 2, 1]), None)
+    assert state.count_backfill_remaining() == 3
+
+    state.enqueue_backfill(state.next_backfill_batch(2))
+    state.close()
+
+    state = StateStore(db_path)
+    try:
+        assert [item['uri'] for item in state.pending_items()] == [make_post(2)['uri'], make_post(3)['uri']]
+        assert [post['uri'] for post in state.next_backfill_batch(10)] == [make_post(4)['uri']]
+        # A batch that was already queued is not queued a second time
+        assert state.enqueue_backfill(make_backfill_page([2, 3])) == []
+    finally:
+        state.close()
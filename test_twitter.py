@@ -0,0 +1,94 @@
+import io
+import os
+from types import SimpleNamespace
+import pytest
+import twitter
+from twitter import transfer_media, iter_media_chunks, MEDIA_CHUNK_SIZE
+
+ACCOUNT = SimpleNamespace(name='test')
+
+class MediaResponse:
+    """A streaming media download that hands out its (decoded) body in uneven pieces."""
+
+    def __init__(self, body, headers):
+        self.body = body
+        self.headers = headers
+        self.closed = False
+
+    def iter_content(self, chunk_size):
+        for start in range(0, len(self.body), 300 * 1024):
+            yield self.body[start:start + 300 * 1024]
+
+    def close(self):
+        self.closed = True
+
+@pytest.fixture
+def uploads(monkeypatch):
+    """Record the uploads transfer_media makes instead of sending them to Twitter."""
+    uploads = []
+
+    def upload_media_simple(account, data):
+        uploads.append(('simple', len(data), [data]))
+        return 'simple-id', 86400
+
+    def upload_media_chunked(account, chunks, total_bytes, media_type):
+        uploads.append(('chunked', total_bytes, list(chunks), media_type))
+        return 'chunked-id', 86400
+
+    monkeypatch.setattr(twitter, 'upload_media_simple', upload_media_simple)
+    monkeypatch.setattr(twitter, 'upload_media_chunked', upload_media_chunked)
+    return uploads
+
+def serve_media(monkeypatch, body, **headers):
+    response = MediaResponse(body, {name.replace('_', '-').title(): value for name, value in headers.items()})
+    monkeypatch.setattr(twitter, 'open_media_stream', lambda media_url: response)
+    return response
+
+def test_chunks_have_the_exact_size():
+    data = os.urandom(2 * MEDIA_CHUNK_SIZE + 5)
+    chunks = list(iter_media_chunks(io.BytesIO(data)))
+    assert [len(chunk) for chunk in chunks] == [MEDIA_CHUNK_SIZE, MEDIA_CHUNK_SIZE, 5]
+    assert b''.join(chunks) == data
+
+def test_small_image_with_length_is_uploaded_in_one_request(monkeypatch, uploads):
+    body = os.urandom(200 * 1024)
+    response = serve_media(monkeypatch, body, content_type='image/jpeg', content_length=str(len(body)))
+
+    assert transfer_media(ACCOUNT, 'https://cdn.test/image') == ('simple-id', 86400, body)
+    assert uploads == [('simple', len(body), [body])]
+    assert response.closed
+
+def test_large_image_with_length_is_streamed_in_chunks(monkeypatch, uploads):
+    body = os.urandom(MEDIA_CHUNK_SIZE * 2 + 100)
+    serve_media(monkeypatch, body, content_type='image/png', content_length=str(len(body)))
+
+    assert transfer_media(ACCOUNT, 'https://cdn.test/image') == ('chunked-id', 86400, None)
+    kind, total_bytes, chunks, media_type = uploads[0]
+    assert (kind, total_bytes, media_type) == ('chunked', len(body), 'image/png')
+    assert [len(chunk) for chunk in chunks] == [MEDIA_CHUNK_SIZE, MEDIA_CHUNK_SIZE, 100]
+    assert b''.join(chunks) == body
+
+def test_small_video_blob_uses_the_chunked_flow(monkeypatch, uploads):
+    body = os.urandom(1000)
+    serve_media(monkeypatch, body, content_type='application/octet-stream', content_length=str(len(body)))
+
+    assert transfer_media(ACCOUNT, 'https://pds.test/blob', 'video')[0] == 'chunked-id'
+    assert uploads == [('chunked', 1000, [body], 'video/mp4')]
+
+@pytest.mark.parametrize('size, kind', [(200 * 1024, 'simple'), (MEDIA_CHUNK_SIZE + 1, 'chunked')])
+def test_body_without_length_is_spooled_to_measure_it(monkeypatch, uploads, size, kind):
+    body = os.urandom(size)
+    serve_media(monkeypatch, body, content_type='image/jpeg', transfer_encoding='chunked')
+
+    transfer_media(ACCOUNT, 'https://cdn.test/image')
+    assert uploads[0][:2] == (kind, size)
+    assert b''.join(uploads[0][2]) == body
+
+def test_length_of_an_encoded_body_is_ignored(monkeypatch, uploads):
+    # Content-Length counts the gzip bytes, the body is handed out decoded
+    body = os.urandom(MEDIA_CHUNK_SIZE + 1)
+    serve_media(monkeypatch, body, content_type='image/jpeg', content_encoding='gzip', content_length='4096')
+
+    transfer_media(ACCOUNT, 'https://cdn.test/image')
+    assert uploads[0][:2] == ('chunked', len(body))
+    assert b''.join(uploads[0][2]) == body
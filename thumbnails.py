@@ -0,0 +1,82 @@
+import re
+
+# cv2 and numpy are imported inside the functions that need them, which only run in the
+# preview server's image worker processes, so neither is loaded by the server process itself
+
+# Link cards show images at up to 1200x630; larger images are scaled down to fit, never up
+CARD_WIDTH = 1200
+CARD_HEIGHT = 630
+JPEG_QUALITY = 82
+# How far into a video its poster frame is taken, past fade-ins and black first frames
+POSTER_FRAME_MSEC = 1000
+
+# Bluesky video thumbnails live next to the HLS playlist of the video
+VIDEO_THUMBNAIL_PATH = re.compile(r'^(/watch/[^/]+/[^/]+/)thumbnail\.jpg$')
+
+def get_video_playlist_url(thumbnail_url, video_cdn_url):
+    """Return the playlist URL of the video a thumbnail URL on the video CDN belongs to, or None."""
+    thumbnail_url = thumbnail_url or ''
+    if not thumbnail_url.startswith(f"{video_cdn_url}/"):
+        return None
+    match = VIDEO_THUMBNAIL_PATH.match(thumbnail_url[len(video_cdn_url):])
+    return f"{video_cdn_url}{match.group(1)}playlist.m3u8" if match else None
+
+def flatten_alpha(image):
+    """Put an image with transparency (e.g. a PNG avatar) on a white background."""
+    import cv2
+    import numpy as np
+
+    if image.ndim == 2:
+        return cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+    if image.shape[2] != 4:
+        return image
+    alpha = image[:, :, 3:4].astype(np.float32) / 255
+    return (image[:, :, :3] * alpha + 255 * (1 - alpha)).astype(np.uint8)
+
+def encode_card(image, width=CARD_WIDTH, height=CARD_HEIGHT, quality=JPEG_QUALITY):
+    """Scale an image down to fit the card and encode it as a progressive JPEG."""
+    import cv2
+
+    image = flatten_alpha(image)
+    scale = min(width / image.shape[1], height / image.shape[0], 1)
+    if scale < 1:
+        size = (max(1, round(image.shape[1] * scale)), max(1, round(image.shape[0] * scale)))
+        image = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+
+    ok, encoded = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, quality, cv2.IMWRITE_JPEG_PROGRESSIVE, 1])
+    return encoded.tobytes() if ok else None
+
+def make_card_image(data, width=CARD_WIDTH, height=CARD_HEIGHT, quality=JPEG_QUALITY):
+    """
+    Turn downloaded image bytes into a card-sized JPEG. Returns None when the bytes aren't an image.
+    Runs in the preview server's process pool.
+    """
+    import cv2
+    import numpy as np
+
+    image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+    if image is None:
+        return None
+    return encode_card(image, width, height, quality)
+
+def extract_poster_frame(video_url, width=CARD_WIDTH, height=CARD_HEIGHT, quality=JPEG_QUALITY):
+    """
+    Read a frame from a video (a file or a URL OpenCV can stream, like an HLS playlist) and turn it
+    into a card-sized JPEG. Returns None when no frame can be read. Runs in the preview server's
+    process pool.
+    """
+    import cv2
+
+    capture = cv2.VideoCapture(video_url)
+    try:
+        if not capture.isOpened():
+            return None
+        capture.set(cv2.CAP_PROP_POS_MSEC, POSTER_FRAME_MSEC)
+        ok, frame = capture.read()
+        if not ok:
+            # Shorter than the poster position, or not seekable
+            capture.set(cv2.CAP_PROP_POS_MSEC, 0)
+            ok, frame = capture.read()
+        return encode_card(frame, width, height, quality) if ok else None
+    finally:
+        capture.release()
@@ -1,76 +1,273 @@
-import requests
-from requests_oauthlib import OAuth1
-import os
+import http_client
+import ratelimit
+import metrics
+import logging
+from contextlib import closing
+from tempfile import SpooledTemporaryFile
+from time import sleep
+from diskcache import Cache
 from config import Config
+from resolver import get_post_url
+
+logger = logging.getLogger(__name__)
+
+# OAuth1 signer per account, created on first use
+auths = {}
+# Cache of downloaded blobs and uploaded media ids keyed by blob CID, opened on first use
+media_cache = None
+# Seconds before Twitter's expiry after which a cached media id is no longer reused
+MEDIA_ID_EXPIRY_MARGIN = 600
+# Size of the blocks streamed from the CDN into APPEND requests (Twitter allows up to 5 MB)
+MEDIA_CHUNK_SIZE = 1024 * 1024
+# Twitter accepts up to 4 images (or a single video/GIF) per tweet
+MAX_MEDIA_PER_TWEET = 4
+
+def get_upload_url():
+    """Twitter API endpoint for media upload."""
+    return f"{Config.TWITTER_UPLOAD_URL}/1.1/media/upload.json"
 
-auth = None 
 # Step 1: Upload image to Twitter
-def download_media(media_url):
+def open_media_stream(media_url):
     """
-    Downloads media from the given URL and returns the local file path.
+    Opens a streaming download of the media at the given URL.
+    The caller is responsible for closing the returned response.
     """
-    media_filename = media_url.split('/')[-1].replace('@jpeg', '.jpeg')  # Extract filename from URL
-    local_path = os.path.join('/tmp', media_filename)  # Save in the /tmp directory
-    
-    response = requests.get(media_url)
-    
-    if response.status_code == 200:
-        with open(local_path, 'wb') as media_file:
-            media_file.write(response.content)
-        return local_path
-    else:
+    response = http_client.get(media_url, stream=True)
+
+    if response.status_code != 200:
+        response.close()
         raise Exception(f"Failed to download media: {response.status_code}")
+    return response
 
-def upload_media(media_url):
+def iter_media_chunks(stream, chunk_size=MEDIA_CHUNK_SIZE):
     """
-    Uploads media to Twitter after downloading it locally.
+    Yields blocks of exactly chunk_size bytes (the last one may be shorter) from a streaming
+    response or a file object.
     """
-    # Step 1: Download the media file
-    media_path = download_media(media_url)
+    if hasattr(stream, 'iter_content'):
+        pieces = stream.iter_content(chunk_size=chunk_size)
+    else:
+        pieces = iter(lambda: stream.read(chunk_size), b'')
 
-    # Step 2: Use the downloaded media file to upload to Twitter
-    files = {"media": open(media_path, "rb")}
-    
-    # Twitter API endpoint for media upload (you may need to adjust this)
-    url = "https://upload.twitter.com/1.1/media/upload.json"
+    buffer = bytearray()
+    for piece in pieces:
+        buffer.extend(piece)
+        while len(buffer) >= chunk_size:
+            yield bytes(buffer[:chunk_size])
+            del buffer[:chunk_size]
+    if buffer:
+        yield bytes(buffer)
 
-    response = requests.post(url, files=files, auth=get_auth())
+def get_media_category(media_type):
+    """Maps a MIME type to the Twitter media category used for chunked uploads."""
+    if media_type == 'image/gif':
+        return 'tweet_gif'
+    if media_type.startswith('video/'):
+        return 'tweet_video'
+    return 'tweet_image'
+
+@metrics.STAGE_SECONDS.time(stage='media_upload')
+def upload_media_simple(account, data):
+    """Uploads a small media file in a single request. Returns the media id and its lifetime in seconds."""
+    response = http_client.post(get_upload_url(), files={"media": data}, auth=get_auth(account), rate_limit=media_upload_limit(account))
 
     if response.status_code == 200:
-        media_id = response.json().get("media_id_string")
-        return media_id
+        response_json = response.json()
+        return response_json.get("media_id_string"), response_json.get("expires_after_secs")
     else:
         raise Exception(f"Failed to upload media to Twitter: {response.status_code}")
 
+@metrics.STAGE_SECONDS.time(stage='media_upload')
+def upload_media_chunked(account, chunks, total_bytes, media_type):
+    """
+    Uploads media with the chunked INIT/APPEND/FINALIZE flow, sending one chunk at a time
+    so memory use does not depend on the file size. Returns the media id and its lifetime in seconds.
+    """
+    init_response = http_client.post(get_upload_url(), data={
+        "command": "INIT",
+        "total_bytes": total_bytes,
+        "media_type": media_type,
+        "media_category": get_media_category(media_type)
+    }, auth=get_auth(account), rate_limit=media_upload_limit(account))
+
+    if init_response.status_code not in (200, 201, 202):
+        raise Exception(f"Failed to initialize media upload: {init_response.status_code}")
+    media_id = init_response.json().get("media_id_string")
+
+    for segment_index, chunk in enumerate(chunks):
+        append_response = http_client.post(get_upload_url(), data={
+            "command": "APPEND",
+            "media_id": media_id,
+            "segment_index": segment_index
+        }, files={"media": chunk}, auth=get_auth(account), rate_limit=media_upload_limit(account))
+
+        if append_response.status_code not in (200, 201, 202, 204):
+            raise Exception(f"Failed to append media segment {segment_index}: {append_response.status_code}")
+
+    finalize_response = http_client.post(get_upload_url(), data={
+        "command": "FINALIZE",
+        "media_id": media_id
+    }, auth=get_auth(account), rate_limit=media_upload_limit(account))
+
+    if finalize_response.status_code not in (200, 201):
+        raise Exception(f"Failed to finalize media upload: {finalize_response.status_code}")
+
+    # Videos and GIFs are processed asynchronously and can't be attached before they are done
+    finalize_json = finalize_response.json()
+    wait_for_media_processing(account, media_id, finalize_json.get("processing_info"))
+    return media_id, finalize_json.get("expires_after_secs")
+
+def wait_for_media_processing(account, media_id, processing_info):
+    """
+    Polls the STATUS command until Twitter has finished processing the uploaded media.
+    """
+    while processing_info and processing_info.get("state") in ("pending", "in_progress"):
+        sleep(processing_info.get("check_after_secs", 1))
+
+        status_response = http_client.get(get_upload_url(), params={
+            "command": "STATUS",
+            "media_id": media_id
+        }, auth=get_auth(account), rate_limit=media_upload_limit(account))
+
+        if status_response.status_code != 200:
+            raise Exception(f"Failed to check media processing status: {status_response.status_code}")
+        processing_info = status_response.json().get("processing_info")
+
+    if processing_info and processing_info.get("state") == "failed":
+        error = processing_info.get("error", {})
+        raise Exception(f"Twitter failed to process media {media_id}: {error.get('message', error)}")
+
+def transfer_media(account, media_url, media_kind='image'):
+    """
+    Streams media from the given URL straight into a Twitter upload.
+    Small images are sent in one request; larger files, GIFs and videos use the chunked upload flow.
+    Returns the media id, its lifetime in seconds and the bytes of small images (None otherwise).
+    """
+    with metrics.STAGE_SECONDS.time(stage='media_download'):
+        stream = open_media_stream(media_url)
+
+    with closing(stream) as response:
+        media_type = response.headers.get('Content-Type', 'image/jpeg').split(';')[0].strip()
+        if media_kind == 'video' and not media_type.startswith('video/'):
+            media_type = 'video/mp4'  # Blob downloads may come back as application/octet-stream
+        content_length = response.headers.get('Content-Length')
+        if response.headers.get('Content-Encoding', 'identity').strip().lower() != 'identity':
+            # The body is decoded while streaming, so the compressed length isn't the upload size
+            content_length = None
+        # The simple upload endpoint only accepts still images
+        needs_chunked = get_media_category(media_type) != 'tweet_image'
+
+        if content_length is not None:
+            total_bytes = int(content_length)
+            chunks = iter_media_chunks(response)
+            if total_bytes <= MEDIA_CHUNK_SIZE and not needs_chunked:
+                data = next(chunks, b'')
+                return upload_media_simple(account, data) + (data,)
+            return upload_media_chunked(account, chunks, total_bytes, media_type) + (None,)
+
+        # Without a usable Content-Length the size is needed up front for INIT, so spool the body.
+        # It stays in memory when it fits in a single chunk and only spills to disk beyond that.
+        with SpooledTemporaryFile(max_size=MEDIA_CHUNK_SIZE) as spool:
+            with metrics.STAGE_SECONDS.time(stage='media_download'):
+                for chunk in iter_media_chunks(response):
+                    spool.write(chunk)
+            total_bytes = spool.tell()
+            spool.seek(0)
+
+            if total_bytes <= MEDIA_CHUNK_SIZE and not needs_chunked:
+                data = spool.read()
+                return upload_media_simple(account, data) + (data,)
+            return upload_media_chunked(account, iter_media_chunks(spool), total_bytes, media_type) + (None,)
+
+def get_media_cache():
+    """Return the media cache, opening it on first use."""
+    global media_cache
+    if media_cache is None:
+        media_cache = Cache(Config.MEDIA_CACHE_DIR, size_limit=Config.MEDIA_CACHE_SIZE_LIMIT)
+    return media_cache
+
+def upload_media(account, media_url, media_kind='image', cid=None):
+    """
+    Uploads media to Twitter, reusing earlier work for the same Bluesky blob CID.
+    A still valid media id is returned without any network I/O, and cached image bytes
+    are uploaded again without downloading them from the CDN.
+    """
+    if cid is None:
+        return transfer_media(account, media_url, media_kind)[0]
+
+    cache = get_media_cache()
+    media_id = cache.get(f"media_id:{account.name}:{cid}")
+    if media_id:
+        metrics.CACHE_REQUESTS.inc(cache='media_id', result='hit')
+        logger.info(f"Reusing uploaded media {media_id} for blob {cid}", extra={'media_id': media_id, 'cid': cid})
+        return media_id
+    metrics.CACHE_REQUESTS.inc(cache='media_id', result='miss')
+
+    data = cache.get(f"blob:{cid}")
+    metrics.CACHE_REQUESTS.inc(cache='blob', result='miss' if data is None else 'hit')
+    if data is not None:
+        media_id, expires_after_secs = upload_media_simple(account, data)
+    else:
+        media_id, expires_after_secs, data = transfer_media(account, media_url, media_kind)
+        if data is not None:
+            cache.set(f"blob:{cid}", data, expire=Config.MEDIA_BLOB_TTL)
+
+    # Stop reusing the media id a little before Twitter expires it
+    if expires_after_secs and expires_after_secs > MEDIA_ID_EXPIRY_MARGIN:
+        cache.set(f"media_id:{account.name}:{cid}", media_id, expire=expires_after_secs - MEDIA_ID_EXPIRY_MARGIN)
+    return media_id
+
 def convert_bluesky_to_preview_url(bluesky_url):
     """
     Converts a Bluesky post URL to your custom preview URL format.
     """
     try:
-        # Split the Bluesky URL to extract the handle and post ID
+        # Split the Bluesky URL to extract the author (a DID or a handle) and post ID
         parts = bluesky_url.split('/')
-        handle = parts[4]  # The handle is in the 5th position
+        handle = parts[4]  # The author is in the 5th position
         post_id = parts[6]  # The post ID is in the 7th position
 
         # Construct the preview URL
-        preview_url = f"https://bluesky.owo.nexus/preview/{handle}/post/{post_id}"
+        preview_url = f"{Config.PREVIEW_URL}/preview/{handle}/post/{post_id}"
         return preview_url
 
     except IndexError:
-        print("Invalid Bluesky URL format.")
+        logger.error("Invalid Bluesky URL format.", extra={'url': bluesky_url})
         return None
 
+def warm_preview_cache(posts):
+    """
+    Push the preview data of posts about to be tweeted to the preview server, so the crawler
+    that follows the links in the tweet is served from its cache. Failures are only logged.
+    """
+    previews = [preview for post in posts for preview in post.get('previews', [])]
+    if not Config.PREVIEW_WARM_URL or not previews:
+        return
+
+    headers = {}
+    if Config.PREVIEW_WARM_TOKEN:
+        headers['Authorization'] = f"Bearer {Config.PREVIEW_WARM_TOKEN}"
+
+    try:
+        response = http_client.post(Config.PREVIEW_WARM_URL, json={'posts': previews}, headers=headers)
+        if response.status_code != 200:
+            logger.warning(f"Failed to warm the preview cache. Status code: {response.status_code}")
+    except Exception as e:
+        logger.warning(f"Failed to warm the preview cache: {e}")
+
 # Step 2: Post a tweet with the uploaded image and a quoted Bluesky post
-def post_tweet_with_media_and_quote(text, media_id=None, quoted_url=None):
-    tweet_url = "https://api.x.com/2/tweets"
+def post_tweet_with_media_and_quote(account, text, media_ids=None, quoted_url=None):
+    tweet_url = f"{Config.TWITTER_API_URL}/2/tweets"
 
     payload = {
         "text": text
     }
 
-    # Add media to tweet if media_id is provided
-    if media_id:
-        payload["media"] = {"media_ids": [media_id]}
+    # Add media to tweet if media ids are provided (a single id is accepted as well)
+    if isinstance(media_ids, str):
+        media_ids = [media_ids]
+    if media_ids:
+        payload["media"] = {"media_ids": media_ids[:MAX_MEDIA_PER_TWEET]}
 
     # Convert Bluesky URL to preview URL and add it to the tweet text
     if quoted_url:
@@ -78,28 +275,25 @@ def post_tweet_with_media_and_quote(text, media_id=None, quoted_url=None):
         if preview_url:
             payload["text"] += f"\n\n{preview_url}"
         else:
-            print(f"Failed to convert quoted Bluesky URL: {quoted_url}")
+            logger.error(f"Failed to convert quoted Bluesky URL: {quoted_url}")
 
-    response = requests.post(tweet_url, json=payload, auth=get_auth())
+    response = http_client.post(tweet_url, json=payload, auth=get_auth(account), rate_limit=tweet_create_limit(account))
 
     if response.status_code == 201:
-        print("Tweet posted successfully:", response.json())
+        logger.info("Tweet posted successfully", extra={'tweet_id': response.json().get('data', {}).get('id')})
         return response
     else:
-        print(f"Failed to post tweet. Status code: {response.status_code}, Response: {response.text}")
+        logger.error(f"Failed to post tweet. Status code: {response.status_code}", extra={'response': response.text})
         return response
 
-def comment_with_original_post(tweet_id, post_data):
+def comment_with_original_post(account, tweet_id, post_data):
     """
     Comment on the Twitter post with a link to the original Bluesky post.
-    Accesses the author_handle directly from the post_data.
+    The link names the author by DID, taken from the post URI.
     """
-    uri = post_data.get('uri')
-    author_handle = post_data.get('author_handle')  # Access the author handle from post_data
-    post_id = uri.split('/')[-1]  # Extract the last part of the URI
-    bluesky_url = f"https://bsky.app/profile/{author_handle}/post/{post_id}"
+    bluesky_url = get_post_url(post_data.get('uri'))
 
-    tweet_url = "https://api.x.com/2/tweets"
+    tweet_url = f"{Config.TWITTER_API_URL}/2/tweets"
 
     # Payload for replying to the tweet with the original Bluesky URL
     payload = {
@@ -109,18 +303,31 @@ def comment_with_original_post(tweet_id, post_data):
         }
     }
 
-    response = requests.post(tweet_url, json=payload, auth=get_auth())
+    response = http_client.post(tweet_url, json=payload, auth=get_auth(account), rate_limit=tweet_create_limit(account))
 
     if response.status_code == 201:
-        print(f"Comment posted successfully: {response.json()}")
+        logger.info("Comment posted successfully", extra={'tweet_id': response.json().get('data', {}).get('id')})
     else:
-        print(f"Failed to post comment. Status code: {response.status_code}, Response: {response.text}")
+        logger.error(f"Failed to post comment. Status code: {response.status_code}", extra={'response': response.text})
+    return response
+
+def media_upload_limit(account):
+    return ratelimit.for_account(account, ratelimit.MEDIA_UPLOAD)
 
-def get_auth():
-    return  OAuth1(
-    Config.TWITTER_API_KEY,
-    Config.TWITTER_API_SECRET_KEY,
-    Config.TWITTER_ACCESS_TOKEN,
-    Config.TWITTER_ACCESS_TOKEN_SECRET
-    )
+def tweet_create_limit(account):
+    return ratelimit.for_account(account, ratelimit.TWEET_CREATE)
 
+def get_auth(account):
+    """Return the shared OAuth1 signer of the account's Twitter credentials."""
+    auth = auths.get(account.name)
+    if auth is None:
+        # Imported on first use; oauthlib is one of the slower imports at startup
+        from requests_oauthlib import OAuth1
+        auth = OAuth1(
+        account.twitter_api_key,
+        account.twitter_api_secret_key,
+        account.twitter_access_token,
+        account.twitter_access_token_secret
+        )
+        auths[account.name] = auth
+    return auth